@@ -0,0 +1,108 @@
+"""Extracts numeric fields from stored proto history into columnar NumPy arrays.
+
+Example:
+  columns = columnar.Extract(
+      db, 'yf.info', ['income.revenue', 'price_target.average'], tickers,
+      '2021-01-01', '2022-12-31')
+  df = columnar.ToDataFrame(columns)  # Indexed by (date, ticker).
+"""
+from concurrent.futures import ProcessPoolExecutor
+import os
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+
+from analysis import proto_fields
+from storage import sqlite
+
+# Columns holding the row keys, in addition to one float64 column per field path.
+DATE = 'date'
+TICKER = 'ticker'
+
+Columns = Dict[str, np.ndarray]
+
+# Storage opened once per extraction worker process, keyed by db_dir.
+_WORKER_DBS: Dict[str, sqlite.ShardedSqliteStorage] = {}
+
+
+def _CompileFields(group: str, fields: Sequence[str]) -> List[proto_fields.FieldPath]:
+  if group not in proto_fields.GROUP_MESSAGES:
+    raise ValueError('No proto message for group: %s' % group)
+  message_class = proto_fields.GROUP_MESSAGES[group]
+  paths = [proto_fields.Compile(message_class, f) for f in fields]
+  for path in paths:
+    if not path.is_numeric:
+      raise ValueError('Field is not numeric: %s' % path.path)
+  return paths
+
+
+def _ExtractRows(rows, group: str, fields: Sequence[str]) -> Columns:
+  """Decodes (date, ticker, data) rows into columns."""
+  message_class = proto_fields.GROUP_MESSAGES[group]
+  paths = _CompileFields(group, fields)
+  dates = []
+  tickers = []
+  values = []
+  for date_str, ticker, data in rows:
+    msg = message_class.FromString(data)
+    dates.append(date_str)
+    tickers.append(ticker)
+    values.append([path(msg) for path in paths])
+  matrix = np.array(values, dtype=np.float64).reshape(len(values), len(paths))
+  columns = {DATE: np.array(dates, dtype=object), TICKER: np.array(tickers, dtype=object)}
+  for i, f in enumerate(fields):
+    columns[f] = matrix[:, i]
+  return columns
+
+
+def _ExtractQuarter(db_dir, quarter, group, fields, tickers, date_from, date_to) -> Columns:
+  """Extracts a single quarter shard in a worker process."""
+  if db_dir not in _WORKER_DBS:
+    _WORKER_DBS[db_dir] = sqlite.ShardedSqliteStorage(db_dir, read_only=True)
+  rows = _WORKER_DBS[db_dir].Scan(group, date_from, date_to, tickers, quarters=[quarter])
+  return _ExtractRows(rows, group, fields)
+
+
+def _Concat(parts: List[Columns], fields: Sequence[str]) -> Columns:
+  keys = [DATE, TICKER] + list(fields)
+  if not parts:
+    return {k: np.array([], dtype=object if k in (DATE, TICKER) else np.float64) for k in keys}
+  return {k: np.concatenate([p[k] for p in parts]) for k in keys}
+
+
+def Extract(
+    db: sqlite.ShardedSqliteStorage, group: str, fields: Sequence[str],
+    tickers: Iterable[str] = None, date_from: str = '2022-01-01', date_to: str = None,
+    parallel: bool = True, max_workers: int = None) -> Columns:
+  """Returns one row per stored (date, ticker) with the values of the given field paths.
+
+  The result maps DATE, TICKER and each field path to a 1-D array, sorted by (date, ticker). Unset
+  values are NaN. date_to defaults to today. With `parallel`, each quarter shard is decoded in its
+  own worker process.
+  """
+  date_to = date_to or sqlite.GetDaysAgoStr(0)
+  fields = list(fields)
+  _CompileFields(group, fields)
+  tickers = sorted(set(tickers)) if tickers is not None else None
+  existing = set(db.ListQuarters())
+  quarters = [
+      q for q in sqlite.GetQuarters(sqlite.GetDate(date_from), sqlite.GetDate(date_to))
+      if q in existing]
+  if parallel and len(quarters) > 1:
+    max_workers = min(len(quarters), max_workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+      parts = list(executor.map(
+          _ExtractQuarter, *zip(*[
+              (db.db_dir, q, group, fields, tickers, date_from, date_to) for q in quarters])))
+  else:
+    parts = [
+        _ExtractRows(db.Scan(group, date_from, date_to, tickers, quarters=[q]), group, fields)
+        for q in quarters]
+  return _Concat(parts, fields)
+
+
+def ToDataFrame(columns: Columns):
+  """Returns the columns as a pandas DataFrame indexed by (date, ticker)."""
+  import pandas as pd
+  df = pd.DataFrame(columns)
+  return df.set_index([DATE, TICKER])
@@ -0,0 +1,71 @@
+import math
+import shutil
+import tempfile
+import unittest
+
+from analysis import columnar
+from protos import yfinance_pb2 as yfpb
+from storage import sqlite
+
+
+def _Info(revenue: float) -> bytes:
+  info = yfpb.Info()
+  if revenue:
+    info.income.revenue = revenue
+  info.price_target.average = 10.0
+  return info.SerializeToString()
+
+
+class TestColumnar(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.storage = sqlite.ShardedSqliteStorage(self.tmp_dir)
+    self.storage.WriteMany([
+      ('T1', '2021-01-04', _Info(1.0), 'yf.info'),
+      ('T2', '2021-01-04', _Info(2.0), 'yf.info'),
+      ('T1', '2021-12-01', _Info(0), 'yf.info'),
+      ('T3', '2021-12-01', _Info(3.0), 'yf.info'),
+    ])
+
+  def tearDown(self) -> None:
+    self.storage.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def _Extract(self, **kwargs):
+    return columnar.Extract(
+        self.storage, 'yf.info', ['income.revenue', 'price_target.average'],
+        date_from='2021-01-01', date_to='2021-12-31', **kwargs)
+
+  def testExtract(self):
+    columns = self._Extract(tickers=['T1', 'T2'], parallel=False)
+    self.assertEqual(list(columns[columnar.DATE]), ['2021-01-04', '2021-01-04', '2021-12-01'])
+    self.assertEqual(list(columns[columnar.TICKER]), ['T1', 'T2', 'T1'])
+    self.assertEqual(list(columns['income.revenue'][:2]), [1.0, 2.0])
+    self.assertTrue(math.isnan(columns['income.revenue'][2]))
+    self.assertEqual(list(columns['price_target.average']), [10.0] * 3)
+
+  def testExtractParallel(self):
+    sequential = self._Extract(parallel=False)
+    parallel = self._Extract(parallel=True)
+    self.assertEqual(list(parallel[columnar.TICKER]), ['T1', 'T2', 'T1', 'T3'])
+    self.assertEqual(
+      list(parallel['price_target.average']), list(sequential['price_target.average']))
+
+  def testExtractEmpty(self):
+    columns = columnar.Extract(
+        self.storage, 'yf.info', ['income.revenue'], date_from='2019-01-01',
+        date_to='2019-12-31')
+    self.assertEqual(len(columns['income.revenue']), 0)
+
+  def testNonNumericField(self):
+    with self.assertRaises(ValueError):
+      columnar.Extract(self.storage, 'yf.info', ['dividend.ex_date'])
+
+  def testToDataFrame(self):
+    df = columnar.ToDataFrame(self._Extract(parallel=False))
+    self.assertEqual(df.loc[('2021-12-01', 'T3'), 'income.revenue'], 3.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+"""Local stand-in of the Yahoo Finance JSON API for tests.
+
+Serves the quote, quote summary and crumb endpoints used by fetch.ApiFetcher with HTTP/1.1
+keep-alive, and counts the requests and connections it gets. It can throttle quote summary
+requests like the real API: over `max_rate` per second, or `max_concurrency` at a time, they get a
+429 error.
+"""
+import collections
+import http.server
+import json
+import socketserver
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict
+
+CRUMB = 'test-crumb'
+
+
+def Value(raw: Any) -> Dict[str, Any]:
+  """Returns raw as an API value, e.g. {"raw": 1.5, "fmt": "1.5"}."""
+  return {'raw': raw, 'fmt': str(raw)}
+
+
+def Summary(price: float, eps: float) -> Dict[str, Any]:
+  """Returns the quote summary modules of a ticker, in the API format."""
+  trend = []
+  for period, end_date in [('0q', '2022-06-30'), ('+1y', '2023-09-30'), ('+5y', None)]:
+    trend.append({
+      'maxAge': 1,
+      'period': period,
+      'endDate': end_date,
+      'growth': Value(0.1),
+      'earningsEstimate': {
+        'avg': Value(eps), 'low': Value(eps * 0.9), 'high': Value(eps * 1.1),
+        'yearAgoEps': Value(eps * 0.8), 'numberOfAnalysts': Value(20), 'growth': Value(0.05),
+      },
+      'revenueEstimate': {
+        'avg': Value(eps * 1e9), 'numberOfAnalysts': Value(18), 'growth': {},
+      },
+      'epsTrend': {'current': Value(eps), '7daysAgo': Value(eps), '30daysAgo': Value(eps * 0.98)},
+      'epsRevisions': {'upLast7days': Value(2), 'downLast30days': Value(1)},
+    })
+  return {
+    'financialData': {
+      'targetLowPrice': Value(price * 0.8),
+      'targetMeanPrice': Value(price * 1.1),
+      'numberOfAnalystOpinions': Value(30),
+      'totalRevenue': Value(3.6e11),
+      'grossProfits': {},
+    },
+    'defaultKeyStatistics': {'sharesOutstanding': Value(1.6e10), 'beta': Value(1.2)},
+    'summaryDetail': {'fiftyDayAverage': Value(price * 0.98), 'dividendRate': Value(0.88)},
+    'price': {'regularMarketPrice': Value(price)},
+    'earningsTrend': {'trend': trend, 'maxAge': 1},
+  }
+
+
+class FakeApi(object):
+  """Serves `summaries` ({ticker: summary modules}) on localhost until stopped.
+
+  Requests for tickers listed in `failing` get a 500 error. Quote summaries take latency_secs to
+  serve, and are throttled over max_rate per second (with bursts of up to max_rate requests) or
+  max_concurrency at a time; throttled responses have a Retry-After header if retry_after is set.
+  """
+
+  def __init__(
+      self, summaries: Dict[str, Dict[str, Any]], failing=(), max_rate: float = None,
+      max_concurrency: int = None, latency_secs: float = 0, retry_after: int = None):
+    self.summaries = summaries
+    self.failing = set(failing)
+    self.max_rate = max_rate
+    self.max_concurrency = max_concurrency
+    self.latency_secs = latency_secs
+    self.retry_after = retry_after
+    self.requests = collections.Counter()
+    self.connections = 0
+    self.throttled = 0
+    self._in_flight = 0
+    self._tokens = max_rate
+    self._last = time.monotonic()
+    self._lock = threading.Lock()
+    api = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def setup(self):
+        super().setup()
+        with api._lock:
+          api.connections += 1
+
+      def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        with api._lock:
+          api.requests[url.path] += 1
+        status, body = api.Handle(url.path, urllib.parse.parse_qs(url.query))
+        body = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        if status == 429 and api.retry_after is not None:
+          self.send_header('Retry-After', str(api.retry_after))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, *args):
+        pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+      daemon_threads = True
+
+    self.server = Server(('127.0.0.1', 0), Handler)
+    self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+    self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+  def _Admit(self) -> bool:
+    """Returns whether a quote summary request is under the limits, and counts it in flight."""
+    with self._lock:
+      if self.max_rate:
+        now = time.monotonic()
+        self._tokens = min(self.max_rate, self._tokens + (now - self._last) * self.max_rate)
+        self._last = now
+      if ((self.max_rate and self._tokens < 1) or
+          (self.max_concurrency and self._in_flight >= self.max_concurrency)):
+        self.throttled += 1
+        return False
+      if self.max_rate:
+        self._tokens -= 1
+      self._in_flight += 1
+      return True
+
+  def Handle(self, path: str, params: Dict[str, Any]):
+    if path == '/v1/test/getcrumb':
+      return 200, CRUMB.encode('utf-8')
+    if params.get('crumb') != [CRUMB]:
+      return 401, {'finance': {'error': {'code': 'Unauthorized'}}}
+    if path == '/v7/finance/quote':
+      symbols = params['symbols'][0].split(',')
+      result = [{'symbol': t, 'averageDailyVolume10Day': 1e6}
+                for t in symbols if t in self.summaries]
+      return 200, {'quoteResponse': {'result': result, 'error': None}}
+    prefix = '/v10/finance/quoteSummary/'
+    if path.startswith(prefix):
+      if not self._Admit():
+        return 429, {'finance': {'error': {'code': 'Too Many Requests'}}}
+      try:
+        time.sleep(self.latency_secs)
+        return self._Summary(path[len(prefix):])
+      finally:
+        with self._lock:
+          self._in_flight -= 1
+    return 404, {}
+
+  def _Summary(self, ticker: str):
+    if ticker in self.failing:
+      return 500, {'quoteSummary': {'result': None, 'error': {'code': 'Internal'}}}
+    if ticker not in self.summaries:
+      return 404, {'quoteSummary': {'result': None, 'error': {'code': 'Not Found'}}}
+    return 200, {'quoteSummary': {'result': [self.summaries[ticker]], 'error': None}}
+
+  def __enter__(self):
+    self._thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self.server.shutdown()
+    self.server.server_close()
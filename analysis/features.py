@@ -0,0 +1,54 @@
+"""Projections of the stored yfinance protos into the numeric feature table of the storage.
+
+Every set numeric field of yfpb.Info, and of each Period of yfpb.Analysis, becomes a feature
+named by its field path (see proto_fields), e.g. `price_target.average` or
+`periods[0Q].eps_estimate.average`:
+
+  db = sqlite.ShardedSqliteStorage(db_dir, projections=features.PROJECTIONS)
+  # Tickers whose average price target rose by more than 5% in 30 days.
+  features.Changes(db, 'yf.info', 'price_target.average', '2022-03-31', 30, min_change=0.05)
+"""
+import datetime
+from typing import List, Tuple
+
+from analysis import proto_fields
+from storage import sqlite
+
+
+def Project(message_class) -> sqlite.Projection:
+  """Returns the projection of serialized messages of the class into features."""
+  def Projection(data: bytes):
+    return proto_fields.Flatten(message_class.FromString(data))
+  return Projection
+
+
+# Projections of the proto groups, for ShardedSqliteStorage.
+PROJECTIONS = {
+  group: Project(message_class)
+  for group, message_class in proto_fields.GROUP_MESSAGES.items()
+}
+
+
+def Changes(
+    db: sqlite.ShardedSqliteStorage, group: str, path: str, date_str: str, days: int,
+    min_change: float = None, max_staleness_days: int = 7,
+    tickers=None) -> List[Tuple[str, float, float, float]]:
+  """Returns (ticker, old value, new value, relative change) of a feature over `days`.
+
+  The new value is the latest one on or before date_str and the old one the latest on or before
+  `days` earlier, each at most max_staleness_days old. Only tickers with both values, a non-zero
+  old value and, if given, a change above min_change are returned, by decreasing change.
+  """
+  date_from = (sqlite.GetDate(date_str) - datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+  old = {ticker: value for ticker, _, value in db.FeatureCrossSection(
+      date_from, group, path, tickers, max_staleness_days)}
+  result = []
+  for ticker, _, value in db.FeatureCrossSection(
+      date_str, group, path, tickers, max_staleness_days):
+    if not old.get(ticker):
+      continue
+    change = value / old[ticker] - 1
+    if min_change is None or change > min_change:
+      result.append((ticker, old[ticker], value, change))
+  result.sort(key=lambda row: -row[3])
+  return result
@@ -0,0 +1,76 @@
+import shutil
+import tempfile
+import unittest
+
+from analysis import features
+from protos import yfinance_pb2 as yfpb
+from storage import sqlite
+
+
+def Info(price_target: float) -> bytes:
+  info = yfpb.Info()
+  info.price_target.average = price_target
+  info.income.revenue = 100.0
+  return info.SerializeToString()
+
+
+class TestFeatures(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.db = sqlite.ShardedSqliteStorage(self.tmp_dir, projections=features.PROJECTIONS)
+
+  def tearDown(self) -> None:
+    self.db.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def testProjections(self):
+    analysis = yfpb.Analysis()
+    p = analysis.periods.add()
+    p.name = '0Q'
+    p.end_date = '2022-03-31'
+    p.eps_estimate.average = 1.5
+    s = p.eps_estimate_snapshots.add()
+    s.days_ago = 7
+    s.value = 1.4
+    self.db.WriteMany([
+      ('A', '2022-01-03', Info(10.0), 'yf.info'),
+      ('A', '2022-01-03', analysis.SerializeToString(), 'yf.analysis'),
+    ])
+    self.assertEqual(
+        self.db.FeatureFields('yf.info'), ['income.revenue', 'price_target.average'])
+    self.assertEqual(
+        self.db.FeatureFields('yf.analysis'),
+        ['periods[0Q].eps_estimate.average', 'periods[0Q].eps_estimate_snapshots[7].value'])
+    self.assertEqual(
+        list(self.db.ReadFeature(
+            'yf.analysis', 'periods[0Q].eps_estimate_snapshots[7].value',
+            '2022-01-01', '2022-01-31')),
+        [('2022-01-03', 'A', 1.4)])
+
+  def testChanges(self):
+    self.db.WriteMany([
+      ('A', '2022-02-01', Info(10.0), 'yf.info'),
+      ('B', '2022-02-01', Info(10.0), 'yf.info'),
+      ('C', '2022-02-01', Info(10.0), 'yf.info'),
+      ('A', '2022-03-01', Info(11.0), 'yf.info'),
+      ('B', '2022-03-01', Info(10.2), 'yf.info'),
+      ('D', '2022-03-01', Info(20.0), 'yf.info'),
+    ])
+    changes = features.Changes(
+        self.db, 'yf.info', 'price_target.average', '2022-03-03', 30, min_change=0.05)
+    self.assertEqual([row[:3] for row in changes], [('A', 10.0, 11.0)])
+    self.assertAlmostEqual(changes[0][3], 0.1)
+    self.assertEqual(
+        [row[0] for row in features.Changes(
+            self.db, 'yf.info', 'price_target.average', '2022-03-03', 30)],
+        ['A', 'B'])
+    self.assertEqual(
+        features.Changes(
+            self.db, 'yf.info', 'price_target.average', '2022-03-03', 30,
+            max_staleness_days=1),
+        [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,352 @@
+"""Fetch layer for yfinance data, with an on-disk record/replay response cache.
+
+A Response holds the raw payloads of a ticker exactly as stored in the raw DB: `ticker.info` as
+JSON and `ticker.analysis` as DataFrame.to_json(). YFinanceClient parses these same bytes.
+
+YFinanceFetcher scrapes the pages of a ticker with the yfinance package. ApiFetcher builds the same
+payloads from the Yahoo Finance JSON API, with a single quote summary request per ticker over a
+shared keep-alive session, and can fetch the quotes of many tickers at once.
+
+CachingFetcher stores payloads under <cache_dir>/<date>/<endpoint>/<ticker>.json and runs in one
+of the modes:
+  * cache: serve fresh entries (younger than ttl_secs), fetch and store the others.
+  * record: always fetch and store.
+  * replay: serve the latest entry of each ticker regardless of age, and never fetch.
+"""
+import calendar
+import collections
+import datetime
+import json
+import logging
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+ENDPOINTS = ('info', 'analysis')
+
+MODE_CACHE = 'cache'
+MODE_RECORD = 'record'
+MODE_REPLAY = 'replay'
+_MODES = (MODE_CACHE, MODE_RECORD, MODE_REPLAY)
+
+_DEFAULT_TTL_SECS = 3600
+_DEFAULT_MAX_BYTES = 1 << 30
+# Infix of the temporary files of entries being stored.
+_TMP_SUFFIX = '.tmp-'
+
+_DEFAULT_API_URL = 'https://query2.finance.yahoo.com'
+# Sets the cookies the API requires along with a crumb.
+_DEFAULT_COOKIE_URL = 'https://fc.yahoo.com'
+_USER_AGENT = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/100.0.4896.127 Safari/537.36')
+_DEFAULT_TIMEOUT_SECS = 30
+# Max symbols of a batch quote request.
+_QUOTE_BATCH_SIZE = 50
+
+# Quote summary modules merged into `ticker.info` by yfinance, in order.
+_INFO_MODULES = [
+  'summaryProfile', 'financialData', 'quoteType', 'defaultKeyStatistics', 'assetProfile',
+  'summaryDetail',
+]
+_SUMMARY_MODULES = _INFO_MODULES + ['price', 'earningsTrend']
+
+
+class Response(object):
+  """Raw yfinance payloads of a ticker."""
+
+  def __init__(self, ticker: str, info: bytes, analysis: bytes):
+    self.ticker = ticker
+    self.info = info
+    self.analysis = analysis
+
+  def Get(self, endpoint: str) -> bytes:
+    return getattr(self, endpoint)
+
+
+class Fetcher(object):
+
+  def Fetch(self, ticker: str) -> Response:
+    raise NotImplementedError()
+
+
+class YFinanceFetcher(Fetcher):
+  """Fetches from Yahoo with the yfinance package."""
+
+  def Fetch(self, ticker: str) -> Response:
+    import yfinance as yf
+    t = yf.Ticker(ticker)
+    analysis = t.analysis
+    return Response(
+        ticker,
+        json.dumps(t.info).encode('utf-8'),
+        analysis.to_json().encode('utf-8') if analysis is not None else b'null')
+
+
+class ApiFetcher(Fetcher):
+  """Fetches from the Yahoo Finance JSON API over a shared, pooled keep-alive session.
+
+  The payloads are those of YFinanceFetcher: `info` merges the same quote summary modules as
+  yfinance, and `analysis` is the earnings trend table in the DataFrame.to_json() layout.
+  """
+
+  def __init__(
+      self, base_url: str = _DEFAULT_API_URL, cookie_url: str = _DEFAULT_COOKIE_URL,
+      pool_size: int = 8, timeout_secs: float = _DEFAULT_TIMEOUT_SECS):
+    import requests
+    self.base_url = base_url.rstrip('/')
+    self.cookie_url = cookie_url
+    self.timeout_secs = timeout_secs
+    self.session = requests.Session()
+    self.session.headers['User-Agent'] = _USER_AGENT
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self._crumb: str = None
+    self._crumb_lock = threading.Lock()
+
+  def _Crumb(self) -> str:
+    import requests
+    with self._crumb_lock:
+      if self._crumb is None:
+        if self.cookie_url:
+          try:
+            self.session.get(self.cookie_url, timeout=self.timeout_secs)
+          except requests.RequestException:
+            pass  # The cookie is set on error responses too.
+        response = self.session.get(
+            self.base_url + '/v1/test/getcrumb', timeout=self.timeout_secs)
+        self._crumb = response.text if response.ok else ''
+      return self._crumb
+
+  def _Get(self, path: str, params: Dict[str, str]) -> Dict[str, Any]:
+    params = dict(params)
+    crumb = self._Crumb()
+    if crumb:
+      params['crumb'] = crumb
+    response = self.session.get(self.base_url + path, params=params, timeout=self.timeout_secs)
+    response.raise_for_status()
+    return response.json()
+
+  def FetchQuotes(self, tickers: Sequence[str]) -> Dict[str, Dict[str, Any]]:
+    """Returns the quotes of the existing tickers, with one request per 50 tickers."""
+    quotes = {}
+    for i in range(0, len(tickers), _QUOTE_BATCH_SIZE):
+      data = self._Get(
+          '/v7/finance/quote', {'symbols': ','.join(tickers[i:i + _QUOTE_BATCH_SIZE])})
+      for quote in (data.get('quoteResponse') or {}).get('result') or []:
+        quotes[quote['symbol']] = quote
+    return quotes
+
+  def FetchSummary(self, ticker: str) -> Dict[str, Any]:
+    """Returns the quote summary modules of the ticker, with raw values."""
+    data = self._Get(
+        '/v10/finance/quoteSummary/%s' % ticker, {'modules': ','.join(_SUMMARY_MODULES)})
+    summary = data.get('quoteSummary') or {}
+    if not summary.get('result'):
+      raise ValueError('No quote summary for %s: %s' % (ticker, summary.get('error')))
+    return Unwrap(summary['result'][0])
+
+  def FetchResponse(self, ticker: str, quote: Dict[str, Any] = None) -> Response:
+    """Fetches the ticker, adding the quote fields missing from its summary to info."""
+    summary = self.FetchSummary(ticker)
+    return Response(
+        ticker,
+        json.dumps(InfoPayload(summary, quote)).encode('utf-8'),
+        json.dumps(AnalysisPayload(summary)).encode('utf-8'))
+
+  def Fetch(self, ticker: str) -> Response:
+    return self.FetchResponse(ticker)
+
+
+def Unwrap(value: Any) -> Any:
+  """Replaces the {"raw": ..., "fmt": ...} values of API responses by their raw value.
+
+  Empty objects become None, like in yfinance.
+  """
+  if isinstance(value, dict):
+    if 'raw' in value:
+      return value['raw']
+    if not value:
+      return None
+    return {k: Unwrap(v) for k, v in value.items()}
+  if isinstance(value, list):
+    return [Unwrap(v) for v in value]
+  return value
+
+
+def InfoPayload(summary: Dict[str, Any], quote: Dict[str, Any] = None) -> Dict[str, Any]:
+  """Returns the `ticker.info` dict of yfinance from quote summary modules."""
+  info = {}
+  for module in _INFO_MODULES:
+    if isinstance(summary.get(module), dict):
+      info.update(summary[module])
+  price = summary.get('price') or {}
+  if not isinstance(summary.get('summaryDetail'), dict):
+    info.update(price)
+  info['regularMarketPrice'] = price.get('regularMarketPrice', info.get('regularMarketOpen'))
+  info['preMarketPrice'] = price.get('preMarketPrice', info.get('preMarketPrice'))
+  for key, val in (quote or {}).items():
+    info.setdefault(key, val)
+  return info
+
+
+def _CamelToTitle(name: str) -> str:
+  return re.sub('([a-z])([A-Z])', r'\g<1> \g<2>', name).title()
+
+
+def _EpochMillis(date_str: str) -> Optional[int]:
+  if not date_str:
+    return None
+  return calendar.timegm(time.strptime(date_str[:10], '%Y-%m-%d')) * 1000
+
+
+def AnalysisPayload(summary: Dict[str, Any]) -> Optional[Dict[str, Dict[str, Any]]]:
+  """Returns the `ticker.analysis` table of yfinance as {column: {period: value}}, or None.
+
+  Like yfinance, periods are upper cased, column names are title cased, and object values are
+  flattened into one column per key.
+  """
+  trend = (summary.get('earningsTrend') or {}).get('trend')
+  if not trend:
+    return None
+  rows = collections.OrderedDict()
+  object_columns = set()
+  for elem in trend:
+    row = rows.setdefault(str(elem.get('period')).upper(), {})
+    for key, val in elem.items():
+      if key == 'period':
+        continue
+      column = _CamelToTitle(key)
+      if key == 'endDate':
+        val = _EpochMillis(val)
+      if isinstance(val, dict):
+        object_columns.add(column)
+        for sub_key, sub_val in val.items():
+          row['%s %s' % (column, _CamelToTitle(sub_key))] = sub_val
+      else:
+        row[column] = val
+  table = collections.OrderedDict()
+  for row in rows.values():
+    for column in row:
+      if column not in object_columns:
+        table.setdefault(column, collections.OrderedDict())
+  for period, row in rows.items():
+    for column, values in table.items():
+      values[period] = row.get(column)
+  return table
+
+
+class CacheMiss(Exception):
+  pass
+
+
+class CachingFetcher(Fetcher):
+  """Caches the responses of `upstream` on disk, evicting least recently used entries.
+
+  Entries are evicted once the cache exceeds max_bytes. The entry age is its mtime and the last
+  use its atime, which is set explicitly so it works on noatime mounts. Entries evicted while
+  another thread reads them are cache misses.
+  """
+
+  def __init__(
+      self, cache_dir: str, upstream: Fetcher = None, mode: str = MODE_CACHE,
+      ttl_secs: float = _DEFAULT_TTL_SECS, max_bytes: int = _DEFAULT_MAX_BYTES,
+      clock=time.time):
+    if mode not in _MODES:
+      raise ValueError('Unknown fetch cache mode: %s' % mode)
+    self.cache_dir = cache_dir
+    self.upstream = upstream or YFinanceFetcher()
+    self.mode = mode
+    self.ttl_secs = ttl_secs
+    self.max_bytes = max_bytes
+    self._clock = clock
+    self._lock = threading.Lock()
+    self._size = sum(os.path.getsize(path) for path, _, _ in self._ListEntries())
+
+  def _Path(self, date_str: str, endpoint: str, ticker: str) -> str:
+    return os.path.join(self.cache_dir, date_str, endpoint, '%s.json' % ticker)
+
+  def _ListEntries(self) -> List[Tuple[str, float, int]]:
+    """Returns (path, atime, size) of all entries, skipping the files being stored."""
+    entries = []
+    for root, _, files in os.walk(self.cache_dir):
+      for f in files:
+        if _TMP_SUFFIX in f:
+          continue
+        path = os.path.join(root, f)
+        try:
+          st = os.stat(path)
+        except FileNotFoundError:
+          continue
+        entries.append((path, st.st_atime, st.st_size))
+    return entries
+
+  def _Lookup(self, ticker: str) -> Response:
+    """Returns the latest cached response of the ticker, or None."""
+    if not os.path.isdir(self.cache_dir):
+      return None
+    now = self._clock()
+    for date_str in sorted(os.listdir(self.cache_dir), reverse=True):
+      paths = [self._Path(date_str, e, ticker) for e in ENDPOINTS]
+      if not all(os.path.exists(p) for p in paths):
+        continue
+      try:
+        if self.mode == MODE_CACHE and now - os.path.getmtime(paths[0]) > self.ttl_secs:
+          return None
+        payloads = []
+        for path in paths:
+          with open(path, 'rb') as f:
+            payloads.append(f.read())
+          os.utime(path, (now, os.path.getmtime(path)))
+      except FileNotFoundError:
+        return None  # Evicted meanwhile.
+      return Response(ticker, *payloads)
+    return None
+
+  def _Store(self, response: Response):
+    now = self._clock()
+    date_str = datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d')
+    for endpoint in ENDPOINTS:
+      path = self._Path(date_str, endpoint, response.ticker)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      try:
+        old_size = os.path.getsize(path)
+      except FileNotFoundError:
+        old_size = 0
+      data = response.Get(endpoint)
+      tmp_path = '%s%s%d' % (path, _TMP_SUFFIX, threading.get_ident())
+      with open(tmp_path, 'wb') as f:
+        f.write(data)
+      os.utime(tmp_path, (now, now))
+      os.replace(tmp_path, path)
+      with self._lock:
+        self._size += len(data) - old_size
+    if self._size > self.max_bytes:
+      self._Evict()
+
+  def _Evict(self):
+    with self._lock:
+      entries = sorted(self._ListEntries(), key=lambda e: e[1])
+      for path, _, size in entries:
+        if self._size <= self.max_bytes:
+          break
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        self._size -= size
+      logging.info('Fetch cache evicted to %d bytes' % self._size)
+
+  def Fetch(self, ticker: str) -> Response:
+    if self.mode != MODE_RECORD:
+      response = self._Lookup(ticker)
+      if response:
+        return response
+      if self.mode == MODE_REPLAY:
+        raise CacheMiss('No recorded response for %s in %s' % (ticker, self.cache_dir))
+    response = self.upstream.Fetch(ticker)
+    self._Store(response)
+    return response
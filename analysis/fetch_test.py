@@ -0,0 +1,156 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from analysis import fake_api
+from analysis import fetch
+
+
+class FakeFetcher(fetch.Fetcher):
+
+  def __init__(self):
+    self.fetched = []
+
+  def Fetch(self, ticker: str) -> fetch.Response:
+    self.fetched.append(ticker)
+    n = len(self.fetched)
+    return fetch.Response(ticker, b'{"n": %d}' % n, b'{"Growth": {"0Q": %d}}' % n)
+
+
+class TestCachingFetcher(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.upstream = FakeFetcher()
+    self.now = 1650000000.0
+
+  def tearDown(self) -> None:
+    shutil.rmtree(self.tmp_dir)
+
+  def _Fetcher(self, mode=fetch.MODE_CACHE, **kwargs) -> fetch.CachingFetcher:
+    return fetch.CachingFetcher(
+        self.tmp_dir, self.upstream, mode=mode, clock=lambda: self.now, **kwargs)
+
+  def testCache(self):
+    fetcher = self._Fetcher(ttl_secs=100)
+    self.assertEqual(fetcher.Fetch('T').info, b'{"n": 1}')
+    self.assertEqual(fetcher.Fetch('T').info, b'{"n": 1}')
+    self.assertEqual(self.upstream.fetched, ['T'])
+
+    self.now += 101
+    self.assertEqual(fetcher.Fetch('T').info, b'{"n": 2}')
+    self.assertEqual(self.upstream.fetched, ['T', 'T'])
+
+  def testRecord(self):
+    fetcher = self._Fetcher(mode=fetch.MODE_RECORD)
+    fetcher.Fetch('T')
+    fetcher.Fetch('T')
+    self.assertEqual(self.upstream.fetched, ['T', 'T'])
+    date_dirs = os.listdir(self.tmp_dir)
+    self.assertEqual(len(date_dirs), 1)
+    with open(os.path.join(self.tmp_dir, date_dirs[0], 'analysis', 'T.json'), 'rb') as f:
+      self.assertEqual(f.read(), b'{"Growth": {"0Q": 2}}')
+
+  def testReplay(self):
+    self._Fetcher(mode=fetch.MODE_RECORD).Fetch('T')
+    self.now += 365 * 86400
+    fetcher = self._Fetcher(mode=fetch.MODE_REPLAY)
+    self.assertEqual(fetcher.Fetch('T').info, b'{"n": 1}')
+    with self.assertRaises(fetch.CacheMiss):
+      fetcher.Fetch('OTHER')
+    self.assertEqual(self.upstream.fetched, ['T'])
+
+  def testEvictsLeastRecentlyUsed(self):
+    fetcher = self._Fetcher(max_bytes=70)
+    for t in ['A', 'B']:
+      fetcher.Fetch(t)
+      self.now += 1
+    fetcher.Fetch('A')
+    self.now += 1
+    fetcher.Fetch('C')
+    self.assertLessEqual(fetcher._size, 70)
+    self.assertEqual(self.upstream.fetched, ['A', 'B', 'C'])
+    fetcher.Fetch('A')
+    self.assertEqual(self.upstream.fetched, ['A', 'B', 'C'])
+    fetcher.Fetch('B')
+    self.assertEqual(self.upstream.fetched, ['A', 'B', 'C', 'B'])
+
+  def testSkipsFilesBeingStored(self):
+    self._Fetcher().Fetch('A')
+    tmp_path = os.path.join(self.tmp_dir, os.listdir(self.tmp_dir)[0], 'info', 'B.json.tmp-1')
+    with open(tmp_path, 'wb') as f:
+      f.write(b'x' * 100)
+    fetcher = self._Fetcher(max_bytes=50)
+    self.assertLess(fetcher._size, 50)
+    self.now += 1
+    fetcher.Fetch('C')
+    self.assertTrue(os.path.exists(tmp_path))
+
+  def testEvictedDuringLookup(self):
+    fetcher = self._Fetcher()
+    fetcher.Fetch('T')
+    getmtime = os.path.getmtime
+    def GetMtime(path):
+      # Another thread evicts the entry.
+      os.remove(path)
+      return getmtime(path)
+    with mock.patch.object(fetch.os.path, 'getmtime', GetMtime):
+      self.assertEqual(fetcher.Fetch('T').info, b'{"n": 2}')
+    self.assertEqual(self.upstream.fetched, ['T', 'T'])
+
+  def testUnknownMode(self):
+    with self.assertRaises(ValueError):
+      self._Fetcher(mode='offline')
+
+
+class TestApiFetcher(unittest.TestCase):
+
+  def testPayloads(self):
+    summaries = {'AAPL': fake_api.Summary(price=160.0, eps=1.5)}
+    with fake_api.FakeApi(summaries) as api:
+      fetcher = fetch.ApiFetcher(api.url, cookie_url='')
+      response = fetcher.Fetch('AAPL')
+    info = json.loads(response.info)
+    self.assertEqual(info['targetMeanPrice'], 176.0)
+    self.assertEqual(info['totalRevenue'], 3.6e11)
+    self.assertIsNone(info['grossProfits'])
+    self.assertEqual(info['regularMarketPrice'], 160.0)
+
+    analysis = json.loads(response.analysis)
+    self.assertEqual(list(analysis['Growth']), ['0Q', '+1Y', '+5Y'])
+    self.assertEqual(analysis['End Date']['0Q'], 1656547200000)
+    self.assertIsNone(analysis['End Date']['+5Y'])
+    self.assertEqual(analysis['Earnings Estimate Avg']['+1Y'], 1.5)
+    self.assertAlmostEqual(analysis['Earnings Estimate Year Ago Eps']['0Q'], 1.2)
+    self.assertIsNone(analysis['Revenue Estimate Growth']['0Q'])
+    self.assertEqual(analysis['Eps Trend 7Days Ago']['0Q'], 1.5)
+    self.assertEqual(analysis['Eps Revisions Up Last7Days']['0Q'], 2)
+    self.assertNotIn('Earnings Estimate', analysis)
+
+  def testBatchesQuotes(self):
+    tickers = ['T%03d' % i for i in range(120)]
+    with fake_api.FakeApi({t: {} for t in tickers[::2]}) as api:
+      fetcher = fetch.ApiFetcher(api.url, cookie_url='')
+      quotes = fetcher.FetchQuotes(tickers)
+    self.assertEqual(sorted(quotes), tickers[::2])
+    self.assertEqual(api.requests['/v7/finance/quote'], 3)
+    self.assertEqual(api.requests['/v1/test/getcrumb'], 1)
+
+  def testUnknownTicker(self):
+    with fake_api.FakeApi({}) as api:
+      fetcher = fetch.ApiFetcher(api.url, cookie_url='')
+      with self.assertRaises(Exception):
+        fetcher.Fetch('NOPE')
+
+  def testUnwrap(self):
+    self.assertEqual(
+        fetch.Unwrap({'a': {'raw': 1, 'fmt': '1'}, 'b': {}, 'c': [{'raw': 2}], 'd': 'x'}),
+        {'a': 1, 'b': None, 'c': [2], 'd': 'x'})
+    self.assertIsNone(fetch.AnalysisPayload({'earningsTrend': {'trend': []}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
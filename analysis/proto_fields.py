@@ -0,0 +1,153 @@
+"""Field paths into yfinance protos, resolved once from the proto descriptors.
+
+A field path is a dot separated list of field names, e.g. `income.revenue`. A repeated message
+field is indexed by the value of its first field, e.g. `periods[+1Y].eps_estimate.average` selects
+the Period named +1Y and `periods[0Q].eps_estimate_snapshots[30].value` the 30 days snapshot.
+
+Unset values (missing sub-messages, missing repeated elements and proto3 default values) read as
+None, consistent with the client which never writes empty values.
+"""
+import re
+from typing import Any, Callable, Dict, Iterator, Tuple
+
+from google.protobuf import descriptor as descriptor_lib
+from google.protobuf import message
+
+from protos import yfinance_pb2 as yfpb
+
+# Proto message stored in each storage group.
+GROUP_MESSAGES = {
+  'yf.analysis': yfpb.Analysis,
+  'yf.info': yfpb.Info,
+}
+
+_SEGMENT_RE = re.compile(r'^(\w+)(?:\[([^\]]+)\])?$')
+
+_NUMERIC_TYPES = frozenset([
+  descriptor_lib.FieldDescriptor.CPPTYPE_DOUBLE,
+  descriptor_lib.FieldDescriptor.CPPTYPE_FLOAT,
+  descriptor_lib.FieldDescriptor.CPPTYPE_INT32,
+  descriptor_lib.FieldDescriptor.CPPTYPE_INT64,
+  descriptor_lib.FieldDescriptor.CPPTYPE_UINT32,
+  descriptor_lib.FieldDescriptor.CPPTYPE_UINT64,
+])
+
+Getter = Callable[[message.Message], Any]
+
+
+class FieldPath(object):
+  """A compiled field path. Call it with a message to read the value, or None if unset."""
+
+  def __init__(self, message_class, path: str):
+    self.path = path
+    self.field: descriptor_lib.FieldDescriptor = None
+    getter: Getter = lambda msg: msg
+    descriptor = message_class.DESCRIPTOR
+    for segment in path.split('.'):
+      match = _SEGMENT_RE.match(segment)
+      if not match:
+        raise ValueError('Invalid segment "%s" in field path: %s' % (segment, path))
+      name, key = match.groups()
+      if descriptor is None or name not in descriptor.fields_by_name:
+        raise ValueError('Unknown field "%s" in field path: %s' % (name, path))
+      field = descriptor.fields_by_name[name]
+      repeated = IsRepeated(field)
+      if repeated != (key is not None) or (repeated and field.message_type is None):
+        raise ValueError('Field "%s" must %sbe indexed in field path: %s' % (
+            name, '' if repeated else 'not ', path))
+      if key is not None:
+        getter = _SelectGetter(getter, name, field.message_type.fields[0].name, key)
+      elif field.message_type is not None:
+        getter = _MessageGetter(getter, name)
+      else:
+        getter = _ScalarGetter(getter, name, field.default_value)
+      self.field = field
+      descriptor = field.message_type
+    if self.field.message_type is not None:
+      raise ValueError('Field path must end with a scalar field: %s' % path)
+    self._getter = getter
+
+  @property
+  def is_numeric(self) -> bool:
+    return self.field.cpp_type in _NUMERIC_TYPES
+
+  def __call__(self, msg: message.Message) -> Any:
+    return self._getter(msg)
+
+  def __repr__(self):
+    return 'FieldPath(%s)' % self.path
+
+
+def IsRepeated(field: descriptor_lib.FieldDescriptor) -> bool:
+  # Newer protobuf releases replace `label` by `is_repeated`.
+  if hasattr(field, 'is_repeated'):
+    return field.is_repeated
+  return field.label == descriptor_lib.FieldDescriptor.LABEL_REPEATED
+
+
+def _MessageGetter(parent: Getter, name: str) -> Getter:
+  def Get(msg):
+    msg = parent(msg)
+    if msg is None or not msg.HasField(name):
+      return None
+    return getattr(msg, name)
+  return Get
+
+
+def _ScalarGetter(parent: Getter, name: str, default: Any) -> Getter:
+  def Get(msg):
+    msg = parent(msg)
+    if msg is None:
+      return None
+    val = getattr(msg, name)
+    return None if val == default else val
+  return Get
+
+
+def _SelectGetter(parent: Getter, name: str, key_field: str, key: str) -> Getter:
+  def Get(msg):
+    msg = parent(msg)
+    if msg is None:
+      return None
+    for elem in getattr(msg, name):
+      if str(getattr(elem, key_field)) == key:
+        return elem
+    return None
+  return Get
+
+
+def Flatten(msg: message.Message, prefix: str = '') -> Iterator[Tuple[str, float]]:
+  """Yields the (field path, value) of each set numeric field of msg, in field number order.
+
+  The key field of repeated message elements is part of their path, not a value.
+  """
+  for field, val in msg.ListFields():
+    path = prefix + field.name
+    if IsRepeated(field):
+      if field.message_type is None:
+        continue
+      key_field = field.message_type.fields[0].name
+      for elem in val:
+        yield from _FlattenElement(elem, '%s[%s].' % (path, getattr(elem, key_field)), key_field)
+    elif field.message_type is not None:
+      yield from Flatten(val, path + '.')
+    elif field.cpp_type in _NUMERIC_TYPES:
+      yield path, float(val)
+
+
+def _FlattenElement(
+    msg: message.Message, prefix: str, key_field: str) -> Iterator[Tuple[str, float]]:
+  for path, val in Flatten(msg, prefix):
+    if path != prefix + key_field:
+      yield path, val
+
+
+_COMPILED: Dict[Any, FieldPath] = {}
+
+
+def Compile(message_class, path: str) -> FieldPath:
+  """Returns the compiled field path, cached per message class and path."""
+  key = (message_class, path)
+  if key not in _COMPILED:
+    _COMPILED[key] = FieldPath(message_class, path)
+  return _COMPILED[key]
@@ -0,0 +1,63 @@
+import unittest
+
+from analysis import proto_fields
+from protos import yfinance_pb2 as yfpb
+
+
+class TestFieldPath(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.info = yfpb.Info()
+    self.info.income.revenue = 100.0
+    self.info.price_target.num_analysts = 3
+
+    self.analysis = yfpb.Analysis()
+    p = self.analysis.periods.add()
+    p.name = '+1Y'
+    p.eps_estimate.average = 1.5
+    s = p.eps_estimate_snapshots.add()
+    s.days_ago = 30
+    s.value = 1.2
+
+  def testScalar(self):
+    self.assertEqual(proto_fields.Compile(yfpb.Info, 'income.revenue')(self.info), 100.0)
+    self.assertEqual(proto_fields.Compile(yfpb.Info, 'price_target.num_analysts')(self.info), 3)
+
+  def testUnsetIsNone(self):
+    self.assertIsNone(proto_fields.Compile(yfpb.Info, 'income.ebitda')(self.info))
+    self.assertIsNone(proto_fields.Compile(yfpb.Info, 'dividend.forward')(self.info))
+
+  def testRepeated(self):
+    path = proto_fields.Compile(yfpb.Analysis, 'periods[+1Y].eps_estimate.average')
+    self.assertEqual(path(self.analysis), 1.5)
+    path = proto_fields.Compile(yfpb.Analysis, 'periods[+1Y].eps_estimate_snapshots[30].value')
+    self.assertEqual(path(self.analysis), 1.2)
+    path = proto_fields.Compile(yfpb.Analysis, 'periods[0Q].eps_estimate.average')
+    self.assertIsNone(path(self.analysis))
+
+  def testIsNumeric(self):
+    self.assertTrue(proto_fields.Compile(yfpb.Info, 'income.revenue').is_numeric)
+    self.assertFalse(proto_fields.Compile(yfpb.Info, 'dividend.ex_date').is_numeric)
+
+  def testInvalidPaths(self):
+    for path in ['income', 'income.nonexist', 'periods.name', 'income[1].revenue', 'a..b']:
+      with self.assertRaises(ValueError, msg=path):
+        proto_fields.Compile(yfpb.Analysis if path.startswith('periods') else yfpb.Info, path)
+
+  def testFlatten(self):
+    self.info.dividend.ex_date = '2022-02-04'
+    self.assertEqual(list(proto_fields.Flatten(self.info)), [
+      ('price_target.num_analysts', 3.0),
+      ('income.revenue', 100.0),
+    ])
+    flat = list(proto_fields.Flatten(self.analysis))
+    self.assertEqual(flat, [
+      ('periods[+1Y].eps_estimate.average', 1.5),
+      ('periods[+1Y].eps_estimate_snapshots[30].value', 1.2),
+    ])
+    for path, val in flat:
+      self.assertEqual(proto_fields.Compile(yfpb.Analysis, path)(self.analysis), val)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+"""Regenerates the proto DB from the raw DB with the current conversion.
+
+Each quarter shard of the raw DB is streamed in (group, ticker, date) order by a worker process,
+converted with InfoFromRawJson / AnalysisFromRawJson of yfinance_client, and written to the same
+quarter of the target storage with one transaction per batch. Workers only share the system DB
+of the target, so all cores are busy as long as there are as many quarters left as cores.
+
+After each batch, the position of the worker in its quarter is saved in the target system DB (see
+checkpoint.ShardProgress): an interrupted run resumes where it stopped, and finished quarters are
+skipped unless --restart. With --dry_run nothing is written: converted rows are compared to the
+target, and the changed rows are counted by group and numeric field path.
+
+Usage:
+  bazel run analysis:reprocess -- $YF_SNAPSHOT_DB_RAW_PATH $YF_SNAPSHOT_DB_PATH --dry_run
+  bazel run analysis:reprocess -- $YF_SNAPSHOT_DB_RAW_PATH $YF_SNAPSHOT_DB_PATH --quarters=2022q1
+
+The features of the target are not updated: run `storage:admin -- backfill_features` afterwards.
+"""
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List
+
+from analysis import proto_fields
+from analysis import yfinance_client
+from storage import checkpoint
+from storage import codec
+from storage import sqlite
+
+# Name of the job in the progress table of the target.
+JOB = 'reprocess'
+
+# Converters of the raw values of each group.
+CONVERTERS = {
+  'yf.analysis': yfinance_client.AnalysisFromRawJson,
+  'yf.info': yfinance_client.InfoFromRawJson,
+}
+
+_DEFAULT_BATCH_SIZE = 500
+
+# Outcomes of a raw row, counted by group.
+CONVERTED = 'converted'
+FAILED = 'failed'
+EMPTY = 'empty'
+NEW = 'new'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+Result = Dict[str, Any]
+
+
+def _Diff(old: bytes, new, group: str, fields: collections.Counter) -> str:
+  """Returns the outcome of replacing old by the new message, counting changed fields."""
+  if old is None:
+    return NEW
+  old = type(new).FromString(old)
+  if old == new:
+    return UNCHANGED
+  old_values = dict(proto_fields.Flatten(old))
+  new_values = dict(proto_fields.Flatten(new))
+  for path in set(old_values) | set(new_values):
+    if old_values.get(path) != new_values.get(path):
+      fields['%s:%s' % (group, path)] += 1
+  return CHANGED
+
+
+def ReprocessQuarter(
+    raw_dir: str, db_dir: str, q: str, groups: Iterable[str], dry_run: bool = False,
+    batch_size: int = _DEFAULT_BATCH_SIZE, compression: Dict[str, str] = None) -> Result:
+  """Converts the raw rows of a quarter, in the calling process. See the module doc."""
+  groups = set(groups)
+  counts = collections.defaultdict(collections.Counter)
+  fields = collections.Counter()
+  with sqlite.ShardedSqliteStorage(raw_dir, read_only=True) as raw, \
+      sqlite.ShardedSqliteStorage(db_dir, compression=compression, read_only=dry_run) as db:
+    progress = None if dry_run else checkpoint.ShardProgress(db, JOB)
+    position = progress.Position(q) if progress else None
+    batch = []
+    for ticker, date_str, data, group in raw.Rows([q], position):
+      position = (group, ticker, date_str)
+      if group not in groups:
+        continue
+      try:
+        message = CONVERTERS[group](data)
+      except Exception as e:
+        logging.warning('Failed to convert %s %s of %s: %s' % (group, date_str, ticker, e))
+        counts[group][FAILED] += 1
+        continue
+      if message is None:
+        counts[group][EMPTY] += 1
+        continue
+      if dry_run:
+        counts[group][_Diff(db.Read(ticker, date_str, group), message, group, fields)] += 1
+        continue
+      counts[group][CONVERTED] += 1
+      batch.append((ticker, date_str, message.SerializeToString(), group))
+      if len(batch) >= batch_size:
+        db.WriteMany(batch)
+        progress.Save(q, position)
+        batch = []
+    if progress:
+      db.WriteMany(batch)
+      progress.Save(q, position, done=True)
+  logging.info('Reprocessed %s: %s' % (q, dict(counts)))
+  return {'quarters': [q], 'counts': counts, 'fields': fields}
+
+
+def _Merge(results: List[Result]) -> Result:
+  counts = collections.defaultdict(collections.Counter)
+  fields = collections.Counter()
+  quarters = []
+  for result in results:
+    quarters += result['quarters']
+    for group, group_counts in result['counts'].items():
+      counts[group].update(group_counts)
+    fields.update(result['fields'])
+  return {
+    'quarters': sorted(quarters),
+    'counts': {group: dict(group_counts) for group, group_counts in sorted(counts.items())},
+    'fields': dict(fields),
+  }
+
+
+def Reprocess(
+    raw_dir: str, db_dir: str, quarters: Iterable[str] = None, groups: Iterable[str] = None,
+    dry_run: bool = False, restart: bool = False, max_workers: int = None,
+    batch_size: int = _DEFAULT_BATCH_SIZE, compression: Dict[str, str] = None) -> Result:
+  """Reprocesses the quarters (all by default) of the raw DB into the storage at db_dir.
+
+  Each quarter is converted in its own worker process, at most max_workers (the number of CPUs
+  by default) at a time. Sealed quarters of the target are skipped. Returns the quarters
+  processed, the counts of outcomes by group, and with dry_run the counts of changed fields.
+  """
+  groups = sorted(groups or CONVERTERS)
+  with sqlite.ShardedSqliteStorage(raw_dir, read_only=True) as raw:
+    quarters = [q for q in raw.ListQuarters() if quarters is None or q in quarters]
+  if dry_run:
+    if not os.path.exists(os.path.join(db_dir, 'system.sqlite')):
+      raise ValueError('No DB to compare to in %s' % db_dir)
+  else:
+    # Creates the tables of the target before the workers open it.
+    with sqlite.ShardedSqliteStorage(db_dir, compression=compression) as db:
+      progress = checkpoint.ShardProgress(db, JOB)
+      if restart:
+        progress.Reset(quarters)
+      done = set(progress.Done())
+      sealed = set(db.ListQuarters(sealed=True))
+    for q in quarters:
+      if q in sealed:
+        logging.warning('Skipping sealed quarter %s' % q)
+      elif q in done:
+        logging.info('Skipping quarter %s, already reprocessed' % q)
+    quarters = [q for q in quarters if q not in sealed and q not in done]
+
+  args = [(raw_dir, db_dir, q, groups, dry_run, batch_size, compression) for q in quarters]
+  max_workers = min(len(quarters), max_workers or os.cpu_count() or 1)
+  if max_workers > 1:
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+      results = list(executor.map(ReprocessQuarter, *zip(*args)))
+  else:
+    results = [ReprocessQuarter(*a) for a in args]
+  return _Merge(results)
+
+
+def ParseArgs(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('raw_db_path', help='Raw DB to read (YF_SNAPSHOT_DB_RAW_PATH).')
+  parser.add_argument('db_path', help='Storage to write (YF_SNAPSHOT_DB_PATH).')
+  parser.add_argument(
+      '--quarters', default='', help='Comma separated quarters, e.g. 2022q1. Defaults to all.')
+  parser.add_argument(
+      '--groups', default=','.join(sorted(CONVERTERS)), help='Comma separated groups.')
+  parser.add_argument(
+      '--dry_run', action='store_true', help='Compare to the storage instead of writing.')
+  parser.add_argument(
+      '--restart', action='store_true', help='Reprocess quarters already reprocessed.')
+  parser.add_argument(
+      '--max_workers', type=int, default=0, help='Worker processes. Defaults to the CPU count.')
+  parser.add_argument(
+      '--batch_size', type=int, default=_DEFAULT_BATCH_SIZE, help='Rows per transaction.')
+  parser.add_argument(
+      '--compression', default='', help='Codec specs of the storage, e.g. "zstd".')
+  return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(
+      format='%(asctime)s %(levelname)-8s %(message)s',
+      level=logging.INFO,
+      datefmt='%Y-%m-%d %H:%M:%S')
+  args = ParseArgs()
+  result = Reprocess(
+      args.raw_db_path, args.db_path,
+      quarters=list(filter(None, args.quarters.split(','))) or None,
+      groups=list(filter(None, args.groups.split(','))),
+      dry_run=args.dry_run, restart=args.restart, max_workers=args.max_workers or None,
+      batch_size=args.batch_size,
+      compression=codec.ParseCompression(args.compression) if args.compression else None)
+  print(json.dumps(result, indent=2, sort_keys=True))
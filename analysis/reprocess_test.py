@@ -0,0 +1,106 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from analysis import reprocess
+from analysis import yfinance_client
+from protos import yfinance_pb2 as yfpb
+from storage import checkpoint
+from storage import sqlite
+
+_FETCH_CACHE_DIR = os.path.join(
+    os.path.dirname(__file__), 'testdata', 'fetch_cache', '2022-04-01')
+
+
+def Fixture(endpoint: str) -> bytes:
+  with open(os.path.join(_FETCH_CACHE_DIR, endpoint, 'AAPL.json'), 'rb') as f:
+    return f.read()
+
+
+class TestReprocess(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.raw_dir = os.path.join(self.tmp_dir, 'raw')
+    self.db_dir = os.path.join(self.tmp_dir, 'db')
+    os.makedirs(self.raw_dir)
+    os.makedirs(self.db_dir)
+    self.info = Fixture('info')
+    self.analysis = Fixture('analysis')
+    with sqlite.ShardedSqliteStorage(self.raw_dir) as raw:
+      raw.WriteMany([
+        (ticker, date_str, data, group)
+        for ticker in ['A', 'B']
+        for date_str in ['2022-03-31', '2022-04-01']
+        for data, group in [(self.info, 'yf.info'), (self.analysis, 'yf.analysis')]
+      ] + [('C', '2022-04-01', b'not json', 'yf.info')])
+
+  def tearDown(self) -> None:
+    shutil.rmtree(self.tmp_dir)
+
+  def _Read(self, ticker: str, date_str: str, group: str) -> bytes:
+    with sqlite.ShardedSqliteStorage(self.db_dir, read_only=True) as db:
+      return db.Read(ticker, date_str, group)
+
+  def testReprocess(self):
+    result = reprocess.Reprocess(self.raw_dir, self.db_dir, max_workers=2, batch_size=3)
+    self.assertEqual(result['quarters'], ['2022q1', '2022q2'])
+    self.assertEqual(result['counts'], {
+      'yf.analysis': {reprocess.CONVERTED: 4},
+      'yf.info': {reprocess.CONVERTED: 4, reprocess.FAILED: 1},
+    })
+    self.assertEqual(
+        yfpb.Info.FromString(self._Read('B', '2022-04-01', 'yf.info')),
+        yfinance_client.InfoFromRawJson(self.info))
+    self.assertEqual(
+        yfpb.Analysis.FromString(self._Read('A', '2022-03-31', 'yf.analysis')),
+        yfinance_client.AnalysisFromRawJson(self.analysis))
+    with sqlite.ShardedSqliteStorage(self.db_dir) as db:
+      self.assertEqual(db.ReadLatestDate('A', 'yf.info'), '2022-04-01')
+
+    # Finished quarters are skipped, unless restarted.
+    self.assertEqual(reprocess.Reprocess(self.raw_dir, self.db_dir)['quarters'], [])
+    self.assertEqual(
+        reprocess.Reprocess(self.raw_dir, self.db_dir, ['2022q2'], restart=True)['quarters'],
+        ['2022q2'])
+
+  def testResume(self):
+    with sqlite.ShardedSqliteStorage(self.db_dir) as db:
+      checkpoint.ShardProgress(db, reprocess.JOB).Save('2022q2', ('yf.info', 'A', '2022-04-01'))
+    result = reprocess.Reprocess(self.raw_dir, self.db_dir, ['2022q2'])
+    self.assertEqual(result['counts'], {
+      'yf.info': {reprocess.CONVERTED: 1, reprocess.FAILED: 1},
+    })
+    self.assertIsNone(self._Read('A', '2022-04-01', 'yf.info'))
+    self.assertIsNotNone(self._Read('B', '2022-04-01', 'yf.info'))
+
+  def testDryRun(self):
+    info = yfinance_client.InfoFromRawJson(self.info)
+    info.price_target.average += 1
+    with sqlite.ShardedSqliteStorage(self.db_dir) as db:
+      db.WriteMany([
+        ('A', '2022-03-31', info.SerializeToString(), 'yf.info'),
+        ('B', '2022-03-31', yfinance_client.InfoFromRawJson(self.info).SerializeToString(),
+         'yf.info'),
+      ])
+    result = reprocess.Reprocess(
+        self.raw_dir, self.db_dir, ['2022q1'], groups=['yf.info'], dry_run=True)
+    self.assertEqual(
+        result['counts'], {'yf.info': {reprocess.CHANGED: 1, reprocess.UNCHANGED: 1}})
+    self.assertEqual(result['fields'], {'yf.info:price_target.average': 1})
+    json.dumps(result)
+    # Nothing was written.
+    self.assertEqual(
+        yfpb.Info.FromString(self._Read('A', '2022-03-31', 'yf.info')), info)
+    with sqlite.ShardedSqliteStorage(self.db_dir) as db:
+      self.assertEqual(checkpoint.ShardProgress(db, reprocess.JOB).Done(), [])
+
+  def testDryRunWithoutDb(self):
+    with self.assertRaises(ValueError):
+      reprocess.Reprocess(self.raw_dir, os.path.join(self.tmp_dir, 'missing'), dry_run=True)
+
+
+if __name__ == '__main__':
+  unittest.main()
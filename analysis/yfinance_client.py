@@ -1,10 +1,12 @@
+import concurrent.futures
 import datetime
+import json
+import logging
 import math
-from typing import Any, Dict, Iterable
-
-import pandas as pd
-import yfinance as yf
+import operator
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
 
+from analysis import fetch
 from protos import yfinance_pb2 as yfpb
 
 _REQUIRED_ANALYSIS = [
@@ -15,255 +17,295 @@ _REQUIRED_ANALYSIS = [
   'Earnings Estimate Growth',
 ]
 
-def GetFloat(d: Dict[str, Any], key: str):
-  if key in d:
-    val = d[key]
-  else:
-    return None
+def ToFloat(val: Any) -> Optional[float]:
   return float(val) if isinstance(val, int) or isinstance(val, float) else None
 
-def GetInt(d: Dict[str, Any], key: str):
-  if key in d:
-    val = d[key]
-  else:
-    return None
+def ToInt(val: Any) -> Optional[int]:
   if isinstance(val, int) or isinstance(val, float):
     return int(val) if not math.isnan(val) else None
+  return None
 
-class YFinanceClient(object):
-
-  def __init__(self, ticker: str):
-    self.ticker = yf.Ticker(ticker)
-
-  def GetAnalysis(self) -> yfpb.Analysis:
-    data: pd.DataFrame = self.ticker.analysis
-    result = yfpb.Analysis()
-
-    if not self._CheckColumns(_REQUIRED_ANALYSIS, data.columns):
-      return None
+def ToTimestampDate(val: Any) -> Optional[str]:
+  """Converts a unix timestamp in seconds to a YYYY-MM-DD date."""
+  val = ToFloat(val)
+  return datetime.datetime.fromtimestamp(val).strftime('%Y-%m-%d') if val else None
 
-    for k, v in data.iterrows():
-      p = yfpb.Period()
-      p.name = k
-      val = v['End Date']
-      val = val.to_pydatetime() if val and val != pd.NaT else None
-      val = val.strftime('%Y-%m-%d') if not pd.isnull(val) else None
-      if val: p.end_date = val
-
-      # EPS estimate
-      val = GetFloat(v, 'Earnings Estimate Low')
-      if val: p.eps_estimate.low = val
-
-      val = GetFloat(v, 'Earnings Estimate High')
-      if val: p.eps_estimate.high = val
-
-      val = GetFloat(v, 'Earnings Estimate Avg')
-      if val: p.eps_estimate.average = val
-
-      val = GetFloat(v, 'Growth')  if k == '+5y' else GetFloat(v, 'Earnings Estimate Growth')
-      if val: p.eps_estimate.growth = val
-
-      val = GetInt(v, 'Earnings Estimate Number Of Analysts')
-      if val: p.eps_estimate.num_analysts = val
-
-      val = GetFloat(v, 'Earnings Estimate Year Ago Eps')
-      if val: p.eps_estimate.year_ago = val
-
-      # Revenue estimate
-      val = GetFloat(v, 'Revenue Estimate Low')
-      if val: p.revenue_estimate.low = val
+def ToDate(val: Any) -> Optional[str]:
+  """Converts a pandas/python datetime, epoch milliseconds (from to_json) or date string."""
+  if val is None or val != val:  # None, NaN or NaT
+    return None
+  if isinstance(val, str):
+    return val[:10] or None
+  if isinstance(val, int) or isinstance(val, float):
+    return datetime.datetime.utcfromtimestamp(val / 1000).strftime('%Y-%m-%d')
+  return val.strftime('%Y-%m-%d')
 
-      val = GetFloat(v, 'Revenue Estimate High')
-      if val: p.revenue_estimate.high = val
+def GetFloat(d: Dict[str, Any], key: str):
+  return ToFloat(d[key]) if key in d else None
 
-      val = GetFloat(v, 'Revenue Estimate Avg')
-      if val: p.revenue_estimate.average = val
+def GetInt(d: Dict[str, Any], key: str):
+  return ToInt(d[key]) if key in d else None
+
+# ----------------------------- Mapping tables ---------------------------------
+
+# (source key, proto field path, converter). Falsy converted values are not written.
+_INFO_FIELDS = [
+  # Price target
+  ('targetLowPrice', 'price_target.low', ToFloat),
+  ('targetHighPrice', 'price_target.high', ToFloat),
+  ('targetMeanPrice', 'price_target.average', ToFloat),
+  ('numberOfAnalystOpinions', 'price_target.num_analysts', ToInt),
+
+  # Profitability
+  ('profitMargins', 'profitability.profit_margin', ToFloat),
+  ('operatingMargins', 'profitability.operating_margin', ToFloat),
+  ('grossMargins', 'profitability.gross_margin', ToFloat),
+  ('ebitdaMargins', 'profitability.ebitda_margin', ToFloat),
+
+  # Income statement
+  ('totalRevenue', 'income.revenue', ToFloat),
+  ('revenuePerShare', 'income.revenue_per_share', ToFloat),
+  ('revenueGrowth', 'income.revenue_growth', ToFloat),
+  ('revenueQuarterlyGrowth', 'income.revenue_quarterly_growth', ToFloat),
+  ('grossProfits', 'income.gross_profit', ToFloat),
+  ('ebitda', 'income.ebitda', ToFloat),
+  ('netIncomeToCommon', 'income.earnings', ToFloat),
+  ('trailingEps', 'income.earnings_per_share', ToFloat),
+  ('earningsGrowth', 'income.earnings_growth', ToFloat),
+  ('earningsQuarterlyGrowth', 'income.earnings_quarterly_growth', ToFloat),
+
+  # Balance sheet
+  ('totalCash', 'balance_sheet.total_cash', ToFloat),
+  ('totalCashPerShare', 'balance_sheet.total_cash_per_share', ToFloat),
+  ('totalDebt', 'balance_sheet.total_debt', ToFloat),
+  ('debtToEquity', 'balance_sheet.total_debt_to_equity', ToFloat),
+  ('currentRatio', 'balance_sheet.current_ratio', ToFloat),
+  ('bookValue', 'balance_sheet.book_value', ToFloat),
+
+  # Price history
+  ('beta', 'price_history.beta', ToFloat),
+  ('fiftyTwoWeekHigh', 'price_history.high_52w', ToFloat),
+  ('fiftyTwoWeekLow', 'price_history.low_52w', ToFloat),
+  ('fiftyDayAverage', 'price_history.ma_50d', ToFloat),
+  ('twoHundredDayAverage', 'price_history.ma_200d', ToFloat),
+
+  # Share stats
+  ('averageVolume', 'shares_stats.average_volume_3m', ToFloat),
+  ('averageDailyVolume10Day', 'shares_stats.average_volume_10d', ToFloat),
+  ('sharesOutstanding', 'shares_stats.outstanding', ToFloat),
+  ('impliedSharesOutstanding', 'shares_stats.implied_outstanding', ToFloat),
+  ('floatShares', 'shares_stats.float', ToFloat),
+  ('heldPercentInsiders', 'shares_stats.insider_precent', ToFloat),
+  ('heldPercentInstitutions', 'shares_stats.institutions_percent', ToFloat),
+  ('sharesShort', 'shares_stats.short', ToFloat),
+  ('sharesShortPriorMonth', 'shares_stats.short_prev_month', ToFloat),
+  ('shortRatio', 'shares_stats.short_ratio', ToFloat),
+
+  # Dividend
+  ('dividendRate', 'dividend.forward', ToFloat),
+  ('dividendYield', 'dividend.forward_yield', ToFloat),
+  ('exDividendDate', 'dividend.ex_date', ToTimestampDate),
+  ('payoutRatio', 'dividend.payout_ratio', ToFloat),
+  ('trailingAnnualDividendRate', 'dividend.trailing', ToFloat),
+  ('trailingAnnualDividendYield', 'dividend.trailing_yield', ToFloat),
+  ('fiveYearAvgDividendYield', 'dividend.trailing_yield_5y', ToFloat),
+]
 
-      val = GetFloat(v, 'Growth') if k == '+5y' else GetFloat(v, 'Revenue Estimate Growth')
-      if val: p.revenue_estimate.growth = val
+# (analysis column, yfpb.Period field path, converter), applied to each period (row).
+_PERIOD_FIELDS = [
+  ('End Date', 'end_date', ToDate),
+
+  # EPS estimate
+  ('Earnings Estimate Low', 'eps_estimate.low', ToFloat),
+  ('Earnings Estimate High', 'eps_estimate.high', ToFloat),
+  ('Earnings Estimate Avg', 'eps_estimate.average', ToFloat),
+  ('Earnings Estimate Growth', 'eps_estimate.growth', ToFloat),
+  ('Earnings Estimate Number Of Analysts', 'eps_estimate.num_analysts', ToInt),
+  ('Earnings Estimate Year Ago Eps', 'eps_estimate.year_ago', ToFloat),
+
+  # Revenue estimate
+  ('Revenue Estimate Low', 'revenue_estimate.low', ToFloat),
+  ('Revenue Estimate High', 'revenue_estimate.high', ToFloat),
+  ('Revenue Estimate Avg', 'revenue_estimate.average', ToFloat),
+  ('Revenue Estimate Growth', 'revenue_estimate.growth', ToFloat),
+  ('Revenue Estimate Number Of Analysts', 'revenue_estimate.num_analysts', ToInt),
+  ('Revenue Estimate Year Ago Revenue', 'revenue_estimate.year_ago', ToFloat),
+]
 
-      val = GetInt(v, 'Revenue Estimate Number Of Analysts')
-      if val: p.revenue_estimate.num_analysts = val
+# Columns replacing the ones of _PERIOD_FIELDS for the given period name.
+_PERIOD_COLUMN_OVERRIDES = {
+  '+5y': {
+    'Earnings Estimate Growth': 'Growth',
+    'Revenue Estimate Growth': 'Growth',
+  },
+}
+
+# Days ago of the EPS estimate snapshots, and their (column format, yfpb.Snapshot field, converter).
+_SNAPSHOT_DAYS = [7, 30, 60, 90]
+_SNAPSHOT_FIELDS = [
+  ('Eps Trend %dDays Ago', 'value', ToFloat),
+  ('Eps Revisions Up Last%dDays', 'num_ups', ToInt),
+  ('Eps Revisions Down Last%dDays', 'num_downs', ToInt),
+]
 
-      val = GetFloat(v, 'Revenue Estimate Year Ago Revenue')
-      if val: p.revenue_estimate.year_ago = val
+# ----------------------------- Compiled tables ---------------------------------
+
+# (source key, parent message getter, field name, converter)
+_Setter = Tuple[str, Callable[[Any], Any], str, Callable[[Any], Any]]
+
+def _CompileFields(fields: Iterable[Tuple[str, str, Callable[[Any], Any]]]) -> List[_Setter]:
+  compiled = []
+  for key, path, converter in fields:
+    parent, _, name = path.rpartition('.')
+    getter = operator.attrgetter(parent) if parent else (lambda msg: msg)
+    compiled.append((key, getter, name, converter))
+  return compiled
+
+def _ApplyFields(compiled: List[_Setter], data: Mapping[str, Any], msg):
+  for key, getter, name, converter in compiled:
+    val = data.get(key)
+    if val is None:
+      continue
+    val = converter(val)
+    if val:
+      setattr(getter(msg), name, val)
+
+_INFO_SETTERS = _CompileFields(_INFO_FIELDS)
+_PERIOD_SETTERS = _CompileFields(_PERIOD_FIELDS)
+_SNAPSHOT_SETTERS = [
+    (d, _CompileFields([(column % d, name, conv) for column, name, conv in _SNAPSHOT_FIELDS]))
+    for d in _SNAPSHOT_DAYS]
+
+# ----------------------------- Conversion ---------------------------------
+
+def ConvertInfo(data: Mapping[str, Any]) -> yfpb.Info:
+  """Converts a yfinance `ticker.info` dict."""
+  result = yfpb.Info()
+  _ApplyFields(_INFO_SETTERS, data, result)
+  return result
+
+def ConvertAnalysis(
+    index: Sequence[str], columns: Mapping[str, Sequence[Any]]) -> Optional[yfpb.Analysis]:
+  """Converts the yfinance `ticker.analysis` table given as its index and column arrays.
+
+  Returns None if a required column is missing.
+  """
+  if not _CheckColumns(_REQUIRED_ANALYSIS, columns):
+    return None
 
-      # EPS snapshot
-      for d in [7, 30, 60, 90]:
-        s = yfpb.Snapshot()
-        s.days_ago = d
+  result = yfpb.Analysis()
+  for i, k in enumerate(index):
+    overrides = _PERIOD_COLUMN_OVERRIDES.get(k, {})
+    row = _ColumnsRow(columns, i, overrides)
+    p = result.periods.add()
+    p.name = k
+    _ApplyFields(_PERIOD_SETTERS, row, p)
+    for d, setters in _SNAPSHOT_SETTERS:
+      s = p.eps_estimate_snapshots.add()
+      s.days_ago = d
+      _ApplyFields(setters, row, s)
+  return result
+
+def InfoFromRawJson(raw: bytes) -> yfpb.Info:
+  """Converts a `ticker.info` dict stored as JSON in the raw DB."""
+  return ConvertInfo(json.loads(raw))
+
+def AnalysisFromRawJson(raw: bytes) -> Optional[yfpb.Analysis]:
+  """Converts a `ticker.analysis` table stored with DataFrame.to_json() in the raw DB."""
+  data: Dict[str, Dict[str, Any]] = json.loads(raw) or {}
+  index = list(next(iter(data.values()), {}).keys())
+  columns = {c: [values.get(k) for k in index] for c, values in data.items()}
+  return ConvertAnalysis(index, columns)
+
+class _ColumnsRow(object):
+  """Row i of column arrays, read through get() with renamed columns."""
+
+  def __init__(self, columns: Mapping[str, Sequence[Any]], i: int, overrides: Dict[str, str]):
+    self.columns = columns
+    self.i = i
+    self.overrides = overrides
+
+  def get(self, key: str, default: Any = None) -> Any:
+    column = self.columns.get(self.overrides.get(key, key))
+    return column[self.i] if column is not None else default
+
+def _CheckColumns(required: Iterable[str], columns: Iterable[str]):
+  missing = []
+  for k in required:
+    if k not in columns:
+      missing.append(k)
+  if missing:
+    print('Missing required keys: %s' % missing)
+    return False
+  return True
 
-        val = GetFloat(v, 'Eps Trend %dDays Ago' % d)
-        if val: s.value = val
+class YFinanceClient(object):
+  """Converts the yfinance data of a ticker, fetched once through `fetcher`.
 
-        val = GetInt(v, 'Eps Revisions Up Last%dDays' % d)
-        if val: s.num_ups = val
+  The conversion parses the raw payloads of the response, so it matches what is stored in the raw
+  DB and can be reproduced from it.
+  """
 
-        val = GetInt(v, 'Eps Revisions Down Last%dDays' % d)
-        if val: s.num_downs = val
+  def __init__(self, ticker: str, fetcher: fetch.Fetcher = None):
+    self.symbol = ticker
+    self.fetcher = fetcher or fetch.YFinanceFetcher()
+    self._response: fetch.Response = None
 
-        p.eps_estimate_snapshots.append(s)
+  @property
+  def response(self) -> fetch.Response:
+    if self._response is None:
+      self._response = self.fetcher.Fetch(self.symbol)
+    return self._response
 
-      result.periods.append(p)
-    return result
+  def GetAnalysis(self) -> yfpb.Analysis:
+    return AnalysisFromRawJson(self.response.analysis)
 
   def GetInfo(self) -> yfpb.Info:
-    data = self.ticker.info
-    result = yfpb.Info()
-
-    # Price target
-    val  = GetFloat(data, 'targetLowPrice')
-    if val: result.price_target.low = val
-
-    val  = GetFloat(data, 'targetHighPrice')
-    if val: result.price_target.high = val
-
-    val  = GetFloat(data, 'targetMeanPrice')
-    if val: result.price_target.average = val
-
-    val  = GetInt(data, 'numberOfAnalystOpinions')
-    if val: result.price_target.num_analysts = val
-
-    # Profitability
-    val  = GetFloat(data, 'profitMargins')
-    if val: result.profitability.profit_margin = val
-
-    val  = GetFloat(data, 'operatingMargins')
-    if val: result.profitability.operating_margin = val
-
-    val  = GetFloat(data, 'grossMargins')
-    if val: result.profitability.gross_margin = val
-
-    val  = GetFloat(data, 'ebitdaMargins')
-    if val: result.profitability.ebitda_margin = val
-
-    # Income statement
-    val  = GetFloat(data, 'totalRevenue')
-    if val: result.income.revenue = val
-
-    val  = GetFloat(data, 'revenuePerShare')
-    if val: result.income.revenue_per_share = val
-
-    val  = GetFloat(data, 'revenueGrowth')
-    if val: result.income.revenue_growth = val
-
-    val  = GetFloat(data, 'revenueQuarterlyGrowth')
-    if val: result.income.revenue_quarterly_growth = val
-
-    val  = GetFloat(data, 'grossProfits')
-    if val: result.income.gross_profit = val
-
-    val  = GetFloat(data, 'ebitda')
-    if val: result.income.ebitda = val
-
-    val  = GetFloat(data, 'netIncomeToCommon')
-    if val: result.income.earnings = val
-
-    val  = GetFloat(data, 'trailingEps')
-    if val: result.income.earnings_per_share = val
-
-    val  = GetFloat(data, 'earningsGrowth')
-    if val: result.income.earnings_growth = val
-
-    val  = GetFloat(data, 'earningsQuarterlyGrowth')
-    if val: result.income.earnings_quarterly_growth = val
-
-    # Balance sheet
-    val  = GetFloat(data, 'totalCash')
-    if val: result.balance_sheet.total_cash = val
-
-    val  = GetFloat(data, 'totalCashPerShare')
-    if val: result.balance_sheet.total_cash_per_share = val
-
-    val  = GetFloat(data, 'totalDebt')
-    if val: result.balance_sheet.total_debt = val
-
-    val  = GetFloat(data, 'debtToEquity')
-    if val: result.balance_sheet.total_debt_to_equity = val
-
-    val  = GetFloat(data, 'currentRatio')
-    if val: result.balance_sheet.current_ratio = val
-
-    val  = GetFloat(data, 'bookValue')
-    if val: result.balance_sheet.book_value = val
-
-    # Price history
-    val  = GetFloat(data, 'beta')
-    if val: result.price_history.beta = val
-
-    val  = GetFloat(data, 'fiftyTwoWeekHigh')
-    if val: result.price_history.high_52w = val
-
-    val  = GetFloat(data, 'fiftyTwoWeekLow')
-    if val: result.price_history.low_52w = val
-
-    val  = GetFloat(data, 'fiftyDayAverage')
-    if val: result.price_history.ma_50d = val
-
-    val  = GetFloat(data, 'twoHundredDayAverage')
-    if val: result.price_history.ma_200d = val
-
-    # Share stats
-    val  = GetFloat(data, 'averageVolume')
-    if val: result.shares_stats.average_volume_3m = val
-
-    val  = GetFloat(data, 'averageDailyVolume10Day')
-    if val: result.shares_stats.average_volume_10d = val
-
-    val  = GetFloat(data, 'sharesOutstanding')
-    if val: result.shares_stats.outstanding = val
-
-    val  = GetFloat(data, 'impliedSharesOutstanding')
-    if val: result.shares_stats.implied_outstanding = val
-
-    val  = GetFloat(data, 'floatShares')
-    if val: result.shares_stats.float = val
-
-    val  = GetFloat(data, 'heldPercentInsiders')
-    if val: result.shares_stats.insider_precent = val
-
-    val  = GetFloat(data, 'heldPercentInstitutions')
-    if val: result.shares_stats.institutions_percent = val
-
-    val  = GetFloat(data, 'sharesShort')
-    if val: result.shares_stats.short = val
-
-    val  = GetFloat(data, 'sharesShortPriorMonth')
-    if val: result.shares_stats.short_prev_month = val
-
-    val  = GetFloat(data, 'shortRatio')
-    if val: result.shares_stats.short_ratio = val
-
-    # Dividend
-    val  = GetFloat(data, 'dividendRate')
-    if val: result.dividend.forward = val
-
-    val  = GetFloat(data, 'dividendYield')
-    if val: result.dividend.forward_yield = val
-
-    val  = GetFloat(data, 'exDividendDate')
-    if val: result.dividend.ex_date = datetime.datetime.fromtimestamp(val).strftime('%Y-%m-%d')
-
-    val  = GetFloat(data, 'payoutRatio')
-    if val: result.dividend.payout_ratio = val
-
-    val  = GetFloat(data, 'trailingAnnualDividendRate')
-    if val: result.dividend.trailing = val
-
-    val  = GetFloat(data, 'trailingAnnualDividendYield')
-    if val: result.dividend.trailing_yield = val
-
-    val  = GetFloat(data, 'fiveYearAvgDividendYield')
-    if val: result.dividend.trailing_yield_5y = val
-
-    return result
-
-  def _CheckColumns(self, required: Iterable[str], columns: Iterable[str]):
-    missing = []
-    for k in required:
-      if k not in columns:
-        missing.append(k)
-    if missing:
-      print('Missing required keys: %s' % missing)
-      return False
-    return True
+    return InfoFromRawJson(self.response.info)
+
+class YFinanceBatchClient(object):
+  """Fetches and converts many tickers at once over the shared session of an ApiFetcher.
+
+  The quotes of all tickers are fetched in batches to skip unknown tickers, then the quote summary
+  of each one on `concurrency` threads. A failing ticker does not affect the others: it is left out
+  of the result of Fetch() and its error is kept in `errors`.
+  """
+
+  def __init__(self, fetcher: fetch.ApiFetcher = None, concurrency: int = 8):
+    self.fetcher = fetcher or fetch.ApiFetcher(pool_size=concurrency)
+    self.concurrency = concurrency
+    self.errors: Dict[str, Exception] = {}
+
+  def _Fetch(
+      self, ticker: str, quote: Dict[str, Any]) -> Tuple[yfpb.Analysis, yfpb.Info, fetch.Response]:
+    response = self.fetcher.FetchResponse(ticker, quote)
+    return (
+        AnalysisFromRawJson(response.analysis), InfoFromRawJson(response.info), response)
+
+  def Fetch(
+      self, tickers: Sequence[str]) -> Dict[str, Tuple[yfpb.Analysis, yfpb.Info, fetch.Response]]:
+    """Returns {ticker: (analysis, info, response)} of the tickers fetched successfully."""
+    self.errors = {}
+    try:
+      quotes = self.fetcher.FetchQuotes(tickers)
+    except Exception as e:
+      logging.warning('Failed to fetch quotes, fetching all tickers: %s' % e)
+      quotes = None
+    found = []
+    for t in tickers:
+      if quotes is None or t in quotes:
+        found.append(t)
+      else:
+        self.errors[t] = LookupError('Unknown ticker: %s' % t)
+
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+      futures = [
+          (t, executor.submit(self._Fetch, t, quotes.get(t) if quotes else None)) for t in found]
+      for t, future in futures:
+        try:
+          results[t] = future.result()
+        except Exception as e:
+          logging.error('Failed to fetch %s: %s' % (t, e))
+          self.errors[t] = e
+    return results
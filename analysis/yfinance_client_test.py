@@ -1,10 +1,18 @@
+import json
+import os
 from typing import Iterable
 import unittest
+from unittest import mock
 
 from google.protobuf import message
+import requests
 
+from analysis import fake_api
+from analysis import fetch
 from analysis import yfinance_client
 
+_FETCH_CACHE_DIR = os.path.join(os.path.dirname(__file__), 'testdata', 'fetch_cache')
+
 def Trim(arr):
   return [x for x in arr if x]
 
@@ -15,8 +23,11 @@ class TestSqliteStorage(unittest.TestCase):
     self.assertFalse(Trim([0.0]))
     self.assertFalse(Trim([0]))
 
+  def _Client(self) -> yfinance_client.YFinanceClient:
+    return yfinance_client.YFinanceClient('AAPL')
+
   def testGetAnalysis(self):
-    client = yfinance_client.YFinanceClient('AAPL')
+    client = self._Client()
     res = client.GetAnalysis()
 
     # Period names
@@ -50,7 +61,7 @@ class TestSqliteStorage(unittest.TestCase):
         set([7, 30, 60, 90]))
 
   def testGetInfo(self):
-    client = yfinance_client.YFinanceClient('AAPL')
+    client = self._Client()
     res = client.GetInfo()
     self._AssertHasAllFields(res.price_target, ['growth', 'year_ago'])
     self._AssertHasAllFields(res.profitability)
@@ -69,5 +80,130 @@ class TestSqliteStorage(unittest.TestCase):
     if missing:
       raise AssertionError('Field is not set: %s' % missing)
 
+class TestReplay(TestSqliteStorage):
+  """Runs the same tests offline, on a recorded AAPL response."""
+
+  def _Client(self) -> yfinance_client.YFinanceClient:
+    return yfinance_client.YFinanceClient(
+        'AAPL', fetch.CachingFetcher(_FETCH_CACHE_DIR, mode=fetch.MODE_REPLAY))
+
+  def testRawPayloadIsParsed(self):
+    client = self._Client()
+    self.assertEqual(
+      client.GetInfo().income.revenue, json.loads(client.response.info)['totalRevenue'])
+
+
+class TestConversion(unittest.TestCase):
+
+  def testConvertInfo(self):
+    res = yfinance_client.ConvertInfo({
+      'targetMeanPrice': 12,
+      'numberOfAnalystOpinions': 30.0,
+      'totalRevenue': 0,
+      'beta': None,
+      'shortRatio': 'n/a',
+      'exDividendDate': 1650000000,
+    })
+    self.assertEqual(res.price_target.average, 12.0)
+    self.assertEqual(res.price_target.num_analysts, 30)
+    self.assertFalse(res.HasField('income'))
+    self.assertFalse(res.HasField('price_history'))
+    self.assertEqual(res.shares_stats.short_ratio, 0.0)
+    self.assertTrue(res.dividend.ex_date.startswith('2022-04-1'))
+
+  def testConvertAnalysis(self):
+    res = yfinance_client.ConvertAnalysis(['0Q', '+5y'], {
+      'Growth': [0.1, 0.2],
+      'End Date': ['2022-03-31', None],
+      'Earnings Estimate Avg': [1.5, 2.5],
+      'Revenue Estimate Avg': [100.0, None],
+      'Earnings Estimate Growth': [0.3, None],
+      'Earnings Estimate Number Of Analysts': [10.0, float('nan')],
+      'Eps Trend 30Days Ago': [1.4, None],
+      'Eps Revisions Up Last30Days': [2, None],
+    })
+    self.assertEqual([p.name for p in res.periods], ['0Q', '+5y'])
+    p0, p5 = res.periods
+    self.assertEqual(p0.end_date, '2022-03-31')
+    self.assertEqual(p0.eps_estimate.average, 1.5)
+    self.assertEqual(p0.eps_estimate.growth, 0.3)
+    self.assertEqual(p0.eps_estimate.num_analysts, 10)
+    self.assertEqual([s.days_ago for s in p0.eps_estimate_snapshots], [7, 30, 60, 90])
+    self.assertEqual(p0.eps_estimate_snapshots[1].value, 1.4)
+    self.assertEqual(p0.eps_estimate_snapshots[1].num_ups, 2)
+    self.assertEqual(p5.end_date, '')
+    self.assertEqual(p5.eps_estimate.growth, 0.2)
+    self.assertEqual(p5.eps_estimate.num_analysts, 0)
+
+  def testConvertAnalysisMissingColumns(self):
+    self.assertIsNone(yfinance_client.ConvertAnalysis(['0Q'], {'Growth': [0.1]}))
+
+  def testAnalysisFromRawJson(self):
+    raw = json.dumps({
+      'Growth': {'0Q': 0.1, '+1Y': 0.2},
+      'End Date': {'0Q': 1648684800000, '+1Y': None},
+      'Earnings Estimate Avg': {'0Q': 1.5, '+1Y': 6.0},
+      'Revenue Estimate Avg': {'0Q': 100.0, '+1Y': 400.0},
+      'Earnings Estimate Growth': {'0Q': 0.3, '+1Y': 0.4},
+    }).encode('utf-8')
+    res = yfinance_client.AnalysisFromRawJson(raw)
+    self.assertEqual([p.name for p in res.periods], ['0Q', '+1Y'])
+    self.assertEqual(res.periods[0].end_date, '2022-03-31')
+    self.assertEqual(res.periods[1].eps_estimate.average, 6.0)
+
+  def testInfoFromRawJson(self):
+    res = yfinance_client.InfoFromRawJson(b'{"totalRevenue": 1000}')
+    self.assertEqual(res.income.revenue, 1000.0)
+
+
+class TestYFinanceBatchClient(unittest.TestCase):
+
+  def testFetch(self):
+    tickers = ['T%02d' % i for i in range(20)]
+    summaries = {t: fake_api.Summary(price=100.0 + i, eps=1.0 + i) for i, t in enumerate(tickers)}
+    with fake_api.FakeApi(summaries, failing=['T03']) as api:
+      fetcher = fetch.ApiFetcher(api.url, cookie_url='', pool_size=4)
+      client = yfinance_client.YFinanceBatchClient(fetcher, concurrency=4)
+      results = client.Fetch(tickers + ['NOPE'])
+
+    self.assertEqual(sorted(results), sorted(set(tickers) - {'T03'}))
+    self.assertEqual(sorted(client.errors), ['NOPE', 'T03'])
+    self.assertEqual(api.requests['/v7/finance/quote'], 1)
+    self.assertEqual(api.requests['/v1/test/getcrumb'], 1)
+    self.assertNotIn('/v10/finance/quoteSummary/NOPE', api.requests)
+    # Connections are kept alive and reused across tickers.
+    self.assertLessEqual(api.connections, 4)
+
+    analysis, info, response = results['T02']
+    self.assertEqual(info.price_target.num_analysts, 30)
+    self.assertEqual(info.income.revenue, 3.6e11)
+    self.assertEqual(info.shares_stats.average_volume_10d, 1e6)
+    self.assertEqual(info, yfinance_client.InfoFromRawJson(response.info))
+    self.assertEqual([p.name for p in analysis.periods], ['0Q', '+1Y', '+5Y'])
+    p0 = analysis.periods[0]
+    self.assertEqual(p0.end_date, '2022-06-30')
+    self.assertEqual(p0.eps_estimate.average, 3.0)
+    self.assertEqual(p0.eps_estimate.num_analysts, 20)
+    self.assertEqual(p0.revenue_estimate.num_analysts, 18)
+    self.assertEqual(p0.eps_estimate_snapshots[0].value, 3.0)
+    self.assertEqual(p0.eps_estimate_snapshots[0].num_ups, 2)
+    self.assertEqual(p0.eps_estimate_snapshots[1].num_downs, 1)
+
+  def testQuotesFailure(self):
+    # The summaries are still fetched when the batched quotes are unreachable.
+    with fake_api.FakeApi({'AAPL': fake_api.Summary(price=160.0, eps=1.5)}) as api:
+      fetcher = fetch.ApiFetcher(api.url, cookie_url='')
+      client = yfinance_client.YFinanceBatchClient(fetcher)
+      with mock.patch.object(
+          fetcher, 'FetchQuotes', side_effect=requests.ConnectionError()) as fetch_quotes:
+        results = client.Fetch(['AAPL'])
+      fetch_quotes.assert_called_once_with(['AAPL'])
+    self.assertEqual(list(results), ['AAPL'])
+    self.assertEqual(client.errors, {})
+    analysis, info, _ = results['AAPL']
+    self.assertAlmostEqual(info.price_target.average, 176.0)
+    self.assertEqual(analysis.periods[0].eps_estimate.average, 1.5)
+
+
 if __name__ == '__main__':
     unittest.main()
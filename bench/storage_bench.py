@@ -0,0 +1,288 @@
+"""Benchmarks of ShardedSqliteStorage and of the yfinance conversion.
+
+Fills a storage with synthetic snapshots, times the storage operations and the conversion of the
+recorded fixtures, and writes the results as JSON. With --baseline, results are compared to a
+previous run and the command fails if any benchmark regressed.
+
+Usage:
+  bazel run bench:storage_bench -- --tickers=5000 --days=750 --output=/tmp/baseline.json
+  bazel run bench:storage_bench -- --output=/tmp/new.json --baseline=/tmp/baseline.json
+
+An existing --db_dir is reused as is, skipping the (slow) generation and the write benchmark.
+
+`cli_cold_start` times `yfsnap latest` in a new interpreter, from start to exit. The command fails
+if its median exceeds --cold_start_budget_ms.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, Iterable, List
+
+from analysis import fetch
+from analysis import yfinance_client
+from bench import synthetic
+from storage import cache
+from storage import codec
+from storage import sqlite
+
+_FIXTURE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'analysis', 'testdata', 'fetch_cache')
+_FIXTURE_TICKER = 'AAPL'
+
+_GROUPS = ['yf.info', 'yf.analysis']
+_RANGE_DAYS = 90
+
+Result = Dict[str, Any]
+
+
+def PeakRssKb() -> int:
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def Percentile(values: List[float], p: float) -> float:
+  """Returns the p-th percentile (0-100) of values, by nearest rank."""
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def Measure(name: str, fn: Callable[[Any], int], args: Iterable[Any]) -> Result:
+  """Calls fn(arg) for each arg and returns its timings.
+
+  fn returns the number of items (e.g. rows) it processed, from which the throughput is computed.
+  Latencies are per call.
+  """
+  latencies = []
+  items = 0
+  start = time.perf_counter()
+  for arg in args:
+    t = time.perf_counter()
+    items += fn(arg)
+    latencies.append(time.perf_counter() - t)
+  elapsed = time.perf_counter() - start
+  result = {
+    'calls': len(latencies),
+    'items': items,
+    'seconds': elapsed,
+    'items_per_sec': items / elapsed if elapsed else 0.0,
+    'p50_ms': Percentile(latencies, 50) * 1000,
+    'p99_ms': Percentile(latencies, 99) * 1000,
+    'peak_rss_kb': PeakRssKb(),
+  }
+  logging.info('%-16s %8d items %10.1f items/s  p50 %8.3f ms  p99 %8.3f ms' % (
+      name, items, result['items_per_sec'], result['p50_ms'], result['p99_ms']))
+  return result
+
+
+def _Batches(rows: Iterable[sqlite.Row], batch_size: int) -> Iterable[List[sqlite.Row]]:
+  batch = []
+  for row in rows:
+    batch.append(row)
+    if len(batch) >= batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+def BenchStorage(db: sqlite.ShardedSqliteStorage, args, write: bool) -> Dict[str, Result]:
+  results = {}
+  tickers = synthetic.Tickers(args.tickers)
+  dates = synthetic.Dates(args.days)
+  if write:
+    def WriteBatch(batch):
+      db.WriteMany(batch)
+      return len(batch)
+    results['write'] = Measure(
+        'write', WriteBatch, _Batches(synthetic.Rows(tickers, dates), args.batch_size))
+
+  rng = random.Random(args.seed)
+  samples = [(rng.choice(tickers), rng.choice(dates), rng.choice(_GROUPS))
+             for _ in range(args.samples)]
+
+  def Read(sample):
+    return 1 if db.Read(*sample) else 0
+  results['read'] = Measure('read', Read, samples)
+
+  def ReadLatest(sample):
+    return 1 if db.ReadLatest(sample[0], sample[2]) else 0
+  results['read_latest'] = Measure('read_latest', ReadLatest, samples)
+
+  # Repeated reads of the sampled keys, served from a warm cache.
+  cached = cache.CachedStorage(db)
+  for sample in samples:
+    cached.Read(*sample)
+  def CachedRead(sample):
+    return 1 if cached.Read(*sample) else 0
+  results['cached_read'] = Measure('cached_read', CachedRead, samples)
+
+  def ReadRange(sample):
+    ticker, date_str, group = sample
+    date_from = sqlite.GetDate(date_str) - datetime.timedelta(days=_RANGE_DAYS)
+    date_from = date_from.strftime('%Y-%m-%d')
+    return sum(1 for _ in db.ReadRange(ticker, date_from, date_str, group))
+  results['read_range'] = Measure('read_range', ReadRange, samples[:args.scan_samples])
+
+  def Scan(sample):
+    _, date_str, group = sample
+    return sum(1 for _ in db.Scan(group, date_str, date_str))
+  results['scan'] = Measure('scan', Scan, samples[:args.scan_samples])
+
+  def CrossSection(sample):
+    _, date_str, group = sample
+    return sum(1 for _ in db.ReadCrossSection(date_str, group, max_staleness_days=7))
+  results['cross_section'] = Measure(
+      'cross_section', CrossSection, samples[:args.scan_samples])
+
+  def List(group):
+    return sum(len(d) for d in db.List(group, dates[0]).values())
+  results['list'] = Measure('list', List, _GROUPS * args.list_samples)
+  return results
+
+
+def BenchColdStart(db_dir: str, args) -> Dict[str, Result]:
+  tickers = synthetic.Tickers(args.tickers)
+  rng = random.Random(args.seed)
+  # The new interpreters import the modules from the same paths as this one.
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+
+  def ColdStart(ticker):
+    subprocess.run(
+        [sys.executable, '-m', 'storage.yfsnap', 'latest', db_dir, ticker],
+        env=env, check=True, stdout=subprocess.DEVNULL)
+    return 1
+  return {
+    'cli_cold_start': Measure(
+        'cli_cold_start', ColdStart,
+        [rng.choice(tickers) for _ in range(args.cold_start_samples)]),
+  }
+
+
+def ColdStartOverBudget(results: Dict[str, Any], budget_ms: float) -> List[str]:
+  """Returns a description of the cold start if its median latency exceeds the budget."""
+  cold_start = results['benchmarks'].get('cli_cold_start')
+  if cold_start and cold_start['p50_ms'] > budget_ms:
+    return ['cli_cold_start: p50 %.1f ms > budget %.1f ms' % (cold_start['p50_ms'], budget_ms)]
+  return []
+
+
+def BenchConversion(args) -> Dict[str, Result]:
+  fetcher = fetch.CachingFetcher(args.fixture_dir, mode=fetch.MODE_REPLAY)
+  client = yfinance_client.YFinanceClient(_FIXTURE_TICKER, fetcher)
+  client.response  # Read the fixture once, outside of the timings.
+
+  def Convert(method):
+    return 1 if method() is not None else 0
+  return {
+    'convert_info': Measure('convert_info', Convert, [client.GetInfo] * args.samples),
+    'convert_analysis': Measure(
+        'convert_analysis', Convert, [client.GetAnalysis] * args.samples),
+  }
+
+
+def Run(args) -> Dict[str, Any]:
+  db_dir = args.db_dir or tempfile.mkdtemp(prefix='storage_bench_')
+  os.makedirs(db_dir, exist_ok=True)
+  write = not os.listdir(db_dir)
+  compression = codec.ParseCompression(args.compression) if args.compression else None
+  pragmas = sqlite.ParsePragmas(args.pragmas)
+  try:
+    with sqlite.ShardedSqliteStorage(db_dir, compression=compression, pragmas=pragmas) as db:
+      results = BenchStorage(db, args, write)
+    results.update(BenchColdStart(db_dir, args))
+    results.update(BenchConversion(args))
+  finally:
+    if not args.db_dir:
+      shutil.rmtree(db_dir)
+  return {
+    'config': {
+      'tickers': args.tickers,
+      'days': args.days,
+      'samples': args.samples,
+      'compression': args.compression,
+      'pragmas': args.pragmas,
+    },
+    'peak_rss_kb': PeakRssKb(),
+    'benchmarks': results,
+  }
+
+
+def Compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+  """Returns a description of each benchmark slower than the baseline by more than threshold.
+
+  A benchmark regresses if its throughput dropped, or its p99 latency grew, by more than the
+  threshold fraction. Benchmarks missing from either run are ignored.
+  """
+  regressions = []
+  for name, new in sorted(results['benchmarks'].items()):
+    old = baseline['benchmarks'].get(name)
+    if not old:
+      continue
+    if new['items_per_sec'] < old['items_per_sec'] * (1 - threshold):
+      regressions.append('%s: throughput %.1f -> %.1f items/s' % (
+          name, old['items_per_sec'], new['items_per_sec']))
+    if new['p99_ms'] > old['p99_ms'] * (1 + threshold):
+      regressions.append('%s: p99 %.3f -> %.3f ms' % (name, old['p99_ms'], new['p99_ms']))
+  return regressions
+
+
+def ParseArgs(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--tickers', type=int, default=200, help='Number of synthetic tickers.')
+  parser.add_argument('--days', type=int, default=130, help='Number of weekdays per ticker.')
+  parser.add_argument('--batch_size', type=int, default=1000, help='Rows per WriteMany call.')
+  parser.add_argument('--samples', type=int, default=2000, help='Calls of point benchmarks.')
+  parser.add_argument(
+      '--scan_samples', type=int, default=50, help='Calls of range and scan benchmarks.')
+  parser.add_argument('--list_samples', type=int, default=3, help='List calls per group.')
+  parser.add_argument(
+      '--cold_start_samples', type=int, default=10, help='Runs of the read CLI.')
+  parser.add_argument(
+      '--cold_start_budget_ms', type=float, default=250.0,
+      help='Max median start-to-exit latency of the read CLI.')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument(
+      '--compression', default='', help='Codec specs, e.g. "zstd". Defaults to zlib.')
+  parser.add_argument('--pragmas', default='', help='SQLite PRAGMA profile, e.g. "wal".')
+  parser.add_argument(
+      '--db_dir', default='', help='Storage directory, reused if not empty. Defaults to a '
+      'temporary directory deleted after the run.')
+  parser.add_argument('--fixture_dir', default=_FIXTURE_DIR, help='Recorded fetch cache.')
+  parser.add_argument('--output', default='', help='Path of the JSON results.')
+  parser.add_argument('--baseline', default='', help='JSON results to compare against.')
+  parser.add_argument(
+      '--threshold', type=float, default=0.1, help='Tolerated slowdown, as a fraction.')
+  return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(
+      format='%(asctime)s %(levelname)-8s %(message)s',
+      level=logging.INFO,
+      datefmt='%Y-%m-%d %H:%M:%S')
+  args = ParseArgs()
+  results = Run(args)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  regressions = ColdStartOverBudget(results, args.cold_start_budget_ms)
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions += Compare(results, json.load(f), args.threshold)
+  for regression in regressions:
+    logging.error('Regression: %s' % regression)
+  if regressions:
+    sys.exit(1)
@@ -0,0 +1,74 @@
+import tempfile
+import unittest
+
+from bench import storage_bench
+from bench import synthetic
+from protos import yfinance_pb2 as yfpb
+
+
+def _Results(items_per_sec, p99_ms):
+  return {'benchmarks': {'read': {'items_per_sec': items_per_sec, 'p99_ms': p99_ms}}}
+
+
+class TestSynthetic(unittest.TestCase):
+
+  def testRows(self):
+    rows = list(synthetic.Rows(synthetic.Tickers(3), synthetic.Dates(4)))
+    self.assertEqual(len(rows), 3 * 4 * 2)
+    self.assertEqual(rows, list(synthetic.Rows(synthetic.Tickers(3), synthetic.Dates(4))))
+    ticker, date_str, data, group = rows[1]
+    self.assertEqual((ticker, date_str, group), ('T0000', '2022-03-28', 'yf.analysis'))
+    self.assertEqual(len(yfpb.Analysis.FromString(data).periods), 6)
+
+  def testDates(self):
+    # 2022-03-26 and 2022-03-27 are a weekend.
+    self.assertEqual(
+        synthetic.Dates(3, '2022-03-28'), ['2022-03-24', '2022-03-25', '2022-03-28'])
+
+
+class TestStorageBench(unittest.TestCase):
+
+  def testRun(self):
+    with tempfile.TemporaryDirectory() as db_dir:
+      args = storage_bench.ParseArgs([
+          '--tickers=5', '--days=10', '--samples=20', '--scan_samples=5', '--list_samples=1',
+          '--cold_start_samples=2', '--db_dir=%s' % db_dir])
+      results = storage_bench.Run(args)
+      self.assertEqual(results['benchmarks']['write']['items'], 5 * 10 * 2)
+      self.assertEqual(results['benchmarks']['read']['items'], 20)
+      self.assertEqual(results['benchmarks']['list']['items'], 5 * 10 * 2)
+      self.assertEqual(results['benchmarks']['convert_info']['items'], 20)
+      self.assertEqual(results['benchmarks']['cli_cold_start']['items'], 2)
+      self.assertGreater(results['peak_rss_kb'], 0)
+
+      # The existing storage is reused without writing.
+      results = storage_bench.Run(args)
+      self.assertNotIn('write', results['benchmarks'])
+      self.assertEqual(results['benchmarks']['read']['items'], 20)
+
+  def testPercentile(self):
+    values = list(range(100, 0, -1))
+    self.assertEqual(storage_bench.Percentile(values, 50), 51)
+    self.assertEqual(storage_bench.Percentile(values, 99), 100)
+    self.assertEqual(storage_bench.Percentile([], 99), 0.0)
+
+  def testCompare(self):
+    baseline = _Results(1000, 2.0)
+    self.assertEqual(storage_bench.Compare(_Results(950, 2.1), baseline, 0.1), [])
+    self.assertEqual(storage_bench.Compare(_Results(2000, 1.0), baseline, 0.1), [])
+    self.assertEqual(
+        storage_bench.Compare(_Results(800, 3.0), baseline, 0.1),
+        ['read: throughput 1000.0 -> 800.0 items/s', 'read: p99 2.000 -> 3.000 ms'])
+    self.assertEqual(storage_bench.Compare(_Results(1, 1), {'benchmarks': {}}, 0.1), [])
+
+  def testColdStartOverBudget(self):
+    results = {'benchmarks': {'cli_cold_start': {'p50_ms': 120.0}}}
+    self.assertEqual(storage_bench.ColdStartOverBudget(results, 250), [])
+    self.assertEqual(
+        storage_bench.ColdStartOverBudget(results, 100),
+        ['cli_cold_start: p50 120.0 ms > budget 100.0 ms'])
+    self.assertEqual(storage_bench.ColdStartOverBudget({'benchmarks': {}}, 100), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,123 @@
+"""Generates realistic synthetic yfinance snapshots for benchmarks.
+
+Each ticker gets a random walk: price-like fields move every day while fundamentals and analyst
+estimates change every few weeks, like the real data.
+"""
+import datetime
+import random
+from typing import Iterator, List
+
+from protos import yfinance_pb2 as yfpb
+from storage import sqlite
+
+_PERIODS = ['0Q', '+1Q', '0Y', '+1Y', '+5Y', '-5Y']
+
+# Probability that a slowly changing field changes on a given day.
+_SLOW_CHANGE_PROB = 0.05
+
+
+def Tickers(num_tickers: int) -> List[str]:
+  return ['T%04d' % i for i in range(num_tickers)]
+
+
+def Dates(num_days: int, end_date: str = '2022-03-31') -> List[str]:
+  """Returns the last num_days weekdays up to end_date, in ascending order."""
+  dates = []
+  d = sqlite.GetDate(end_date)
+  while len(dates) < num_days:
+    if d.weekday() < 5:
+      dates.append(d.strftime('%Y-%m-%d'))
+    d -= datetime.timedelta(days=1)
+  return dates[::-1]
+
+
+class TickerModel(object):
+  """Random walk of the snapshots of a single ticker."""
+
+  def __init__(self, ticker: str, seed: int = 0):
+    self.rng = random.Random('%s-%d' % (ticker, seed))
+    self.price = self.rng.uniform(5, 500)
+    self.revenue = self.rng.uniform(1e8, 4e11)
+    self.eps = self.rng.uniform(-2, 10)
+    self.num_analysts = self.rng.randint(1, 45)
+
+  def _Slow(self, val: float, scale: float = 0.02) -> float:
+    if self.rng.random() < _SLOW_CHANGE_PROB:
+      return val * (1 + self.rng.gauss(0, scale))
+    return val
+
+  def Step(self):
+    self.price *= 1 + self.rng.gauss(0, 0.02)
+    self.revenue = self._Slow(self.revenue)
+    self.eps = self._Slow(self.eps, 0.05)
+
+  def Info(self) -> yfpb.Info:
+    info = yfpb.Info()
+    info.price_target.low = round(self.price * 0.8, 2)
+    info.price_target.high = round(self.price * 1.3, 2)
+    info.price_target.average = round(self.price * 1.1, 2)
+    info.price_target.num_analysts = self.num_analysts
+    info.profitability.profit_margin = 0.2
+    info.profitability.operating_margin = 0.25
+    info.profitability.gross_margin = 0.4
+    info.profitability.ebitda_margin = 0.3
+    info.income.revenue = round(self.revenue)
+    info.income.revenue_per_share = round(self.revenue / 1e9, 3)
+    info.income.revenue_growth = 0.1
+    info.income.gross_profit = round(self.revenue * 0.4)
+    info.income.ebitda = round(self.revenue * 0.3)
+    info.income.earnings = round(self.revenue * 0.2)
+    info.income.earnings_per_share = round(self.eps, 3)
+    info.income.earnings_growth = 0.15
+    info.balance_sheet.total_cash = round(self.revenue * 0.15)
+    info.balance_sheet.total_debt = round(self.revenue * 0.3)
+    info.balance_sheet.current_ratio = 1.04
+    info.balance_sheet.book_value = 4.4
+    info.price_history.beta = 1.18
+    info.price_history.high_52w = round(self.price * 1.2, 2)
+    info.price_history.low_52w = round(self.price * 0.7, 2)
+    info.price_history.ma_50d = round(self.price * 0.98, 4)
+    info.price_history.ma_200d = round(self.price * 0.95, 4)
+    info.shares_stats.average_volume_3m = round(self.rng.uniform(1e6, 1e8))
+    info.shares_stats.average_volume_10d = round(self.rng.uniform(1e6, 1e8))
+    info.shares_stats.outstanding = 1.6e10
+    info.shares_stats.float = 1.6e10
+    info.shares_stats.short = 1.1e8
+    info.shares_stats.short_ratio = 1.21
+    info.dividend.forward = 0.88
+    info.dividend.forward_yield = 0.005
+    info.dividend.ex_date = '2022-02-04'
+    return info
+
+  def Analysis(self) -> yfpb.Analysis:
+    analysis = yfpb.Analysis()
+    for i, name in enumerate(_PERIODS):
+      p = analysis.periods.add()
+      p.name = name
+      if name in ('+5Y', '-5Y'):
+        p.eps_estimate.growth = 0.15
+      else:
+        p.end_date = '2022-%02d-30' % (3 * i + 3)
+        for est, base in [(p.eps_estimate, self.eps), (p.revenue_estimate, self.revenue)]:
+          est.average = round(base * (1 + 0.05 * i), 3)
+          est.low = round(est.average * 0.9, 3)
+          est.high = round(est.average * 1.1, 3)
+          est.num_analysts = self.num_analysts
+          est.growth = 0.05
+          est.year_ago = round(base * 0.95, 3)
+      for d in [7, 30, 60, 90]:
+        s = p.eps_estimate_snapshots.add()
+        s.days_ago = d
+        s.value = round(self.eps * (1 - d / 1000), 3)
+        s.num_ups = self.rng.randint(0, 3)
+    return analysis
+
+
+def Rows(tickers: List[str], dates: List[str], seed: int = 0) -> Iterator[sqlite.Row]:
+  """Yields the yf.info and yf.analysis rows of all tickers, date by date."""
+  models = [TickerModel(t, seed) for t in tickers]
+  for date_str in dates:
+    for t, model in zip(tickers, models):
+      model.Step()
+      yield (t, date_str, model.Info().SerializeToString(), 'yf.info')
+      yield (t, date_str, model.Analysis().SerializeToString(), 'yf.analysis')
@@ -0,0 +1,307 @@
+"""In-process metrics, exported as a Prometheus textfile or JSON.
+
+Metrics are declared at module level and record nothing until the registry is enabled, so
+instrumented code costs a single attribute check when metrics are off:
+
+  WRITE_SECONDS = metrics.Histogram('yf_storage_write_seconds', 'Write latency.')
+  ...
+  with WRITE_SECONDS.Time(group='yf.info'):
+    ...
+
+Profile() optionally wraps a run with cProfile (all threads) or tracemalloc.
+"""
+import collections
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+# Upper bounds in seconds of the default latency histogram buckets.
+DEFAULT_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PROFILE_CPROFILE = 'cprofile'
+PROFILE_TRACEMALLOC = 'tracemalloc'
+
+# Number of allocation sites written by the tracemalloc profile.
+_TRACEMALLOC_TOP = 50
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Registry(object):
+  """Holds the declared metrics. Nothing is recorded while disabled."""
+
+  def __init__(self):
+    self.enabled = False
+    self.metrics: Dict[str, '_Metric'] = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def Register(self, metric: '_Metric'):
+    with self._lock:
+      if metric.name in self.metrics:
+        raise ValueError('Metric already registered: %s' % metric.name)
+      self.metrics[metric.name] = metric
+
+  def Reset(self):
+    for metric in self.metrics.values():
+      metric.Reset()
+
+  def ToPrometheus(self) -> str:
+    """Returns all recorded metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in self.metrics.values():
+      samples = metric.Samples()
+      if not samples:
+        continue
+      lines.append('# HELP %s %s' % (metric.name, metric.help))
+      lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+      for name, labels, value in samples:
+        lines.append('%s%s %s' % (name, _FormatLabels(labels), _FormatValue(value)))
+    return '\n'.join(lines) + '\n' if lines else ''
+
+  def ToJson(self) -> Dict[str, Any]:
+    """Returns all recorded metrics as {name: {type, help, values: [{labels, value}]}}."""
+    result = collections.OrderedDict()
+    for metric in self.metrics.values():
+      values = metric.Values()
+      if values:
+        result[metric.name] = {'type': metric.kind, 'help': metric.help, 'values': values}
+    return result
+
+  def Export(self, path: str):
+    """Atomically writes the metrics to path, as JSON if it ends with .json."""
+    if path.endswith('.json'):
+      content = json.dumps(self.ToJson(), indent=2)
+    else:
+      content = self.ToPrometheus()
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+      f.write(content)
+    os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+
+
+def Enable(enabled: bool = True):
+  REGISTRY.enabled = enabled
+
+
+def _FormatLabels(labels: Labels) -> str:
+  if not labels:
+    return ''
+  return '{%s}' % ','.join(
+      '%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+      for k, v in labels)
+
+
+def _FormatValue(value: float) -> str:
+  if math.isinf(value):
+    return '+Inf' if value > 0 else '-Inf'
+  return repr(float(value))
+
+
+def _Key(labels: Dict[str, Any]) -> Labels:
+  return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class _Metric(object):
+  kind = ''
+
+  def __init__(self, name: str, help: str, registry: Registry = None):
+    self.name = name
+    self.help = help
+    self.registry = registry or REGISTRY
+    self._values: Dict[Labels, Any] = {}
+    self._lock = threading.Lock()
+    self.registry.Register(self)
+
+  def Reset(self):
+    with self._lock:
+      self._values.clear()
+
+  def Samples(self) -> List[Tuple[str, Labels, float]]:
+    """Returns the (name, labels, value) exposition samples."""
+    with self._lock:
+      return [(self.name, labels, value) for labels, value in sorted(self._values.items())]
+
+  def Values(self) -> List[Dict[str, Any]]:
+    with self._lock:
+      return [{'labels': dict(labels), 'value': value}
+              for labels, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+  kind = 'counter'
+
+  def Inc(self, value: float = 1, **labels):
+    if not self.registry.enabled:
+      return
+    key = _Key(labels)
+    with self._lock:
+      self._values[key] = self._values.get(key, 0) + value
+
+  def Get(self, **labels) -> float:
+    return self._values.get(_Key(labels), 0)
+
+
+class Gauge(_Metric):
+  kind = 'gauge'
+
+  def Set(self, value: float, **labels):
+    if not self.registry.enabled:
+      return
+    with self._lock:
+      self._values[_Key(labels)] = value
+
+  def Get(self, **labels) -> float:
+    return self._values.get(_Key(labels), 0)
+
+
+class _HistogramValue(object):
+
+  def __init__(self, num_buckets: int):
+    self.buckets = [0] * num_buckets
+    self.count = 0
+    self.sum = 0.0
+
+
+class Histogram(_Metric):
+  kind = 'histogram'
+
+  def __init__(
+      self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+      registry: Registry = None):
+    super().__init__(name, help, registry)
+    self.buckets = tuple(sorted(buckets))
+
+  def Observe(self, value: float, **labels):
+    if not self.registry.enabled:
+      return
+    key = _Key(labels)
+    with self._lock:
+      hist = self._values.get(key)
+      if hist is None:
+        hist = self._values[key] = _HistogramValue(len(self.buckets))
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          hist.buckets[i] += 1
+          break
+      hist.count += 1
+      hist.sum += value
+
+  def Time(self, **labels):
+    """Returns a context manager observing the time spent in its block."""
+    if not self.registry.enabled:
+      return _NOOP_TIMER
+    return _Timer(self, labels)
+
+  def Get(self, **labels) -> Tuple[int, float]:
+    """Returns the (count, sum) of the observations."""
+    hist = self._values.get(_Key(labels))
+    return (hist.count, hist.sum) if hist else (0, 0.0)
+
+  def Samples(self) -> List[Tuple[str, Labels, float]]:
+    samples = []
+    with self._lock:
+      for labels, hist in sorted(self._values.items()):
+        cumulative = 0
+        for bound, n in zip(self.buckets, hist.buckets):
+          cumulative += n
+          samples.append(('%s_bucket' % self.name, labels + (('le', repr(bound)),), cumulative))
+        samples.append(('%s_bucket' % self.name, labels + (('le', '+Inf'),), hist.count))
+        samples.append(('%s_sum' % self.name, labels, hist.sum))
+        samples.append(('%s_count' % self.name, labels, hist.count))
+    return samples
+
+  def Values(self) -> List[Dict[str, Any]]:
+    with self._lock:
+      return [{
+        'labels': dict(labels),
+        'count': hist.count,
+        'sum': hist.sum,
+        'buckets': dict(zip([repr(b) for b in self.buckets], hist.buckets)),
+      } for labels, hist in sorted(self._values.items())]
+
+
+class _Timer(object):
+
+  def __init__(self, histogram: Histogram, labels: Dict[str, Any]):
+    self.histogram = histogram
+    self.labels = labels
+    self.elapsed = 0.0
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, *args):
+    self.elapsed = time.perf_counter() - self._start
+    self.histogram.Observe(self.elapsed, **self.labels)
+
+
+class _NoopTimer(object):
+  elapsed = 0.0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    pass
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+@contextlib.contextmanager
+def Profile(kind: str, path: str):
+  """Profiles the enclosed block and writes the result to path.
+
+  * cprofile: CPU profile of the current thread and of all threads started in the block, written
+    as pstats data (read with `python -m pstats path`).
+  * tracemalloc: the top allocation sites at the end of the block, and the peak traced memory.
+  * empty: no profiling.
+  """
+  if not kind:
+    yield
+    return
+  # Imported here to keep the import of instrumented modules cheap.
+  if kind == PROFILE_CPROFILE:
+    import cProfile
+    import pstats
+    profiles = [cProfile.Profile()]
+    lock = threading.Lock()
+    def StartThread(*args):
+      # Runs as the profile function of each new thread, and replaces itself by a profiler.
+      profile = cProfile.Profile()
+      with lock:
+        profiles.append(profile)
+      profile.enable()
+    threading.setprofile(StartThread)
+    profiles[0].enable()
+    try:
+      yield
+    finally:
+      profiles[0].disable()
+      threading.setprofile(None)
+      with lock:
+        pstats.Stats(*profiles).dump_stats(path)
+  elif kind == PROFILE_TRACEMALLOC:
+    import tracemalloc
+    tracemalloc.start()
+    try:
+      yield
+    finally:
+      snapshot = tracemalloc.take_snapshot()
+      _, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      with open(path, 'w') as f:
+        f.write('Peak traced memory: %d bytes\n' % peak)
+        for stat in snapshot.statistics('lineno')[:_TRACEMALLOC_TOP]:
+          f.write('%s\n' % stat)
+  else:
+    raise ValueError('Unknown profile: %s' % kind)
@@ -0,0 +1,149 @@
+import json
+import os
+import pstats
+import tempfile
+import threading
+import unittest
+
+from monitoring import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+  def setUp(self):
+    self.registry = metrics.Registry()
+    self.registry.enabled = True
+
+  def testDisabled(self):
+    self.registry.enabled = False
+    counter = metrics.Counter('c', 'Counter.', registry=self.registry)
+    hist = metrics.Histogram('h', 'Histogram.', registry=self.registry)
+    counter.Inc()
+    hist.Observe(1.0)
+    with hist.Time():
+      pass
+    self.assertEqual(counter.Get(), 0)
+    self.assertEqual(hist.Get(), (0, 0.0))
+    self.assertEqual(self.registry.ToPrometheus(), '')
+    self.assertEqual(self.registry.ToJson(), {})
+
+  def testCounter(self):
+    counter = metrics.Counter('c', 'Counter.', registry=self.registry)
+    counter.Inc(stage='fetch', item='AAPL')
+    counter.Inc(2, item='AAPL', stage='fetch')
+    counter.Inc(stage='write', item='AAPL')
+    self.assertEqual(counter.Get(stage='fetch', item='AAPL'), 3)
+    self.assertEqual(counter.Get(stage='write', item='AAPL'), 1)
+    self.assertEqual(counter.Get(stage='parse', item='AAPL'), 0)
+
+  def testDuplicate(self):
+    metrics.Counter('c', 'Counter.', registry=self.registry)
+    with self.assertRaises(ValueError):
+      metrics.Gauge('c', 'Gauge.', registry=self.registry)
+
+  def testHistogram(self):
+    hist = metrics.Histogram('h', 'Histogram.', buckets=(0.1, 1.0), registry=self.registry)
+    for value in [0.05, 0.5, 0.7, 5]:
+      hist.Observe(value, stage='fetch')
+    with hist.Time(stage='parse') as timer:
+      pass
+    self.assertEqual(hist.Get(stage='fetch'), (4, 6.25))
+    self.assertEqual(hist.Get(stage='parse'), (1, timer.elapsed))
+    self.assertEqual(self.registry.ToJson()['h']['values'][0], {
+      'labels': {'stage': 'fetch'},
+      'count': 4,
+      'sum': 6.25,
+      'buckets': {'0.1': 1, '1.0': 2},
+    })
+
+  def testConcurrentInc(self):
+    counter = metrics.Counter('c', 'Counter.', registry=self.registry)
+    def Run():
+      for _ in range(1000):
+        counter.Inc()
+    threads = [threading.Thread(target=Run) for _ in range(4)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(counter.Get(), 4000)
+
+  def testPrometheus(self):
+    counter = metrics.Counter('c_total', 'Counter.', registry=self.registry)
+    gauge = metrics.Gauge('g', 'Gauge.', registry=self.registry)
+    hist = metrics.Histogram('h', 'Histogram.', buckets=(0.1, 1.0), registry=self.registry)
+    counter.Inc(item='A"B')
+    gauge.Set(2.5)
+    hist.Observe(0.5, stage='fetch')
+    self.assertEqual(self.registry.ToPrometheus(), '\n'.join([
+      '# HELP c_total Counter.',
+      '# TYPE c_total counter',
+      'c_total{item="A\\"B"} 1.0',
+      '# HELP g Gauge.',
+      '# TYPE g gauge',
+      'g 2.5',
+      '# HELP h Histogram.',
+      '# TYPE h histogram',
+      'h_bucket{stage="fetch",le="0.1"} 0.0',
+      'h_bucket{stage="fetch",le="1.0"} 1.0',
+      'h_bucket{stage="fetch",le="+Inf"} 1.0',
+      'h_sum{stage="fetch"} 0.5',
+      'h_count{stage="fetch"} 1.0',
+    ]) + '\n')
+
+  def testExport(self):
+    counter = metrics.Counter('c_total', 'Counter.', registry=self.registry)
+    counter.Inc()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, 'metrics.prom')
+      self.registry.Export(path)
+      with open(path) as f:
+        self.assertIn('c_total 1.0\n', f.read())
+      path = os.path.join(tmp_dir, 'metrics.json')
+      self.registry.Export(path)
+      with open(path) as f:
+        self.assertEqual(json.load(f)['c_total']['values'], [{'labels': {}, 'value': 1}])
+      self.assertEqual(sorted(os.listdir(tmp_dir)), ['metrics.json', 'metrics.prom'])
+
+  def testReset(self):
+    counter = metrics.Counter('c', 'Counter.', registry=self.registry)
+    counter.Inc()
+    self.registry.Reset()
+    self.assertEqual(counter.Get(), 0)
+
+
+def _Work():
+  return sum(range(10000))
+
+
+class TestProfile(unittest.TestCase):
+
+  def testCProfile(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, 'cycle.prof')
+      with metrics.Profile(metrics.PROFILE_CPROFILE, path):
+        t = threading.Thread(target=_Work)
+        t.start()
+        t.join()
+      functions = [f[2] for f in pstats.Stats(path).stats]
+      self.assertIn('_Work', functions)
+
+  def testTracemalloc(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      path = os.path.join(tmp_dir, 'cycle.txt')
+      with metrics.Profile(metrics.PROFILE_TRACEMALLOC, path):
+        data = [bytes(1000) for _ in range(100)]
+      with open(path) as f:
+        self.assertTrue(f.readline().startswith('Peak traced memory: '))
+      del data
+
+  def testNone(self):
+    with metrics.Profile('', 'unused'):
+      pass
+    with self.assertRaises(ValueError):
+      with metrics.Profile('perf', 'unused'):
+        pass
+
+
+if __name__ == '__main__':
+  unittest.main()
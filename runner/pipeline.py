@@ -0,0 +1,186 @@
+import logging
+import queue
+import threading
+import time
+import traceback
+from typing import Any, Callable, Iterable, List
+
+from monitoring import metrics
+
+# Marks the end of a stage's output.
+_DONE = object()
+
+STAGE_SECONDS = metrics.Histogram(
+    'yf_pipeline_stage_seconds', 'Latency of each pipeline stage call, by stage.')
+ITEM_SECONDS = metrics.Counter(
+    'yf_pipeline_item_seconds_total', 'Time spent on each item, by stage and item.')
+ERRORS = metrics.Counter('yf_pipeline_errors_total', 'Failed stage calls, by stage and item.')
+
+
+class FlushError(Exception):
+  """Raised by a pipeline flush_fn with the items whose writes it failed to commit."""
+
+  def __init__(self, items: Iterable[Any], message: str = ''):
+    super().__init__(message)
+    self.items = list(items)
+
+
+class TokenBucket(object):
+  """Thread-safe token bucket rate limiter.
+
+  Each Acquire() takes one token; tokens refill at `rate` per second up to `capacity`. Callers
+  running ahead of the rate reserve a future token and sleep until it is available.
+  """
+
+  def __init__(self, rate: float, capacity: float = None, clock=time.monotonic, sleep=time.sleep):
+    self.rate = rate
+    self.capacity = capacity if capacity else max(1.0, rate)
+    self._clock = clock
+    self._sleep = sleep
+    self._tokens = self.capacity
+    self._last = clock()
+    self._lock = threading.Lock()
+
+  def Acquire(self):
+    with self._lock:
+      now = self._clock()
+      self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+      self._last = now
+      self._tokens -= 1
+      wait = -self._tokens / self.rate if self._tokens < 0 else 0
+    if wait > 0:
+      self._sleep(wait)
+
+
+class Pipeline(object):
+  """Runs items through fetch -> parse -> write stages connected by bounded queues.
+
+  * fetch_fn(item) runs on `concurrency` threads, paced by the optional rate limiter. With a
+    scheduler (see scheduler.FetchScheduler), the threads take items from it instead, and failed
+    fetches may be retried later.
+  * parse_fn(item, fetched) runs on a single thread.
+  * write_fn(item, parsed) runs on a single writer thread, which is the only thread touching the
+    storage; flush_fn() is called on that thread once all items are written. If it raises a
+    FlushError, its items fail, and any other error fails all items.
+
+  A full queue blocks the upstream stage, so slow writes throttle fetching. An item failing in any
+  stage is logged and reported by Run(); it does not affect other items.
+  """
+
+  def __init__(
+      self,
+      fetch_fn: Callable[[Any], Any],
+      parse_fn: Callable[[Any, Any], Any],
+      write_fn: Callable[[Any, Any], None],
+      flush_fn: Callable[[], None] = None,
+      concurrency: int = 4,
+      rate_limiter: TokenBucket = None,
+      queue_size: int = 64,
+      scheduler=None):
+    self.fetch_fn = fetch_fn
+    self.parse_fn = parse_fn
+    self.write_fn = write_fn
+    self.flush_fn = flush_fn
+    self.concurrency = concurrency
+    self.rate_limiter = rate_limiter
+    self.queue_size = queue_size
+    self.scheduler = scheduler
+
+  def Run(self, items: Iterable[Any]) -> List[Any]:
+    """Processes all items and returns the failed ones, in input order."""
+    items = list(items)
+    failed = set()
+    failed_lock = threading.Lock()
+
+    def Fail(stage, item):
+      logging.error(traceback.format_exc())
+      ERRORS.Inc(stage=stage, item=item)
+      with failed_lock:
+        failed.add(item)
+
+    def Call(stage, item, fn, *args):
+      with STAGE_SECONDS.Time(stage=stage) as timer:
+        result = fn(*args)
+      ITEM_SECONDS.Inc(timer.elapsed, stage=stage, item=item)
+      return result
+
+    todo_q = queue.Queue()
+    if self.scheduler:
+      self.scheduler.Start(items)
+    else:
+      for item in items:
+        todo_q.put(item)
+    parse_q = queue.Queue(maxsize=self.queue_size)
+    write_q = queue.Queue(maxsize=self.queue_size)
+
+    def Fetch():
+      while True:
+        if self.scheduler:
+          item = self.scheduler.Next()
+          if item is None:
+            return
+        else:
+          try:
+            item = todo_q.get_nowait()
+          except queue.Empty:
+            return
+        start = time.monotonic()
+        try:
+          if self.rate_limiter:
+            self.rate_limiter.Acquire()
+          fetched = Call('fetch', item, self.fetch_fn, item)
+        except Exception as e:
+          if self.scheduler and self.scheduler.Failed(item, e, time.monotonic() - start):
+            logging.warning('Retrying fetch of %s: %s' % (item, e))
+          else:
+            Fail('fetch', item)
+          continue
+        if self.scheduler:
+          self.scheduler.Succeeded(item, time.monotonic() - start)
+        parse_q.put((item, fetched))
+
+    def Parse():
+      while True:
+        elem = parse_q.get()
+        if elem is _DONE:
+          write_q.put(_DONE)
+          return
+        item, fetched = elem
+        try:
+          write_q.put((item, Call('parse', item, self.parse_fn, item, fetched)))
+        except:
+          Fail('parse', item)
+
+    def Write():
+      while True:
+        elem = write_q.get()
+        if elem is _DONE:
+          break
+        item, parsed = elem
+        try:
+          Call('write', item, self.write_fn, item, parsed)
+        except:
+          Fail('write', item)
+      if self.flush_fn:
+        try:
+          with STAGE_SECONDS.Time(stage='flush'):
+            self.flush_fn()
+        except Exception as e:
+          logging.error(traceback.format_exc())
+          ERRORS.Inc(stage='flush', item='')
+          with failed_lock:
+            failed.update(e.items if isinstance(e, FlushError) else items)
+
+    fetchers = [
+        threading.Thread(target=Fetch, name='fetch-%d' % i)
+        for i in range(max(1, self.concurrency))]
+    parser = threading.Thread(target=Parse, name='parse')
+    writer = threading.Thread(target=Write, name='write')
+    for t in fetchers + [parser, writer]:
+      t.start()
+    for t in fetchers:
+      t.join()
+    parse_q.put(_DONE)
+    parser.join()
+    writer.join()
+    return [item for item in items if item in failed]
@@ -0,0 +1,105 @@
+import threading
+import time
+import unittest
+
+from monitoring import metrics
+from runner import pipeline
+
+
+class TestTokenBucket(unittest.TestCase):
+
+  def testAcquire(self):
+    now = [0.0]
+    sleeps = []
+    def Sleep(secs):
+      sleeps.append(secs)
+    bucket = pipeline.TokenBucket(2, clock=lambda: now[0], sleep=Sleep)
+    bucket.Acquire()
+    bucket.Acquire()
+    self.assertEqual(sleeps, [])
+    bucket.Acquire()
+    self.assertEqual(sleeps, [0.5])
+    now[0] = 10.0
+    bucket.Acquire()
+    self.assertEqual(sleeps, [0.5])
+
+
+class TestPipeline(unittest.TestCase):
+
+  def testRun(self):
+    written = []
+    writer_threads = set()
+    flushed = []
+
+    def Fetch(item):
+      if item == 'bad_fetch':
+        raise ValueError(item)
+      time.sleep(0.01)
+      return item.lower()
+
+    def Parse(item, fetched):
+      if item == 'BAD_PARSE':
+        raise ValueError(item)
+      return fetched + '!'
+
+    def Write(item, parsed):
+      writer_threads.add(threading.current_thread().name)
+      written.append((item, parsed))
+
+    p = pipeline.Pipeline(
+        Fetch, Parse, Write, flush_fn=lambda: flushed.append(True), concurrency=3, queue_size=1)
+    errors = p.Run(['A', 'bad_fetch', 'B', 'BAD_PARSE', 'C'])
+    self.assertEqual(errors, ['bad_fetch', 'BAD_PARSE'])
+    self.assertEqual(sorted(written), [('A', 'a!'), ('B', 'b!'), ('C', 'c!')])
+    self.assertEqual(writer_threads, set(['write']))
+    self.assertEqual(flushed, [True])
+
+  def testMetrics(self):
+    def Fetch(item):
+      if item == 'bad':
+        raise ValueError(item)
+      return item
+
+    metrics.REGISTRY.Reset()
+    metrics.Enable()
+    try:
+      p = pipeline.Pipeline(Fetch, lambda item, fetched: fetched, lambda item, parsed: None)
+      self.assertEqual(p.Run(['A', 'bad', 'B']), ['bad'])
+    finally:
+      metrics.Enable(False)
+    # Failed calls are timed too.
+    self.assertEqual(pipeline.STAGE_SECONDS.Get(stage='fetch')[0], 3)
+    self.assertEqual(pipeline.STAGE_SECONDS.Get(stage='write')[0], 2)
+    self.assertEqual(pipeline.STAGE_SECONDS.Get(stage='flush')[0], 0)
+    self.assertEqual(pipeline.ERRORS.Get(stage='fetch', item='bad'), 1)
+    self.assertGreater(pipeline.ITEM_SECONDS.Get(stage='parse', item='A'), 0)
+    metrics.REGISTRY.Reset()
+
+  def testRunIsConcurrent(self):
+    p = pipeline.Pipeline(
+        lambda item: time.sleep(0.1), lambda item, fetched: None, lambda item, parsed: None,
+        concurrency=10)
+    start = time.monotonic()
+    self.assertEqual(p.Run(range(10)), [])
+    self.assertLess(time.monotonic() - start, 0.5)
+
+  def testFlushFailureFailsAllItems(self):
+    def Flush():
+      raise IOError('disk full')
+    p = pipeline.Pipeline(
+        lambda item: item, lambda item, fetched: fetched, lambda item, parsed: None,
+        flush_fn=Flush)
+    self.assertEqual(p.Run(['A', 'B']), ['A', 'B'])
+
+  def testFlushFailureFailsUncommittedItems(self):
+    # Items of earlier batches were committed by write_fn, only B was still buffered.
+    def Flush():
+      raise pipeline.FlushError(['B'], 'disk full')
+    p = pipeline.Pipeline(
+        lambda item: item, lambda item, fetched: fetched, lambda item, parsed: None,
+        flush_fn=Flush)
+    self.assertEqual(p.Run(['A', 'B', 'C']), ['B'])
+
+
+if __name__ == '__main__':
+    unittest.main()
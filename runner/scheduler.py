@@ -0,0 +1,222 @@
+"""Adaptive pacing and retries of the fetches of a snapshot cycle.
+
+AimdController adapts the number of concurrent fetches and their rate to what the upstream
+sustains, like TCP congestion control: both grow additively while fetches succeed within the
+latency target, and are cut multiplicatively when the upstream throttles (HTTP 429 or 503) or
+slows down, at most once per cooldown so that a burst of failures counts once.
+
+FetchScheduler hands the items of a cycle to the fetch threads of a pipeline.Pipeline. Failed
+fetches are retried after a jittered exponential backoff (or the Retry-After of the response),
+within a retry budget per cycle and before the end of the cycle. Items which failed in previous
+cycles are fetched last and retried less, so that they do not hold back the others.
+"""
+import heapq
+import math
+import random
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Tuple
+
+from monitoring import metrics
+from runner import pipeline
+
+# HTTP statuses of rate limiting responses.
+_THROTTLED_STATUSES = frozenset([429, 503])
+
+_CONCURRENCY_LIMIT = metrics.Gauge(
+    'yf_fetch_concurrency_limit', 'Concurrent fetches allowed by the AIMD controller.')
+_RATE_LIMIT = metrics.Gauge(
+    'yf_fetch_rate_limit', 'Fetches per second allowed by the AIMD controller.')
+_RETRIES = metrics.Counter('yf_fetch_retries_total', 'Fetch retries, by reason.')
+_GIVE_UPS = metrics.Counter('yf_fetch_give_ups_total', 'Fetches failed for good, by reason.')
+
+THROTTLED = 'throttled'
+ERROR = 'error'
+
+
+def IsThrottled(error: Exception) -> bool:
+  """Returns whether the error is a rate limiting response of the upstream."""
+  response = getattr(error, 'response', None)
+  if getattr(response, 'status_code', None) in _THROTTLED_STATUSES:
+    return True
+  return 'Too Many Requests' in str(error)
+
+
+def RetryAfter(error: Exception) -> float:
+  """Returns the Retry-After delay in seconds of the response of the error, or None."""
+  headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+  try:
+    return float(headers.get('Retry-After'))
+  except (TypeError, ValueError):
+    return None
+
+
+class AimdController(object):
+  """Limits the concurrency and rate of fetches, with additive increase, multiplicative decrease.
+
+  Each fetch succeeding within latency_target_secs raises the concurrency limit by 1/limit (about
+  +1 per round of `limit` fetches) and the rate by rate_step/rate (about +rate_step per second),
+  up to max_concurrency and max_rate. A throttled or slow fetch multiplies both by `decrease`,
+  down to 1 and min_rate, unless they were decreased less than cooldown_secs ago. Other failures
+  leave them unchanged. A rate of 0 leaves the rate unlimited.
+  """
+
+  def __init__(
+      self, concurrency: int, rate: float = 0, max_concurrency: int = None,
+      max_rate: float = None, min_rate: float = 0.1, rate_step: float = 0.1,
+      decrease: float = 0.5, latency_target_secs: float = 10.0, cooldown_secs: float = 5.0,
+      clock=time.monotonic, sleep=time.sleep):
+    self.limit = float(max(1, concurrency))
+    self.max_concurrency = max(max_concurrency or concurrency, 1)
+    self.rate = rate
+    self.max_rate = max(max_rate or rate, rate)
+    self.min_rate = min(min_rate, rate)
+    self.rate_step = rate_step
+    self.decrease = decrease
+    self.latency_target_secs = latency_target_secs
+    self.cooldown_secs = cooldown_secs
+    self._clock = clock
+    self._bucket = pipeline.TokenBucket(rate, clock=clock, sleep=sleep) if rate > 0 else None
+    self._in_flight = 0
+    self._last_decrease = None
+    self._cond = threading.Condition()
+    self._Export()
+
+  def _Export(self):
+    _CONCURRENCY_LIMIT.Set(self.limit)
+    _RATE_LIMIT.Set(self.rate)
+
+  def Acquire(self):
+    """Blocks until a fetch may start. Each call must be followed by a Release()."""
+    with self._cond:
+      while self._in_flight >= int(self.limit):
+        self._cond.wait()
+      self._in_flight += 1
+    if self._bucket:
+      self._bucket.Acquire()
+
+  def Release(self, latency: float, throttled: bool = False, failed: bool = False):
+    """Records the outcome of a fetch and adapts the limits."""
+    with self._cond:
+      self._in_flight -= 1
+      if throttled or latency > self.latency_target_secs:
+        now = self._clock()
+        if self._last_decrease is None or now - self._last_decrease >= self.cooldown_secs:
+          self._last_decrease = now
+          self.limit = max(1.0, self.limit * self.decrease)
+          if self._bucket:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+      elif not failed:
+        self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+        if self._bucket:
+          self.rate = min(self.max_rate, self.rate + self.rate_step / self.rate)
+      if self._bucket:
+        self._bucket.rate = self.rate
+        self._bucket.capacity = max(1.0, self.rate)
+      self._Export()
+      self._cond.notify_all()
+
+
+class FetchScheduler(object):
+  """Schedules the fetches and retries of the items of a cycle, see the module doc.
+
+  An item is attempted up to max_attempts times, minus one per previous cycle it failed in (at
+  least once). Retries wait base_backoff_secs * 2^(attempt - 1), jittered by +-50% and at most
+  max_backoff_secs, and are limited to retry_budget retries per item of the cycle. Retries which
+  would start more than cycle_secs after the start of the cycle are given up.
+  """
+
+  def __init__(
+      self, controller: AimdController = None, max_attempts: int = 3,
+      retry_budget: float = 0.2, base_backoff_secs: float = 1.0,
+      max_backoff_secs: float = 300.0, cycle_secs: float = None, rng: random.Random = None):
+    self.controller = controller
+    self.max_attempts = max_attempts
+    self.retry_budget = retry_budget
+    self.base_backoff_secs = base_backoff_secs
+    self.max_backoff_secs = max_backoff_secs
+    self.cycle_secs = cycle_secs
+    self._rng = rng or random.Random()
+    # Number of consecutive cycles each item failed in.
+    self.failures: Dict[Any, int] = {}
+    self._queue: List[Tuple[float, int, int, Any]] = []
+    self._attempts: Dict[Any, int] = {}
+    self._in_flight = 0
+    self._budget = 0
+    self._deadline = None
+    self._seq = 0
+    self._cond = threading.Condition()
+
+  def _Push(self, ready: float, item: Any):
+    """Queues the item, ready at the given time. Requires self._cond."""
+    self._seq += 1
+    heapq.heappush(self._queue, (ready, self.failures.get(item, 0), self._seq, item))
+
+  def Start(self, items: Iterable[Any]):
+    """Starts a cycle of the items."""
+    items = list(items)
+    with self._cond:
+      now = time.monotonic()
+      self._queue = []
+      self._attempts = {}
+      self._in_flight = 0
+      self._budget = math.ceil(self.retry_budget * len(items))
+      self._deadline = now + self.cycle_secs if self.cycle_secs else None
+      for item in items:
+        self._Push(now, item)
+
+  def Next(self) -> Any:
+    """Blocks until an item is due and may be fetched, and returns it.
+
+    Returns None once all items are done, i.e. none is queued or being fetched.
+    """
+    with self._cond:
+      while True:
+        now = time.monotonic()
+        if self._queue and self._queue[0][0] <= now:
+          item = heapq.heappop(self._queue)[3]
+          self._in_flight += 1
+          break
+        if not self._queue and not self._in_flight:
+          return None
+        self._cond.wait(self._queue[0][0] - now if self._queue else None)
+    if self.controller:
+      self.controller.Acquire()
+    return item
+
+  def Succeeded(self, item: Any, latency: float):
+    if self.controller:
+      self.controller.Release(latency)
+    with self._cond:
+      self._in_flight -= 1
+      self.failures.pop(item, None)
+      self._cond.notify_all()
+
+  def Failed(self, item: Any, error: Exception, latency: float) -> bool:
+    """Records a failed fetch of the item. Returns True if it is retried later."""
+    throttled = IsThrottled(error)
+    reason = THROTTLED if throttled else ERROR
+    if self.controller:
+      self.controller.Release(latency, throttled=throttled, failed=True)
+    with self._cond:
+      self._in_flight -= 1
+      attempts = self._attempts.get(item, 0) + 1
+      self._attempts[item] = attempts
+      allowed = max(1, self.max_attempts - self.failures.get(item, 0))
+      retry = attempts < allowed and self._budget > 0
+      if retry:
+        delay = RetryAfter(error)
+        if delay is None:
+          delay = min(self.max_backoff_secs, self.base_backoff_secs * 2 ** (attempts - 1))
+          delay *= 0.5 + self._rng.random()
+        ready = time.monotonic() + delay
+        retry = self._deadline is None or ready <= self._deadline
+      if retry:
+        self._budget -= 1
+        self._Push(ready, item)
+        _RETRIES.Inc(reason=reason)
+      else:
+        self.failures[item] = self.failures.get(item, 0) + 1
+        _GIVE_UPS.Inc(reason=reason)
+      self._cond.notify_all()
+    return retry
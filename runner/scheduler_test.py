@@ -0,0 +1,194 @@
+import random
+import threading
+import time
+import unittest
+
+import requests
+
+from analysis import fake_api
+from analysis import fetch
+from runner import pipeline
+from runner import scheduler
+
+
+class _Response(object):
+
+  def __init__(self, status_code: int, headers=None):
+    self.status_code = status_code
+    self.headers = headers or {}
+
+
+def HttpError(status_code: int, headers=None) -> requests.HTTPError:
+  return requests.HTTPError('%d' % status_code, response=_Response(status_code, headers))
+
+
+class TestThrottling(unittest.TestCase):
+
+  def testIsThrottled(self):
+    self.assertTrue(scheduler.IsThrottled(HttpError(429)))
+    self.assertTrue(scheduler.IsThrottled(HttpError(503)))
+    self.assertTrue(scheduler.IsThrottled(ValueError('429 Client Error: Too Many Requests')))
+    self.assertFalse(scheduler.IsThrottled(HttpError(404)))
+    self.assertFalse(scheduler.IsThrottled(ValueError('No quote summary')))
+
+  def testRetryAfter(self):
+    self.assertEqual(scheduler.RetryAfter(HttpError(429, {'Retry-After': '3'})), 3.0)
+    self.assertIsNone(scheduler.RetryAfter(HttpError(429, {'Retry-After': 'soon'})))
+    self.assertIsNone(scheduler.RetryAfter(HttpError(429)))
+    self.assertIsNone(scheduler.RetryAfter(ValueError()))
+
+
+class TestAimdController(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.now = [0.0]
+    self.sleeps = []
+    self.controller = scheduler.AimdController(
+        concurrency=4, rate=2, max_concurrency=8, max_rate=4, rate_step=1,
+        latency_target_secs=1.0, cooldown_secs=10.0,
+        clock=lambda: self.now[0], sleep=self.sleeps.append)
+
+  def _Fetch(self, latency: float = 0.1, throttled: bool = False, failed: bool = False):
+    self.controller.Acquire()
+    self.controller.Release(latency, throttled=throttled, failed=failed)
+
+  def testIncrease(self):
+    self._Fetch()
+    self.assertEqual(self.controller.limit, 4.25)
+    self.assertEqual(self.controller.rate, 2.5)
+    for _ in range(100):
+      self.now[0] += 1
+      self._Fetch()
+    self.assertEqual(self.controller.limit, 8)
+    self.assertEqual(self.controller.rate, 4)
+
+  def testDecrease(self):
+    self._Fetch(throttled=True)
+    self.assertEqual((self.controller.limit, self.controller.rate), (2, 1))
+    # Within the cooldown.
+    self.now[0] = 5.0
+    self._Fetch(throttled=True)
+    self.assertEqual((self.controller.limit, self.controller.rate), (2, 1))
+    self.now[0] = 15.0
+    self._Fetch(latency=2.0)
+    self.assertEqual((self.controller.limit, self.controller.rate), (1, 0.5))
+    self.now[0] = 30.0
+    self._Fetch(throttled=True)
+    self.assertEqual(self.controller.limit, 1)
+    # Other errors leave the limits unchanged.
+    self.now[0] = 60.0
+    self._Fetch(failed=True)
+    self.assertEqual((self.controller.limit, self.controller.rate), (1, 0.25))
+
+  def testAcquireBlocks(self):
+    controller = scheduler.AimdController(concurrency=1)
+    controller.Acquire()
+    acquired = threading.Event()
+    def Acquire():
+      controller.Acquire()
+      acquired.set()
+    t = threading.Thread(target=Acquire)
+    t.start()
+    self.assertFalse(acquired.wait(0.05))
+    controller.Release(0.1)
+    self.assertTrue(acquired.wait(5))
+    t.join()
+
+
+class TestFetchScheduler(unittest.TestCase):
+
+  def _Scheduler(self, **kwargs) -> scheduler.FetchScheduler:
+    kwargs.setdefault('base_backoff_secs', 0.01)
+    return scheduler.FetchScheduler(rng=random.Random(0), **kwargs)
+
+  def testRetries(self):
+    s = self._Scheduler(max_attempts=3, retry_budget=1)
+    s.Start(['A', 'B'])
+    self.assertEqual(s.Next(), 'A')
+    self.assertTrue(s.Failed('A', HttpError(429), 0.1))
+    self.assertEqual(s.Next(), 'B')
+    s.Succeeded('B', 0.1)
+    # Waits for the backoff of A.
+    self.assertEqual(s.Next(), 'A')
+    self.assertTrue(s.Failed('A', ValueError(), 0.1))
+    self.assertEqual(s.Next(), 'A')
+    self.assertFalse(s.Failed('A', ValueError(), 0.1))
+    self.assertIsNone(s.Next())
+    self.assertEqual(s.failures, {'A': 1})
+
+  def testRetryBudget(self):
+    s = self._Scheduler(retry_budget=0.5)
+    s.Start(['A', 'B', 'C'])
+    items = [s.Next() for _ in range(3)]
+    self.assertEqual(
+        [s.Failed(item, ValueError(), 0.1) for item in items], [True, True, False])
+
+  def testDeadline(self):
+    s = self._Scheduler(base_backoff_secs=10, cycle_secs=1)
+    s.Start(['A'])
+    self.assertFalse(s.Failed(s.Next(), HttpError(429), 0.1))
+    s.Start(['B'])
+    self.assertFalse(s.Failed(s.Next(), HttpError(429, {'Retry-After': '5'}), 0.1))
+    s.Start(['C'])
+    self.assertTrue(s.Failed(s.Next(), HttpError(429, {'Retry-After': '0'}), 0.1))
+
+  def testDeprioritizesFailingItems(self):
+    s = self._Scheduler(max_attempts=3, retry_budget=1)
+    s.failures = {'A': 2, 'B': 1}
+    s.Start(['A', 'B', 'C'])
+    self.assertEqual([s.Next() for _ in range(3)], ['C', 'B', 'A'])
+    # A gets a single attempt, B two.
+    self.assertFalse(s.Failed('A', ValueError(), 0.1))
+    self.assertTrue(s.Failed('B', ValueError(), 0.1))
+    s.Succeeded('C', 0.1)
+    self.assertEqual(s.Next(), 'B')
+    s.Succeeded('B', 0.1)
+    self.assertIsNone(s.Next())
+    self.assertEqual(s.failures, {'A': 3})
+
+  def testNextWaitsForFetches(self):
+    s = self._Scheduler()
+    s.Start(['A'])
+    item = s.Next()
+    t = threading.Timer(0.05, lambda: s.Failed(item, ValueError(), 0.1))
+    t.start()
+    # A may be retried until its fetch fails.
+    self.assertEqual(s.Next(), 'A')
+    t.join()
+
+
+class TestThrottledApi(unittest.TestCase):
+
+  def _Run(self, api: fake_api.FakeApi, tickers, fetch_scheduler=None):
+    fetcher = fetch.ApiFetcher(api.url, cookie_url='')
+    written = []
+    p = pipeline.Pipeline(
+        fetcher.FetchSummary, lambda item, summary: summary,
+        lambda item, summary: written.append(item), concurrency=8, scheduler=fetch_scheduler)
+    return p.Run(tickers), written
+
+  def testRecoversFromThrottling(self):
+    tickers = ['T%02d' % i for i in range(30)]
+    summaries = {t: fake_api.Summary(price=100.0, eps=1.0) for t in tickers}
+    with fake_api.FakeApi(summaries, max_rate=20, max_concurrency=4) as api:
+      failed, _ = self._Run(api, tickers)
+    self.assertGreater(len(failed), 0)
+
+    controller = scheduler.AimdController(
+        concurrency=8, rate=50, cooldown_secs=0.1, latency_target_secs=5.0)
+    fetch_scheduler = scheduler.FetchScheduler(
+        controller, max_attempts=10, retry_budget=5, base_backoff_secs=0.05)
+    with fake_api.FakeApi(summaries, max_rate=20, max_concurrency=4) as api:
+      start = time.monotonic()
+      failed, written = self._Run(api, tickers, fetch_scheduler)
+    self.assertEqual(failed, [])
+    self.assertEqual(sorted(written), tickers)
+    self.assertGreater(api.throttled, 0)
+    self.assertLess(controller.limit, 8)
+    self.assertLess(controller.rate, 50)
+    self.assertLess(time.monotonic() - start, 30)
+    self.assertEqual(fetch_scheduler.failures, {})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,26 +1,108 @@
 import datetime
+import multiprocessing
 import os
-import json
 import logging
 import time
-import traceback
+from typing import List, Tuple
 
+from analysis import features
+from analysis import fetch
 from analysis import yfinance_client
+from monitoring import metrics
+from runner import pipeline
+from runner import scheduler
+from storage import checkpoint
+from storage import codec
+from storage import partition
 from storage import sqlite
 
-def TakeSnapshot(ticker, db: sqlite.ShardedSqliteStorage, db_raw: sqlite.ShardedSqliteStorage):
-  date_str = datetime.datetime.now().strftime('%Y-%m-%d')
-  client = yfinance_client.YFinanceClient(ticker)
-  analysis = client.GetAnalysis()
-  info = client.GetInfo()
+# Groups written for each ticker by ParseSnapshot.
+GROUPS = ['yf.analysis', 'yf.info']
 
-  db.Write(ticker, date_str, analysis.SerializeToString(), group='yf.analysis')
-  db.Write(ticker, date_str, info.SerializeToString(), group='yf.info')
+# Days of checkpoints kept in the system DB.
+_CHECKPOINT_DAYS = 7
 
+_PARSE_SECONDS = metrics.Histogram(
+    'yf_snapshot_parse_seconds', 'Latency of the parse steps, by step (convert or serialize).')
+_CYCLE_SECONDS = metrics.Gauge('yf_snapshot_cycle_seconds', 'Duration of the last cycle.')
+_CYCLE_TIMESTAMP = metrics.Gauge(
+    'yf_snapshot_cycle_timestamp_seconds', 'Unix time at the end of the last cycle.')
+_CYCLE_TICKERS = metrics.Gauge(
+    'yf_snapshot_cycle_tickers', 'Tickers of the last cycle, by status (ok, failed or skipped).')
+
+def FetchSnapshot(ticker: str, fetcher: fetch.Fetcher = None) -> yfinance_client.YFinanceClient:
+  """Fetches the yfinance data of the ticker. This is the network bound stage."""
+  logging.info('Snapshotting %s' % ticker)
+  client = yfinance_client.YFinanceClient(ticker, fetcher)
+  client.response
+  return client
+
+def ParseSnapshot(
+    ticker: str, client: yfinance_client.YFinanceClient, with_raw: bool,
+    date_str: str) -> Tuple[List[sqlite.Row], List[sqlite.Row]]:
+  """Converts fetched data to the rows of the date for the DB and the raw DB."""
+  with _PARSE_SECONDS.Time(step='convert'):
+    analysis = client.GetAnalysis()
+    info = client.GetInfo()
+
+  with _PARSE_SECONDS.Time(step='serialize'):
+    rows = [
+      (ticker, date_str, analysis.SerializeToString(), 'yf.analysis'),
+      (ticker, date_str, info.SerializeToString(), 'yf.info'),
+    ]
+  raw_rows = []
+  if with_raw:
+    raw_rows = [
+      (ticker, date_str, client.response.analysis, 'yf.analysis'),
+      (ticker, date_str, client.response.info, 'yf.info'),
+    ]
+  return rows, raw_rows
+
+def WriteSnapshot(
+    rows: List[sqlite.Row], raw_rows: List[sqlite.Row],
+    db: sqlite.BatchWriter, db_raw: sqlite.BatchWriter):
+  # Raw rows first: the ticker is checkpointed once its rows are flushed to db, which flushes
+  # db_raw first (see CreateWriters).
   if db_raw:
-    db_raw.Write(
-      ticker, date_str, client.ticker.analysis.to_json().encode('utf-8'), group='yf.analysis')
-    db_raw.Write(ticker, date_str, json.dumps(client.ticker.info).encode('utf-8'), group='yf.info')
+    for row in raw_rows:
+      db_raw.Write(*row)
+  for row in rows:
+    db.Write(*row)
+
+def CreateWriters(
+    db: sqlite.ShardedSqliteStorage, db_raw: sqlite.ShardedSqliteStorage, batch_size: int,
+    progress: checkpoint.Checkpoint) -> Tuple[sqlite.BatchWriter, sqlite.BatchWriter]:
+  """Returns the batch writers of the DB and the raw DB (None without one).
+
+  Tickers are checkpointed once their rows are committed to the DB. Each flush of the DB flushes
+  the raw DB first, so that checkpointed tickers have their raw rows too.
+  """
+  writer_raw = sqlite.BatchWriter(db_raw, batch_size) if db_raw else None
+  writer = sqlite.BatchWriter(
+      db, batch_size, on_flush=progress.MarkRows,
+      before_flush=writer_raw.Flush if writer_raw else None)
+  return writer, writer_raw
+
+def FlushWriters(writer: sqlite.BatchWriter, writer_raw: sqlite.BatchWriter):
+  """Flushes the writers of CreateWriters at the end of a cycle, as a pipeline flush_fn.
+
+  On failure, raises a pipeline.FlushError with the tickers of the rows still buffered: the rows
+  of the other tickers were committed by earlier flushes.
+  """
+  try:
+    if writer_raw:
+      writer_raw.Flush()
+    writer.Flush()
+  except Exception as e:
+    buffered = writer.rows + (writer_raw.rows if writer_raw else [])
+    raise pipeline.FlushError(sorted(set(row[0] for row in buffered)), str(e)) from e
+
+def TakeSnapshot(
+    ticker, db: sqlite.BatchWriter, db_raw: sqlite.BatchWriter, fetcher: fetch.Fetcher = None):
+  client = FetchSnapshot(ticker, fetcher)
+  rows, raw_rows = ParseSnapshot(
+      ticker, client, db_raw is not None, datetime.datetime.now().strftime('%Y-%m-%d'))
+  WriteSnapshot(rows, raw_rows, db, db_raw)
 
 def EnsureEnv(key: str):
   val = os.getenv(key)
@@ -28,49 +110,146 @@ def EnsureEnv(key: str):
     raise Exception('Environment var must be set: %s' % key)
   return val
 
-if __name__ == '__main__':
-  logging.basicConfig(
-      format='%(asctime)s %(levelname)-8s %(message)s',
-      level=logging.INFO,
-      datefmt='%Y-%m-%d %H:%M:%S')
-  logging.basicConfig(
-      format='%(asctime)s %(levelname)-8s %(message)s',
-      level=logging.ERROR,
-      datefmt='%Y-%m-%d %H:%M:%S')
+def WorkerPath(path: str, num_workers: int, worker_index: int) -> str:
+  """Returns the per-worker variant of a file path, e.g. metrics-3.prom for worker 3."""
+  if num_workers <= 1 or not path:
+    return path
+  root, ext = os.path.splitext(path)
+  return '%s-%d%s' % (root, worker_index, ext)
 
+def Main(num_workers: int = 1, worker_index: int = 0):
+  """Runs the snapshot cycles of the worker's partition of the tickers."""
   # ONE-SHOT Mode
   oneshot_mode = os.getenv('YF_SNAPSHOT_ONESHOT', 'TRUE')
 
-  # DB
+  # Number of rows committed per transaction
+  batch_size = int(os.getenv('YF_SNAPSHOT_WRITE_BATCH_SIZE', '500'))
+
+  # Number of tickers fetched concurrently, and max fetches per second (0 for unlimited), at
+  # start. Both are cut when the upstream throttles or responds slower than the latency target,
+  # and grow back up to their max while fetches succeed (see scheduler.AimdController).
+  concurrency = int(os.getenv('YF_SNAPSHOT_CONCURRENCY', '4'))
+  rate_limit = float(os.getenv('YF_SNAPSHOT_RATE_LIMIT', '2'))
+  max_concurrency = max(concurrency, int(os.getenv('YF_SNAPSHOT_MAX_CONCURRENCY', '0')))
+  max_rate_limit = max(rate_limit, float(os.getenv('YF_SNAPSHOT_MAX_RATE_LIMIT', '0')))
+  latency_target_secs = float(os.getenv('YF_SNAPSHOT_LATENCY_TARGET_SECS', '10'))
+
+  # Failed fetches are retried with backoff, up to max attempts per ticker and a budget of
+  # retries per ticker of the cycle, within the cycle. A cycle starts every cycle interval.
+  max_attempts = int(os.getenv('YF_SNAPSHOT_MAX_ATTEMPTS', '3'))
+  retry_budget = float(os.getenv('YF_SNAPSHOT_RETRY_BUDGET', '0.2'))
+  cycle_secs = float(os.getenv('YF_SNAPSHOT_CYCLE_SECS', '7200'))
+
+  # SQLite PRAGMA profile, WAL by default so that readers do not block on ingestion
+  pragmas = sqlite.ParsePragmas(os.getenv('YF_SNAPSHOT_SQLITE_PRAGMAS', 'wal'))
+
+  # DB: with several workers, each one writes to its own storage under the DB path
   db_path = EnsureEnv('YF_SNAPSHOT_DB_PATH')
-  db = sqlite.ShardedSqliteStorage(db_path)
+  compression = codec.ParseCompression(os.getenv('YF_SNAPSHOT_COMPRESSION', ''))
+  # Numeric fields of yf.info and yf.analysis projected into the feature table on write,
+  # and, with the change log, their day-over-day changes.
+  change_log = os.getenv('YF_SNAPSHOT_CHANGE_LOG', 'FALSE') == 'TRUE'
+  projections = (
+      features.PROJECTIONS
+      if change_log or os.getenv('YF_SNAPSHOT_FEATURES', 'FALSE') == 'TRUE' else None)
+  main_db = sqlite.ShardedSqliteStorage(
+      db_path, compression=compression, pragmas=pragmas, projections=projections,
+      change_log=change_log)
+  db = main_db
+  if num_workers > 1:
+    db = sqlite.ShardedSqliteStorage(
+        partition.WorkerDir(db_path, worker_index), compression=compression, pragmas=pragmas,
+        projections=projections, change_log=change_log)
 
   # DB (Raw Data)
   db_raw_path = os.getenv('YF_SNAPSHOT_DB_RAW_PATH', '')
+  raw_compression = codec.ParseCompression(os.getenv('YF_SNAPSHOT_RAW_COMPRESSION', ''))
+  if db_raw_path and num_workers > 1:
+    db_raw_path = partition.WorkerDir(db_raw_path, worker_index)
+  db_raw = sqlite.ShardedSqliteStorage(
+      db_raw_path, compression=raw_compression, pragmas=pragmas) if db_raw_path else None
+
+  # Upstream: yfinance page scraping, or the JSON API over a shared keep-alive session
+  if os.getenv('YF_SNAPSHOT_FETCHER', 'yfinance') == 'api':
+    upstream = fetch.ApiFetcher(pool_size=max_concurrency)
+  else:
+    upstream = fetch.YFinanceFetcher()
+
+  # yfinance response cache: mode is one of cache, record, replay
+  fetch_cache_dir = os.getenv('YF_SNAPSHOT_FETCH_CACHE_DIR', '')
+  fetcher = fetch.CachingFetcher(
+      fetch_cache_dir,
+      upstream,
+      mode=os.getenv('YF_SNAPSHOT_FETCH_CACHE_MODE', fetch.MODE_CACHE),
+      ttl_secs=float(os.getenv('YF_SNAPSHOT_FETCH_CACHE_TTL', '3600')),
+      max_bytes=int(os.getenv('YF_SNAPSHOT_FETCH_CACHE_MAX_BYTES', str(1 << 30))),
+  ) if fetch_cache_dir else upstream
 
-  # Tickers (with cache)
-  tickers_str = db.Get('YF_SNAPSHOT_TICKERS')
+  # Metrics: exported at the end of each cycle as a Prometheus textfile, or as JSON for *.json
+  metrics_path = WorkerPath(
+      os.getenv('YF_SNAPSHOT_METRICS_PATH', ''), num_workers, worker_index)
+  metrics.Enable(bool(metrics_path))
+
+  # Profiling of each cycle: cprofile or tracemalloc, written to the profile path
+  profile = os.getenv('YF_SNAPSHOT_PROFILE', '')
+  profile_path = WorkerPath(
+      os.getenv('YF_SNAPSHOT_PROFILE_PATH', 'yf_snapshot.prof'), num_workers, worker_index)
+
+  # Tickers done today are skipped, unless done more than the refresh interval ago (0 for never)
+  refresh_secs = float(os.getenv('YF_SNAPSHOT_REFRESH_SECS', '0'))
+  progress = checkpoint.Checkpoint(db)
+
+  # Tickers (with cache in the main DB)
+  tickers_str = main_db.Get('YF_SNAPSHOT_TICKERS')
   if not tickers_str:
     tickers_str = EnsureEnv('YF_SNAPSHOT_TICKERS')
-    db.Set('YF_SNAPSHOT_TICKERS', tickers_str)
+    main_db.Set('YF_SNAPSHOT_TICKERS', tickers_str)
+  if db is not main_db:
+    main_db.Close()
+
+  # Kept across cycles: the limits learnt, and the tickers failing cycle after cycle, which are
+  # fetched last and retried less.
+  fetch_scheduler = scheduler.FetchScheduler(
+      scheduler.AimdController(
+          concurrency, rate_limit, max_concurrency=max_concurrency, max_rate=max_rate_limit,
+          latency_target_secs=latency_target_secs),
+      max_attempts=max_attempts, retry_budget=retry_budget, cycle_secs=cycle_secs)
 
   while True:
-    db = sqlite.ShardedSqliteStorage(db_path)
-    db_raw = sqlite.ShardedSqliteStorage(db_raw_path) if db_raw_path else None
-
-    errors = []
-    for t in tickers_str.split(','):
-      t = t.strip()
-      logging.info('Snapshotting %s' % t)
-      try:
-        TakeSnapshot(t, db, db_raw)
-      except:
-        errors.append(t)
-        logging.error(traceback.format_exc())
+    date_str = datetime.datetime.now().strftime('%Y-%m-%d')
+    progress.Prune(sqlite.GetDaysAgoStr(_CHECKPOINT_DAYS))
+    all_tickers = partition.Partition(
+        [t.strip() for t in tickers_str.split(',')], num_workers, worker_index)
+    tickers = progress.Pending(all_tickers, GROUPS, date_str, refresh_secs)
+    logging.info('Snapshotting %d of %d tickers' % (len(tickers), len(all_tickers)))
+
+    writer, writer_raw = CreateWriters(db, db_raw, batch_size, progress)
+
+    snapshot_pipeline = pipeline.Pipeline(
+        lambda t: FetchSnapshot(t, fetcher),
+        lambda t, client: ParseSnapshot(t, client, writer_raw is not None, date_str),
+        lambda t, parsed: WriteSnapshot(parsed[0], parsed[1], writer, writer_raw),
+        flush_fn=lambda: FlushWriters(writer, writer_raw),
+        concurrency=max_concurrency,
+        scheduler=fetch_scheduler)
+    cycle_start = time.time()
+    with metrics.Profile(profile, profile_path):
+      errors = snapshot_pipeline.Run(tickers)
+    progress.MarkFailed(errors, GROUPS, date_str)
+    _CYCLE_SECONDS.Set(time.time() - cycle_start)
+    _CYCLE_TIMESTAMP.Set(time.time())
+    _CYCLE_TICKERS.Set(len(tickers) - len(errors), status='ok')
+    _CYCLE_TICKERS.Set(len(errors), status='failed')
+    _CYCLE_TICKERS.Set(len(all_tickers) - len(tickers), status='skipped')
+    if metrics_path:
+      metrics.REGISTRY.Export(metrics_path)
 
     err_msg = 'Failed to snapshot: [%s]' % ','.join(errors)
 
     if oneshot_mode == 'FALSE':
+      db.Close()
+      if db_raw:
+        db_raw.Close()
       if errors:
         raise Exception(err_msg)
       else:
@@ -79,5 +258,30 @@ if __name__ == '__main__':
     else:
       if errors:
         logging.error(err_msg)
-      logging.info('Sleeping for 7200s...')
-      time.sleep(7200)
+      sleep_secs = max(0, cycle_start + cycle_secs - time.time())
+      logging.info('Sleeping for %ds...' % sleep_secs)
+      time.sleep(sleep_secs)
+
+if __name__ == '__main__':
+  logging.basicConfig(
+      format='%(asctime)s %(levelname)-8s %(message)s',
+      level=logging.INFO,
+      datefmt='%Y-%m-%d %H:%M:%S')
+
+  # Partitioning: the worker index is set for k8s Indexed Jobs; without it, all workers run as
+  # local processes.
+  num_workers = int(os.getenv('YF_SNAPSHOT_NUM_WORKERS', '1'))
+  worker_index = os.getenv('YF_SNAPSHOT_WORKER_INDEX', os.getenv('JOB_COMPLETION_INDEX', ''))
+  if num_workers > 1 and not worker_index:
+    workers = [
+        multiprocessing.Process(target=Main, args=(num_workers, i), name='worker-%d' % i)
+        for i in range(num_workers)]
+    for w in workers:
+      w.start()
+    for w in workers:
+      w.join()
+    failed = [w.name for w in workers if w.exitcode != 0]
+    if failed:
+      raise Exception('Failed workers: %s' % ','.join(failed))
+  else:
+    Main(num_workers, int(worker_index or '0'))
@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from analysis import fetch
+from analysis import yfinance_client
+from runner import pipeline
+from runner import snapshot
+from storage import checkpoint
+from storage import sqlite
+
+_FETCH_CACHE_DIR = os.path.join(
+    os.path.dirname(__file__), '..', 'analysis', 'testdata', 'fetch_cache', '2022-04-01')
+
+_DATE = '2022-04-01'
+
+
+class FixtureFetcher(fetch.Fetcher):
+
+  def Fetch(self, ticker: str) -> fetch.Response:
+    payloads = []
+    for endpoint in fetch.ENDPOINTS:
+      with open(os.path.join(_FETCH_CACHE_DIR, endpoint, 'AAPL.json'), 'rb') as f:
+        payloads.append(f.read())
+    return fetch.Response(ticker, *payloads)
+
+
+class Crash(Exception):
+  pass
+
+
+class TestSnapshot(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.tmp_dir, 'db'))
+    os.makedirs(os.path.join(self.tmp_dir, 'raw'))
+    self.db = sqlite.ShardedSqliteStorage(os.path.join(self.tmp_dir, 'db'))
+    self.db_raw = sqlite.ShardedSqliteStorage(os.path.join(self.tmp_dir, 'raw'))
+    self.progress = checkpoint.Checkpoint(self.db)
+
+  def tearDown(self) -> None:
+    self.db.Close()
+    self.db_raw.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def _Parse(self, ticker: str):
+    client = yfinance_client.YFinanceClient(ticker, FixtureFetcher())
+    return snapshot.ParseSnapshot(ticker, client, True, _DATE)
+
+  def testParseSnapshotDate(self):
+    rows, raw_rows = self._Parse('A')
+    self.assertEqual([row[1] for row in rows + raw_rows], [_DATE] * 4)
+    self.assertEqual([row[3] for row in rows], snapshot.GROUPS)
+
+  def testCrashAfterFlush(self):
+    writer, writer_raw = snapshot.CreateWriters(self.db, self.db_raw, 3, self.progress)
+    mark_rows = writer.on_flush
+    def MarkRowsAndCrash(rows):
+      mark_rows(rows)
+      raise Crash()
+    writer.on_flush = MarkRowsAndCrash
+    tickers = ['A', 'B', 'C']
+    with self.assertRaises(Crash):
+      for ticker in tickers:
+        rows, raw_rows = self._Parse(ticker)
+        snapshot.WriteSnapshot(rows, raw_rows, writer, writer_raw)
+
+    pending = self.progress.Pending(tickers, snapshot.GROUPS, _DATE)
+    done = [ticker for ticker in tickers if ticker not in pending]
+    self.assertEqual(done, ['A'])
+    for ticker in done:
+      for group in snapshot.GROUPS:
+        self.assertIsNotNone(self.db.Read(ticker, _DATE, group))
+        self.assertIsNotNone(self.db_raw.Read(ticker, _DATE, group))
+
+  def testFailedAfterFlush(self):
+    writer, writer_raw = snapshot.CreateWriters(self.db, self.db_raw, 2, self.progress)
+    write_many = self.db.WriteMany
+    def WriteMany(rows):
+      if any(row[0] != 'A' for row in rows):
+        raise IOError('disk full')
+      write_many(rows)
+    self.db.WriteMany = WriteMany
+    tickers = ['A', 'B', 'C']
+    errors = []
+    for ticker in tickers:
+      rows, raw_rows = self._Parse(ticker)
+      try:
+        snapshot.WriteSnapshot(rows, raw_rows, writer, writer_raw)
+      except IOError:
+        errors.append(ticker)
+    self.assertEqual(errors, ['B', 'C'])
+    # A failure reported for A, e.g. by a pipeline failing all items, keeps it done.
+    self.progress.MarkFailed(tickers, snapshot.GROUPS, _DATE)
+    self.assertEqual(self.progress.Pending(tickers, snapshot.GROUPS, _DATE), ['B', 'C'])
+
+  def testFinalFlushFailure(self):
+    writer, writer_raw = snapshot.CreateWriters(self.db, self.db_raw, 4, self.progress)
+    write_many = self.db.WriteMany
+    def WriteMany(rows):
+      if any(row[0] == 'C' for row in rows):
+        raise IOError('disk full')
+      write_many(rows)
+    self.db.WriteMany = WriteMany
+    p = pipeline.Pipeline(
+        lambda t: t, lambda t, fetched: self._Parse(t),
+        lambda t, parsed: snapshot.WriteSnapshot(parsed[0], parsed[1], writer, writer_raw),
+        flush_fn=lambda: snapshot.FlushWriters(writer, writer_raw), concurrency=1)
+    # A and B were committed by the flush of the second ticker.
+    self.assertEqual(p.Run(['A', 'B', 'C']), ['C'])
+    self.assertEqual(self.progress.Pending(['A', 'B', 'C'], snapshot.GROUPS, _DATE), ['C'])
+
+
+if __name__ == '__main__':
+  unittest.main()
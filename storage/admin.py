@@ -0,0 +1,129 @@
+"""Maintenance commands for a ShardedSqliteStorage directory.
+
+Usage:
+  bazel run storage:admin -- rebuild_latest /path/to/db
+  bazel run storage:admin -- recompress /path/to/db --compression=zstd --train_dict=yf.info
+  bazel run storage:admin -- gc /path/to/db
+  bazel run storage:admin -- seal /path/to/db --quarters=2021q1,2021q2
+  bazel run storage:admin -- merge_workers /path/to/db --delete --change_log
+  bazel run storage:admin -- backfill_features /path/to/db --quarters=2022q1
+"""
+import argparse
+import logging
+
+from analysis import features
+from storage import codec
+from storage import partition
+from storage import sqlite
+
+
+def RebuildLatest(args):
+  with sqlite.ShardedSqliteStorage(args.db_path) as db:
+    db.RebuildLatestIndex()
+
+
+def Recompress(args):
+  compression = codec.ParseCompression(args.compression) if args.compression else None
+  with sqlite.ShardedSqliteStorage(args.db_path, compression=compression) as db:
+    for group in filter(None, args.train_dict.split(',')):
+      db.TrainDictionary(group)
+    db.Recompress()
+
+
+def CollectGarbage(args):
+  with sqlite.ShardedSqliteStorage(args.db_path) as db:
+    db.CollectGarbage()
+
+
+def Seal(args):
+  compression = codec.ParseCompression(args.compression) if args.compression else None
+  quarters = list(filter(None, args.quarters.split(','))) or None
+  with sqlite.ShardedSqliteStorage(args.db_path, compression=compression) as db:
+    db.Seal(quarters)
+
+
+def MergeWorkers(args):
+  # Projects the merged rows into features, like the workers did.
+  with sqlite.ShardedSqliteStorage(
+      args.db_path, projections=features.PROJECTIONS, change_log=args.change_log) as db:
+    merged = partition.MergeWorkers(db, args.delete)
+  logging.info('Merged %d rows' % merged)
+
+
+def BackfillFeatures(args):
+  quarters = list(filter(None, args.quarters.split(','))) or None
+  with sqlite.ShardedSqliteStorage(
+      args.db_path, projections=features.PROJECTIONS, change_log=args.change_log) as db:
+    rows = db.BackfillFeatures(quarters)
+  logging.info('Projected %d rows into features' % rows)
+
+
+def ParseArgs(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  commands = parser.add_subparsers(dest='command')
+  commands.required = True
+
+  cmd = commands.add_parser(
+      'rebuild_latest', help='Reconstruct the latest-date index from existing shards.')
+  cmd.add_argument('db_path')
+  cmd.set_defaults(func=RebuildLatest)
+
+  cmd = commands.add_parser(
+      'recompress', help='Re-encode all shards in place with the configured codecs.')
+  cmd.add_argument('db_path')
+  cmd.add_argument(
+      '--compression', default='',
+      help='Codec specs, e.g. "zstd" or "yf.info=zstd,*=zlib". Defaults to zlib.')
+  cmd.add_argument(
+      '--train_dict', default='',
+      help='Comma separated groups to train a zstd dictionary for before recompressing.')
+  cmd.set_defaults(func=Recompress)
+
+  cmd = commands.add_parser(
+      'gc', help='Delete deduplicated values no longer referenced by any row.')
+  cmd.add_argument('db_path')
+  cmd.set_defaults(func=CollectGarbage)
+
+  cmd = commands.add_parser(
+      'seal', help='Rewrite closed quarter shards into immutable, read-optimized files.')
+  cmd.add_argument('db_path')
+  cmd.add_argument(
+      '--quarters', default='',
+      help='Comma separated quarters to seal, e.g. 2021q1. Defaults to all closed quarters.')
+  cmd.add_argument(
+      '--compression', default='',
+      help='Codec specs of the sealed values, e.g. "zstd". Defaults to zlib.')
+  cmd.set_defaults(func=Seal)
+
+  cmd = commands.add_parser(
+      'merge_workers', help='Write the rows of all partition worker storages into the storage.')
+  cmd.add_argument('db_path')
+  cmd.add_argument(
+      '--delete', action='store_true',
+      help='Delete the worker storages once merged. Workers must not be running.')
+  cmd.add_argument(
+      '--change_log', action='store_true',
+      help='Also log the changes of the merged rows, for workers run with the change log.')
+  cmd.set_defaults(func=MergeWorkers)
+
+  cmd = commands.add_parser(
+      'backfill_features', help='Project the existing yf.info and yf.analysis rows into features.')
+  cmd.add_argument('db_path')
+  cmd.add_argument(
+      '--quarters', default='',
+      help='Comma separated quarters to backfill. Defaults to all unsealed quarters.')
+  cmd.add_argument(
+      '--change_log', action='store_true',
+      help='Also log the changes of each row against the previous row of its ticker.')
+  cmd.set_defaults(func=BackfillFeatures)
+
+  return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(
+      format='%(asctime)s %(levelname)-8s %(message)s',
+      level=logging.INFO,
+      datefmt='%Y-%m-%d %H:%M:%S')
+  args = ParseArgs()
+  args.func(args)
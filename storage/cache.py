@@ -0,0 +1,221 @@
+"""In-process read-through cache of a ShardedSqliteStorage.
+
+CachedStorage keeps the values read by Read() and ReadLatest() in memory, keyed by (group, ticker,
+date), and the latest date of each (group, ticker). Values of groups with a decoder (a proto
+class) are cached decoded, so hot reads neither query SQLite nor parse the blob again:
+
+  db = cache.CachedStorage(
+      sqlite.ShardedSqliteStorage(db_dir, read_only=True), decoders=proto_fields.GROUP_MESSAGES)
+  info = db.ReadLatest('AAPL', 'yf.info')  # yfpb.Info, shared: do not modify it.
+
+Writes through the cache invalidate the written keys only. Writes by other processes (or other
+storage objects) are detected from the generation of the shard files (see
+ShardedSqliteStorage.FileGeneration()), checked at most every check_secs per shard: every cached
+value of a shard which changed is dropped. Other methods are passed to the storage uncached.
+"""
+import collections
+import threading
+import time
+from typing import Any, Dict, Iterable, Tuple
+
+from monitoring import metrics
+from storage import sqlite
+
+_DEFAULT_MAX_ENTRIES = 100000
+_DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+_DEFAULT_CHECK_SECS = 1.0
+
+# Approximate memory used by an entry besides its value.
+_ENTRY_OVERHEAD_BYTES = 200
+
+_LOOKUPS = metrics.Counter(
+    'yf_storage_cache_lookups_total', 'Cache lookups, by storage and result (hit or miss).')
+_EVICTIONS = metrics.Counter(
+    'yf_storage_cache_evictions_total', 'Entries evicted from the cache, by storage.')
+
+# (group, ticker, date), with a None date for the latest date of the ticker.
+Key = Tuple[str, str, str]
+
+
+class _Entry(object):
+  __slots__ = ('value', 'size', 'epoch')
+
+  def __init__(self, value: Any, size: int, epoch: int):
+    self.value = value
+    self.size = size
+    self.epoch = epoch
+
+
+class CachedStorage(object):
+  """Caches the reads of `db` in an LRU bounded by max_entries and max_bytes.
+
+  The size of an entry is the size of its stored value plus a fixed overhead, which approximates
+  the memory of decoded values. Missing values are not cached.
+  """
+
+  def __init__(
+      self, db: sqlite.ShardedSqliteStorage, max_entries: int = _DEFAULT_MAX_ENTRIES,
+      max_bytes: int = _DEFAULT_MAX_BYTES, decoders: Dict[str, Any] = None,
+      check_secs: float = _DEFAULT_CHECK_SECS, clock=time.monotonic):
+    self.db = db
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.decoders = decoders or {}
+    self.check_secs = check_secs
+    self._clock = clock
+    self._entries: Dict[Key, _Entry] = collections.OrderedDict()
+    # [generation, epoch, last check] of each shard, and of the system DB (None) which holds the
+    # latest dates. Entries of an older epoch are stale.
+    self._files: Dict[str, list] = {}
+    self._bytes = 0
+    # Incremented by each write, so reads which overlap a write do not cache what they read.
+    self._write_seq = 0
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.invalidations = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Close()
+
+  def __getattr__(self, name: str):
+    return getattr(self.db, name)
+
+  def Close(self):
+    self.Clear()
+    self.db.Close()
+
+  def Clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._files.clear()
+      self._bytes = 0
+
+  def Stats(self) -> Dict[str, int]:
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'invalidations': self.invalidations,
+        'entries': len(self._entries),
+        'bytes': self._bytes,
+      }
+
+  def _Epoch(self, q: str) -> int:
+    """Returns the epoch of the shard (system DB if None), checking its generation if due.
+
+    Requires self._lock.
+    """
+    now = self._clock()
+    state = self._files.get(q)
+    if state is None:
+      state = self._files[q] = [self.db.FileGeneration(q), 0, now]
+    elif now - state[2] >= self.check_secs:
+      state[2] = now
+      generation = self.db.FileGeneration(q)
+      if generation != state[0]:
+        state[0] = generation
+        state[1] += 1
+    return state[1]
+
+  def _Get(self, key: Key) -> Tuple[Any, int, int]:
+    """Returns (cached value or None, epoch, write sequence) of the key."""
+    q = sqlite.GetQuarter(key[2]) if key[2] else None
+    with self._lock:
+      epoch = self._Epoch(q)
+      entry = self._entries.get(key)
+      if entry is not None and entry.epoch != epoch:
+        self._Remove(key)
+        self.invalidations += 1
+        entry = None
+      if entry is None:
+        self.misses += 1
+        _LOOKUPS.Inc(db=self.db.db_dir, result='miss')
+        return None, epoch, self._write_seq
+      self._entries.move_to_end(key)
+      self.hits += 1
+      _LOOKUPS.Inc(db=self.db.db_dir, result='hit')
+      return entry.value, epoch, self._write_seq
+
+  def _Put(self, key: Key, value: Any, size: int, epoch: int, write_seq: int):
+    """Caches a value read at the given epoch, unless a write happened since the read began."""
+    size += _ENTRY_OVERHEAD_BYTES
+    with self._lock:
+      if write_seq != self._write_seq or size > self.max_bytes:
+        return
+      self._Remove(key)
+      self._entries[key] = _Entry(value, size, epoch)
+      self._bytes += size
+      while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+        self._Remove(next(iter(self._entries)))
+        self.evictions += 1
+        _EVICTIONS.Inc(db=self.db.db_dir)
+
+  def _Remove(self, key: Key):
+    """Removes the key if cached. Requires self._lock."""
+    entry = self._entries.pop(key, None)
+    if entry is not None:
+      self._bytes -= entry.size
+
+  def _Invalidate(self, keys: Iterable[Tuple[str, str, str]]):
+    """Drops the cached values and latest dates of written (group, ticker, date) keys."""
+    with self._lock:
+      self._write_seq += 1
+      quarters = set([None])
+      for group, ticker, date_str in keys:
+        self._Remove((group, ticker, date_str))
+        self._Remove((group, ticker, None))
+        quarters.add(sqlite.GetQuarter(date_str))
+      # The new generation of the files is this process's own write: keep their other entries.
+      # A concurrent write of another process to the same files is missed until the next one.
+      for q in quarters:
+        state = self._files.get(q)
+        if state is not None:
+          state[0] = self.db.FileGeneration(q)
+          state[2] = self._clock()
+
+  def Read(self, ticker: str, date_str: str, group='analysis') -> Any:
+    """Returns the value of the ticker on the date, decoded if its group has a decoder."""
+    key = (group, ticker, date_str)
+    value, epoch, write_seq = self._Get(key)
+    if value is not None:
+      return value
+    data = self.db.Read(ticker, date_str, group)
+    if data is None:
+      return None
+    decoder = self.decoders.get(group)
+    value = decoder.FromString(data) if decoder else data
+    self._Put(key, value, len(data), epoch, write_seq)
+    return value
+
+  def ReadLatestDate(self, ticker: str, group='analysis') -> str:
+    key = (group, ticker, None)
+    date_str, epoch, write_seq = self._Get(key)
+    if date_str is not None:
+      return date_str
+    date_str = self.db.ReadLatestDate(ticker, group)
+    if date_str is not None:
+      self._Put(key, date_str, len(date_str), epoch, write_seq)
+    return date_str
+
+  def ReadLatest(self, ticker: str, group='analysis') -> Any:
+    latest_date = self.ReadLatestDate(ticker, group)
+    return self.Read(ticker, latest_date, group) if latest_date else None
+
+  def Write(self, ticker: str, date_str: str, data: bytes, group='analysis'):
+    try:
+      self.db.Write(ticker, date_str, data, group)
+    finally:
+      self._Invalidate([(group, ticker, date_str)])
+
+  def WriteMany(self, rows: Iterable[sqlite.Row]):
+    rows = list(rows)
+    try:
+      self.db.WriteMany(rows)
+    finally:
+      self._Invalidate([(group, ticker, date_str) for ticker, date_str, _, group in rows])
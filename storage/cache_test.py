@@ -0,0 +1,120 @@
+import shutil
+import tempfile
+import unittest
+
+from protos import yfinance_pb2 as yfpb
+from storage import cache
+from storage import sqlite
+
+
+def Info(price_target: float) -> bytes:
+  info = yfpb.Info()
+  info.price_target.average = price_target
+  return info.SerializeToString()
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self) -> float:
+    return self.now
+
+
+class CountingStorage(sqlite.ShardedSqliteStorage):
+  """Counts the reads which reach the storage."""
+
+  def __init__(self, *args, **kwargs):
+    super().__init__(*args, **kwargs)
+    self.reads = 0
+
+  def Read(self, *args):
+    self.reads += 1
+    return super().Read(*args)
+
+
+class TestCachedStorage(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.clock = FakeClock()
+    self.storage = CountingStorage(self.tmp_dir)
+    self.db = cache.CachedStorage(
+        self.storage, decoders={'yf.info': yfpb.Info}, clock=self.clock)
+    self.db.WriteMany([
+      ('A', '2022-03-30', Info(10.0), 'yf.info'),
+      ('A', '2022-04-01', Info(11.0), 'yf.info'),
+      ('B', '2022-03-30', b'raw', 'raw.info'),
+    ])
+
+  def tearDown(self) -> None:
+    self.db.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def testReadThrough(self):
+    info = self.db.Read('A', '2022-03-30', 'yf.info')
+    self.assertEqual(info.price_target.average, 10.0)
+    self.assertIs(self.db.Read('A', '2022-03-30', 'yf.info'), info)
+    self.assertEqual(self.db.Read('B', '2022-03-30', 'raw.info'), b'raw')
+    self.assertEqual(self.db.ReadLatest('A', 'yf.info').price_target.average, 11.0)
+    self.assertEqual(self.db.ReadLatest('A', 'yf.info').price_target.average, 11.0)
+    self.assertIsNone(self.db.Read('C', '2022-03-30', 'yf.info'))
+    self.assertEqual(self.storage.reads, 4)
+    stats = self.db.Stats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (3, 5, 4))
+
+  def testWriteInvalidatesWrittenKeys(self):
+    self.db.Read('A', '2022-03-30', 'yf.info')
+    self.assertEqual(self.db.ReadLatest('A', 'yf.info').price_target.average, 11.0)
+    self.db.Write('A', '2022-04-04', Info(12.0), 'yf.info')
+    self.clock.now += 10
+    self.assertEqual(self.db.ReadLatest('A', 'yf.info').price_target.average, 12.0)
+    self.db.WriteMany([('A', '2022-04-01', Info(13.0), 'yf.info')])
+    self.clock.now += 10
+    self.assertEqual(self.db.Read('A', '2022-04-01', 'yf.info').price_target.average, 13.0)
+    # Values of the written shards which were not written stay cached.
+    reads = self.storage.reads
+    self.db.Read('A', '2022-03-30', 'yf.info')
+    self.assertEqual(self.storage.reads, reads)
+    self.assertEqual(self.db.Stats()['invalidations'], 0)
+
+  def testOtherWriterInvalidatesShard(self):
+    self.db.Read('A', '2022-03-30', 'yf.info')
+    self.db.Read('A', '2022-04-01', 'yf.info')
+    with sqlite.ShardedSqliteStorage(self.tmp_dir) as other:
+      other.Write('A', '2022-04-01', Info(20.0), 'yf.info')
+    # The generation is checked at most every check_secs.
+    self.assertEqual(self.db.Read('A', '2022-04-01', 'yf.info').price_target.average, 11.0)
+    self.clock.now += 10
+    self.assertEqual(self.db.Read('A', '2022-04-01', 'yf.info').price_target.average, 20.0)
+    reads = self.storage.reads
+    self.db.Read('A', '2022-03-30', 'yf.info')
+    self.assertEqual(self.storage.reads, reads)
+    self.assertEqual(self.db.Stats()['invalidations'], 1)
+
+  def testEviction(self):
+    db = cache.CachedStorage(self.storage, max_entries=2)
+    db.Read('A', '2022-03-30', 'yf.info')
+    db.Read('A', '2022-04-01', 'yf.info')
+    db.Read('A', '2022-03-30', 'yf.info')
+    db.Read('B', '2022-03-30', 'raw.info')
+    self.assertEqual(db.Stats()['evictions'], 1)
+    reads = self.storage.reads
+    db.Read('A', '2022-03-30', 'yf.info')
+    self.assertEqual(self.storage.reads, reads)
+    db.Read('A', '2022-04-01', 'yf.info')
+    self.assertEqual(self.storage.reads, reads + 1)
+
+    db = cache.CachedStorage(self.storage, max_bytes=cache._ENTRY_OVERHEAD_BYTES + 20)
+    db.Read('A', '2022-03-30', 'yf.info')
+    db.Read('B', '2022-03-30', 'raw.info')
+    self.assertEqual(db.Stats()['entries'], 1)
+    self.assertLessEqual(db.Stats()['bytes'], db.max_bytes)
+
+  def testPassThrough(self):
+    self.assertEqual(self.db.ListQuarters(), ['2022q1', '2022q2'])
+
+
+if __name__ == '__main__':
+  unittest.main()
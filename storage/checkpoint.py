@@ -0,0 +1,140 @@
+"""Progress of snapshot cycles, kept in the system DB of a ShardedSqliteStorage.
+
+Each (ticker, group, date) processed by a cycle is recorded as done or failed, with the time it was
+recorded. A restarted or repeated cycle then only processes the tickers missing a group for the
+day, unless their data is older than the refresh interval.
+
+ShardProgress records the position of longer jobs, like reprocessing, in each shard they read.
+"""
+import time
+from typing import Iterable, List, Tuple
+
+from storage import sqlite
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class Checkpoint(object):
+
+  def __init__(self, db: sqlite.ShardedSqliteStorage, clock=time.time):
+    self.db = db
+    self._clock = clock
+    with db.System() as con:
+      con.execute('''
+      CREATE TABLE IF NOT EXISTS checkpoint
+      (ticker text, grp text, date text, status text, updated real,
+       PRIMARY KEY(ticker, grp, date))
+      ''')
+      con.commit()
+
+  def _Mark(self, tickers: Iterable[str], groups: Iterable[str], date_str: str, status: str):
+    """Records the status, except failures of (ticker, group, date) already done."""
+    now = self._clock()
+    groups = list(groups)
+    with self.db.System() as con:
+      con.executemany(
+          '''INSERT INTO checkpoint VALUES (?, ?, ?, ?, ?)
+          ON CONFLICT(ticker, grp, date) DO UPDATE
+          SET status = excluded.status, updated = excluded.updated
+          WHERE excluded.status = ? OR checkpoint.status != ?''',
+          ((ticker, group, date_str, status, now, STATUS_DONE, STATUS_DONE)
+           for ticker in tickers for group in groups))
+      con.commit()
+
+  def MarkDone(self, tickers: Iterable[str], groups: Iterable[str], date_str: str):
+    self._Mark(tickers, groups, date_str, STATUS_DONE)
+
+  def MarkFailed(self, tickers: Iterable[str], groups: Iterable[str], date_str: str):
+    """Marks the groups of the tickers failed, unless their rows were already done."""
+    self._Mark(tickers, groups, date_str, STATUS_FAILED)
+
+  def MarkRows(self, rows: Iterable[sqlite.Row]):
+    """Marks the (ticker, date, data, group) rows as done, e.g. as BatchWriter on_flush."""
+    now = self._clock()
+    with self.db.System() as con:
+      con.executemany(
+          'INSERT OR REPLACE INTO checkpoint VALUES (?, ?, ?, ?, ?)',
+          ((ticker, group, date_str, STATUS_DONE, now) for ticker, date_str, _, group in rows))
+      con.commit()
+
+  def Pending(
+      self, tickers: Iterable[str], groups: Iterable[str], date_str: str,
+      refresh_secs: float = 0) -> List[str]:
+    """Returns the tickers to process for the date, in input order.
+
+    A ticker is pending unless all its groups are done for the date. With `refresh_secs`, tickers
+    done more than refresh_secs ago are pending again.
+    """
+    groups = set(groups)
+    min_updated = self._clock() - refresh_secs if refresh_secs else None
+    done = {}
+    with self.db.System() as con:
+      for ticker, group, updated in con.execute(
+          'SELECT ticker, grp, updated FROM checkpoint WHERE date = ? AND status = ?;',
+          (date_str, STATUS_DONE)):
+        if group in groups and (min_updated is None or updated >= min_updated):
+          done.setdefault(ticker, set()).add(group)
+    return [t for t in tickers if done.get(t, set()) != groups]
+
+  def Prune(self, before_date: str) -> int:
+    """Deletes the checkpoints of dates before before_date. Returns the number of rows deleted."""
+    with self.db.System() as con:
+      cur = con.execute('DELETE FROM checkpoint WHERE date < ?;', (before_date,))
+      con.commit()
+      return cur.rowcount
+
+
+class ShardProgress(object):
+  """Position of a job in each quarter shard it reads in (group, ticker, date) order.
+
+  An interrupted job resumes after the last position it saved for each quarter, and skips the
+  quarters it marked done. Several processes can save the positions of different quarters.
+  """
+
+  def __init__(self, db: sqlite.ShardedSqliteStorage, job: str, clock=time.time):
+    self.db = db
+    self.job = job
+    self._clock = clock
+    with db.System() as con:
+      con.execute('''
+      CREATE TABLE IF NOT EXISTS shard_progress
+      (job text, quarter text, grp text, ticker text, date text, done integer, updated real,
+       PRIMARY KEY(job, quarter))
+      ''')
+      con.commit()
+
+  def Position(self, q: str) -> Tuple[str, str, str]:
+    """Returns the last saved (group, ticker, date) of the quarter, or None."""
+    with self.db.System() as con:
+      row = con.execute(
+          'SELECT grp, ticker, date FROM shard_progress WHERE job = ? AND quarter = ?;',
+          (self.job, q)).fetchone()
+    return tuple(row) if row and row[0] is not None else None
+
+  def Save(self, q: str, position: Tuple[str, str, str], done: bool = False):
+    """Saves the last processed (group, ticker, date) of the quarter, None if it had no rows."""
+    group, ticker, date_str = position or (None, None, None)
+    with self.db.System() as con:
+      con.execute(
+          'INSERT OR REPLACE INTO shard_progress VALUES (?, ?, ?, ?, ?, ?, ?)',
+          (self.job, q, group, ticker, date_str, int(done), self._clock()))
+      con.commit()
+
+  def Done(self) -> List[str]:
+    """Returns the quarters marked done, in order."""
+    with self.db.System() as con:
+      return [q for q, in con.execute(
+          'SELECT quarter FROM shard_progress WHERE job = ? AND done ORDER BY quarter;',
+          (self.job,))]
+
+  def Reset(self, quarters: Iterable[str] = None):
+    """Forgets the positions of the quarters (all by default)."""
+    with self.db.System() as con:
+      if quarters is None:
+        con.execute('DELETE FROM shard_progress WHERE job = ?;', (self.job,))
+      else:
+        con.executemany(
+            'DELETE FROM shard_progress WHERE job = ? AND quarter = ?;',
+            ((self.job, q) for q in quarters))
+      con.commit()
@@ -0,0 +1,96 @@
+import shutil
+import tempfile
+import unittest
+
+from storage import checkpoint
+from storage import sqlite
+
+_GROUPS = ['yf.analysis', 'yf.info']
+_DATE = '2022-04-01'
+
+
+class TestCheckpoint(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.storage = sqlite.ShardedSqliteStorage(self.tmp_dir)
+    self.now = [1000.0]
+    self.checkpoint = checkpoint.Checkpoint(self.storage, clock=lambda: self.now[0])
+
+  def tearDown(self) -> None:
+    self.storage.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def testPending(self):
+    tickers = ['A', 'B', 'C', 'D']
+    self.assertEqual(self.checkpoint.Pending(tickers, _GROUPS, _DATE), tickers)
+    self.checkpoint.MarkDone(['A'], _GROUPS, _DATE)
+    self.checkpoint.MarkRows([('B', _DATE, b'', 'yf.info'), ('C', _DATE, b'', 'yf.info')])
+    self.checkpoint.MarkRows([('C', _DATE, b'', 'yf.analysis')])
+    self.checkpoint.MarkFailed(['D'], _GROUPS, _DATE)
+    self.assertEqual(self.checkpoint.Pending(tickers, _GROUPS, _DATE), ['B', 'D'])
+    self.assertEqual(self.checkpoint.Pending(tickers, _GROUPS, '2022-04-02'), tickers)
+
+  def testFailureAfterDone(self):
+    # Rows committed and checkpointed earlier in the cycle stay done.
+    self.checkpoint.MarkDone(['A'], _GROUPS, _DATE)
+    self.checkpoint.MarkRows([('B', _DATE, b'', 'yf.info')])
+    self.checkpoint.MarkFailed(['A', 'B'], _GROUPS, _DATE)
+    self.assertEqual(self.checkpoint.Pending(['A', 'B'], _GROUPS, _DATE), ['B'])
+    self.checkpoint.MarkRows([('B', _DATE, b'', 'yf.analysis')])
+    self.assertEqual(self.checkpoint.Pending(['A', 'B'], _GROUPS, _DATE), [])
+
+  def testRefresh(self):
+    self.checkpoint.MarkDone(['A'], _GROUPS, _DATE)
+    self.now[0] += 600
+    self.checkpoint.MarkDone(['B'], _GROUPS, _DATE)
+    self.now[0] += 600
+    self.assertEqual(self.checkpoint.Pending(['A', 'B'], _GROUPS, _DATE, refresh_secs=0), [])
+    self.assertEqual(
+        self.checkpoint.Pending(['A', 'B'], _GROUPS, _DATE, refresh_secs=900), ['A'])
+
+  def testPersisted(self):
+    self.checkpoint.MarkDone(['A'], _GROUPS, _DATE)
+    self.storage.Close()
+    self.storage = sqlite.ShardedSqliteStorage(self.tmp_dir)
+    progress = checkpoint.Checkpoint(self.storage)
+    self.assertEqual(progress.Pending(['A', 'B'], _GROUPS, _DATE), ['B'])
+
+  def testPrune(self):
+    self.checkpoint.MarkDone(['A'], _GROUPS, '2022-03-01')
+    self.checkpoint.MarkDone(['A'], _GROUPS, _DATE)
+    self.assertEqual(self.checkpoint.Prune('2022-03-15'), 2)
+    self.assertEqual(self.checkpoint.Pending(['A'], _GROUPS, _DATE), [])
+    self.assertEqual(self.checkpoint.Pending(['A'], _GROUPS, '2022-03-01'), ['A'])
+
+
+class TestShardProgress(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.storage = sqlite.ShardedSqliteStorage(self.tmp_dir)
+    self.progress = checkpoint.ShardProgress(self.storage, 'job')
+
+  def tearDown(self) -> None:
+    self.storage.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def testPositions(self):
+    self.assertIsNone(self.progress.Position('2022q1'))
+    self.progress.Save('2022q1', ('yf.info', 'A', '2022-01-03'))
+    self.progress.Save('2022q2', ('yf.info', 'B', '2022-04-01'), done=True)
+    self.progress.Save('2022q3', None, done=True)
+    self.assertEqual(self.progress.Position('2022q1'), ('yf.info', 'A', '2022-01-03'))
+    self.assertIsNone(self.progress.Position('2022q3'))
+    self.assertEqual(self.progress.Done(), ['2022q2', '2022q3'])
+    self.assertEqual(checkpoint.ShardProgress(self.storage, 'other').Done(), [])
+
+    self.progress.Reset(['2022q2'])
+    self.assertEqual(self.progress.Done(), ['2022q3'])
+    self.progress.Reset()
+    self.assertIsNone(self.progress.Position('2022q1'))
+    self.assertEqual(self.progress.Done(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,154 @@
+"""Codecs for blobs stored in SqliteStorage.
+
+An encoded blob starts with a header byte naming its codec. Header bytes have an invalid protobuf
+wire type (6 or 7) in their low bits, so they never start a serialized proto or a JSON document:
+rows written before compression was enabled are read back unchanged. Raw blobs that happen to
+start with a header byte are escaped with HEADER_RAW.
+
+zstd requires the optional `zstandard` package and can use a trained dictionary. Dictionaries are
+registered by their id, which zstd records in each frame, so any registered dictionary is found
+when decoding.
+"""
+import logging
+import threading
+import zlib
+from typing import Dict, Iterable
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+HEADER_RAW = 0xF7
+HEADER_ZLIB = 0xFE
+HEADER_ZSTD = 0xFF
+_HEADERS = frozenset([HEADER_RAW, HEADER_ZLIB, HEADER_ZSTD])
+
+# Codec spec of each group; '*' applies to groups not listed.
+DEFAULT_COMPRESSION = {'*': 'zlib', 'system': 'none'}
+
+_DEFAULT_ZLIB_LEVEL = 6
+_DEFAULT_ZSTD_LEVEL = 3
+_DEFAULT_DICT_SIZE = 112640
+
+# Registered zstd dictionaries, by dictionary id.
+_ZSTD_DICTS: Dict[int, 'zstandard.ZstdCompressionDict'] = {}
+_ZSTD_DICTS_LOCK = threading.Lock()
+_local = threading.local()
+
+
+class Codec(object):
+  """Stores blobs uncompressed."""
+  name = 'none'
+
+  def Encode(self, data: bytes) -> bytes:
+    if data and data[0] in _HEADERS:
+      return bytes([HEADER_RAW]) + data
+    return data
+
+  def __repr__(self):
+    return '%s()' % type(self).__name__
+
+
+class ZlibCodec(Codec):
+  name = 'zlib'
+
+  def __init__(self, level: int = _DEFAULT_ZLIB_LEVEL):
+    self.level = level
+
+  def Encode(self, data: bytes) -> bytes:
+    return bytes([HEADER_ZLIB]) + zlib.compress(data, self.level)
+
+
+class ZstdCodec(Codec):
+  name = 'zstd'
+
+  def __init__(self, level: int = _DEFAULT_ZSTD_LEVEL, dictionary: bytes = None):
+    if zstandard is None:
+      raise ImportError('zstd compression requires the zstandard package')
+    self.level = level
+    self.dict_id = RegisterZstdDictionary(dictionary) if dictionary else 0
+    self._local = threading.local()
+
+  def Encode(self, data: bytes) -> bytes:
+    # Compressors are not thread-safe, keep one per thread.
+    compressor = getattr(self._local, 'compressor', None)
+    if compressor is None:
+      compressor = zstandard.ZstdCompressor(
+          level=self.level, dict_data=_ZSTD_DICTS.get(self.dict_id), write_content_size=True)
+      self._local.compressor = compressor
+    return bytes([HEADER_ZSTD]) + compressor.compress(data)
+
+  def __repr__(self):
+    return 'ZstdCodec(level=%d, dict_id=%d)' % (self.level, self.dict_id)
+
+
+def RegisterZstdDictionary(dictionary: bytes) -> int:
+  """Makes the dictionary available for decoding and returns its id."""
+  zstd_dict = zstandard.ZstdCompressionDict(dictionary)
+  dict_id = zstd_dict.dict_id()
+  with _ZSTD_DICTS_LOCK:
+    _ZSTD_DICTS.setdefault(dict_id, zstd_dict)
+  return dict_id
+
+
+def TrainZstdDictionary(samples: Iterable[bytes], dict_size: int = _DEFAULT_DICT_SIZE) -> bytes:
+  """Returns a zstd dictionary trained on the sample blobs."""
+  if zstandard is None:
+    raise ImportError('zstd compression requires the zstandard package')
+  return zstandard.train_dictionary(dict_size, list(samples)).as_bytes()
+
+
+def Decode(blob):
+  """Returns the original data of an encoded blob. Non-bytes values are returned as is."""
+  if not isinstance(blob, bytes) or not blob or blob[0] not in _HEADERS:
+    return blob
+  header = blob[0]
+  if header == HEADER_ZLIB:
+    return zlib.decompress(blob[1:])
+  if header == HEADER_ZSTD:
+    return _DecompressZstd(blob[1:])
+  return blob[1:]
+
+
+def _DecompressZstd(data: bytes) -> bytes:
+  if zstandard is None:
+    raise ImportError('Reading zstd compressed data requires the zstandard package')
+  dict_id = zstandard.get_frame_parameters(data).dict_id
+  decompressors = getattr(_local, 'decompressors', None)
+  if decompressors is None:
+    decompressors = _local.decompressors = {}
+  decompressor = decompressors.get(dict_id)
+  if decompressor is None:
+    if dict_id and dict_id not in _ZSTD_DICTS:
+      raise ValueError('Unknown zstd dictionary: %d' % dict_id)
+    decompressor = zstandard.ZstdDecompressor(dict_data=_ZSTD_DICTS.get(dict_id))
+    decompressors[dict_id] = decompressor
+  return decompressor.decompress(data)
+
+
+def Create(spec: str, dictionary: bytes = None) -> Codec:
+  """Returns the codec for a spec like 'none', 'zlib', 'zlib:9', 'zstd' or 'zstd:19'."""
+  name, _, level = spec.partition(':')
+  if name == 'none':
+    return Codec()
+  if name == 'zlib':
+    return ZlibCodec(int(level) if level else _DEFAULT_ZLIB_LEVEL)
+  if name == 'zstd':
+    if zstandard is None:
+      logging.warning('zstandard is not installed, using zlib instead of %s' % spec)
+      return ZlibCodec()
+    return ZstdCodec(int(level) if level else _DEFAULT_ZSTD_LEVEL, dictionary)
+  raise ValueError('Unknown codec: %s' % spec)
+
+
+def ParseCompression(spec: str) -> Dict[str, str]:
+  """Parses 'zstd' or 'yf.info=zstd,yf.analysis=zstd:9,*=zlib' into codec specs by group."""
+  compression = dict(DEFAULT_COMPRESSION)
+  for part in spec.split(','):
+    part = part.strip()
+    if not part:
+      continue
+    group, _, codec_spec = part.rpartition('=')
+    compression[group or '*'] = codec_spec
+  return compression
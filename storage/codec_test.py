@@ -0,0 +1,62 @@
+import unittest
+
+from storage import codec
+
+_JSON = b'{"totalRevenue": 1000, "totalCash": 2000, "currency": "USD"}'
+_PROTO = b'\x1a\t\t\x00\x00\x00\x00\x00\x00\x08@'
+
+
+class TestCodec(unittest.TestCase):
+
+  def testNone(self):
+    c = codec.Create('none')
+    self.assertEqual(c.Encode(_JSON), _JSON)
+    self.assertEqual(codec.Decode(c.Encode(_JSON)), _JSON)
+
+  def testRawWithHeaderByteIsEscaped(self):
+    c = codec.Create('none')
+    data = bytes([codec.HEADER_ZLIB]) + b'data'
+    self.assertEqual(c.Encode(data), bytes([codec.HEADER_RAW]) + data)
+    self.assertEqual(codec.Decode(c.Encode(data)), data)
+
+  def testZlib(self):
+    encoded = codec.Create('zlib:9').Encode(_JSON * 10)
+    self.assertEqual(encoded[0], codec.HEADER_ZLIB)
+    self.assertLess(len(encoded), len(_JSON * 10))
+    self.assertEqual(codec.Decode(encoded), _JSON * 10)
+
+  @unittest.skipIf(codec.zstandard is None, 'zstandard is not installed')
+  def testZstd(self):
+    encoded = codec.Create('zstd').Encode(_PROTO)
+    self.assertEqual(encoded[0], codec.HEADER_ZSTD)
+    self.assertEqual(codec.Decode(encoded), _PROTO)
+
+  @unittest.skipIf(codec.zstandard is None, 'zstandard is not installed')
+  def testZstdDictionary(self):
+    samples = [
+        b'{"ticker": "T%d", "totalRevenue": %d, "totalCash": %d}' % (i, i * 7, i * 13)
+        for i in range(1000)]
+    dictionary = codec.TrainZstdDictionary(samples, dict_size=4096)
+    c = codec.Create('zstd', dictionary)
+    self.assertTrue(c.dict_id)
+    encoded = c.Encode(samples[0])
+    self.assertLess(len(encoded), len(codec.Create('zstd').Encode(samples[0])))
+    self.assertEqual(codec.Decode(encoded), samples[0])
+
+  def testDecodeLegacyValues(self):
+    for value in [_JSON, _PROTO, b'', None, 'text']:
+      self.assertEqual(codec.Decode(value), value)
+
+  def testParseCompression(self):
+    self.assertEqual(codec.ParseCompression(''), codec.DEFAULT_COMPRESSION)
+    self.assertEqual(
+      codec.ParseCompression('zstd, yf.info=zlib:9'),
+      {'*': 'zstd', 'system': 'none', 'yf.info': 'zlib:9'})
+
+  def testUnknownCodec(self):
+    with self.assertRaises(ValueError):
+      codec.Create('lz4')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+"""Bulk export of a snapshot DB to JSON lines or Parquet files, in bounded memory.
+
+Each quarter shard is streamed by a worker process (see ShardedSqliteStorage.Rows) and written in
+record batches of batch_size rows, so memory use does not grow with the history. Each group of a
+quarter is written to its own Hive-style partition, which readers can prune by group and quarter:
+
+  <output dir>/group=yf.info/quarter=2022q1/part-00000.parquet
+
+jsonl rows are the JSON lines of yfsnap, {"ticker", "date", "group", "data"} with protos decoded
+to JSON objects. parquet rows have `ticker` and `date` columns, then for proto groups a float64
+column per numeric field path (see proto_fields.Flatten), e.g. `price_target.average`, and for
+other groups a binary `data` column. Each batch is a row group, whose column statistics allow
+predicate pushdown. A batch with fields missing from the schema of the current part file starts a
+new part: the schema of the last part of a partition is the union of all of its parts. Parts, and
+partitions, thus have different schemas, and pyarrow.dataset.dataset() would read all parts with
+the schema of the first one, dropping the other columns: read them with Dataset(), whose schema is
+the union of the schemas of all parts. parquet requires the optional `pyarrow` package:
+
+  dataset = export.Dataset(output_dir)
+  table = dataset.to_table(filter=pyarrow.dataset.field('ticker') == 'AAPL')
+
+Usage:
+  bazel run storage:export -- $YF_SNAPSHOT_DB_PATH /tmp/export --format=parquet
+  bazel run storage:export -- $YF_SNAPSHOT_DB_PATH /tmp/export --quarters=2022q1 --groups=yf.info
+
+Partitions are replaced: part files are written under a temporary name and renamed when complete.
+"""
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Tuple
+
+from analysis import proto_fields
+from storage import sqlite
+from storage import yfsnap
+
+try:
+  import pyarrow
+  import pyarrow.dataset
+  import pyarrow.parquet
+except ImportError:
+  pyarrow = None
+
+JSONL = 'jsonl'
+PARQUET = 'parquet'
+
+_DEFAULT_BATCH_SIZE = 1000
+
+# (ticker, date, data) rows of a partition.
+Batch = List[Tuple[str, str, bytes]]
+Result = Dict[str, Any]
+
+
+def PartitionDir(output_dir: str, group: str, q: str) -> str:
+  return os.path.join(output_dir, 'group=%s' % group, 'quarter=%s' % q)
+
+
+class JsonlWriter(object):
+  """Writes the rows of a partition as JSON lines to a single part file."""
+
+  def __init__(self, dir_path: str, group: str):
+    self.group = group
+    self.paths = [os.path.join(dir_path, 'part-00000.jsonl')]
+    self._out = open(self.paths[0] + '.tmp', 'w')
+
+  def Write(self, batch: Batch):
+    self._out.write(''.join(
+        json.dumps(yfsnap.Record(ticker, date_str, self.group, data), sort_keys=True) + '\n'
+        for ticker, date_str, data in batch))
+
+  def Close(self):
+    self._out.close()
+    os.replace(self.paths[0] + '.tmp', self.paths[0])
+
+
+class ParquetWriter(object):
+  """Writes the rows of a partition as Parquet part files, one row group per batch."""
+
+  def __init__(self, dir_path: str, group: str):
+    if pyarrow is None:
+      raise ImportError('Parquet export requires the pyarrow package')
+    self.dir_path = dir_path
+    self.group = group
+    self.message_class = proto_fields.GROUP_MESSAGES.get(group)
+    self.paths: List[str] = []
+    # Field path columns, in the order they were first seen.
+    self.fields: List[str] = []
+    self._writer = None
+
+  def _NextPart(self):
+    self._ClosePart()
+    schema = [('ticker', pyarrow.string()), ('date', pyarrow.string())]
+    if self.message_class is None:
+      schema.append(('data', pyarrow.binary()))
+    else:
+      schema += [(path, pyarrow.float64()) for path in self.fields]
+    self.paths.append(os.path.join(self.dir_path, 'part-%05d.parquet' % len(self.paths)))
+    self._writer = pyarrow.parquet.ParquetWriter(self.paths[-1] + '.tmp', pyarrow.schema(schema))
+
+  def _ClosePart(self):
+    if self._writer is not None:
+      self._writer.close()
+      os.replace(self.paths[-1] + '.tmp', self.paths[-1])
+      self._writer = None
+
+  def Write(self, batch: Batch):
+    columns = [[ticker for ticker, _, _ in batch], [date_str for _, date_str, _ in batch]]
+    if self.message_class is None:
+      columns.append([data for _, _, data in batch])
+    else:
+      values = [dict(proto_fields.Flatten(self.message_class.FromString(data)))
+                for _, _, data in batch]
+      known = set(self.fields)
+      new_fields = [path for row in values for path in row if path not in known]
+      if new_fields:
+        self.fields += list(collections.OrderedDict.fromkeys(new_fields))
+        self._ClosePart()
+      columns += [[row.get(path) for row in values] for path in self.fields]
+    if self._writer is None:
+      self._NextPart()
+    self._writer.write_table(pyarrow.Table.from_arrays(
+        [pyarrow.array(column, type=field.type)
+         for column, field in zip(columns, self._writer.schema)],
+        schema=self._writer.schema))
+
+  def Close(self):
+    self._ClosePart()
+
+
+def Schema(output_dir: str):
+  """Returns the union of the schemas of the Parquet parts of output_dir and of its partitions.
+
+  Only the footers of the parts are read.
+  """
+  if pyarrow is None:
+    raise ImportError('Parquet export requires the pyarrow package')
+  paths = sorted(glob.glob(os.path.join(output_dir, 'group=*', 'quarter=*', 'part-*.parquet')))
+  partitions = pyarrow.schema([('group', pyarrow.string()), ('quarter', pyarrow.string())])
+  return pyarrow.unify_schemas(
+      [pyarrow.parquet.read_schema(path) for path in paths] + [partitions])
+
+
+def Dataset(output_dir: str):
+  """Returns the pyarrow dataset of a Parquet export, with the schema of all of its parts.
+
+  Columns missing from a part read as nulls.
+  """
+  return pyarrow.dataset.dataset(
+      output_dir, schema=Schema(output_dir), format='parquet', partitioning='hive')
+
+
+_WRITERS = {
+  JSONL: JsonlWriter,
+  PARQUET: ParquetWriter,
+}
+
+
+def ExportQuarter(
+    db_dir: str, output_dir: str, q: str, groups: Iterable[str] = None, fmt: str = JSONL,
+    batch_size: int = _DEFAULT_BATCH_SIZE) -> Result:
+  """Exports the rows of a quarter, in the calling process. See the module doc."""
+  groups = set(groups) if groups is not None else None
+  rows = collections.Counter()
+  files = 0
+  writer = None
+  batch: Batch = []
+
+  def Flush():
+    if batch:
+      writer.Write(batch)
+      del batch[:]
+
+  def Finish():
+    Flush()
+    writer.Close()
+    return len(writer.paths)
+
+  with sqlite.ShardedSqliteStorage(db_dir, read_only=True) as db:
+    for ticker, date_str, data, group in db.Rows([q]):
+      if groups is not None and group not in groups:
+        continue
+      if writer is None or writer.group != group:
+        if writer is not None:
+          files += Finish()
+        dir_path = PartitionDir(output_dir, group, q)
+        os.makedirs(dir_path, exist_ok=True)
+        for path in glob.glob(os.path.join(dir_path, 'part-*')):
+          os.remove(path)
+        writer = _WRITERS[fmt](dir_path, group)
+      batch.append((ticker, date_str, data))
+      rows[group] += 1
+      if len(batch) >= batch_size:
+        Flush()
+  if writer is not None:
+    files += Finish()
+  logging.info('Exported %s: %s' % (q, dict(rows)))
+  return {'quarters': [q], 'rows': rows, 'files': files}
+
+
+def Export(
+    db_dir: str, output_dir: str, quarters: Iterable[str] = None, groups: Iterable[str] = None,
+    fmt: str = JSONL, max_workers: int = None, batch_size: int = _DEFAULT_BATCH_SIZE) -> Result:
+  """Exports the quarters (all by default) of the storage at db_dir to output_dir.
+
+  Each quarter is exported by its own worker process, at most max_workers (the number of CPUs by
+  default) at a time. Returns the quarters exported, the number of rows by group and the number
+  of files written.
+  """
+  if fmt not in _WRITERS:
+    raise ValueError('Unknown export format: %s' % fmt)
+  if fmt == PARQUET and pyarrow is None:
+    raise ImportError('Parquet export requires the pyarrow package')
+  if not os.path.exists(os.path.join(db_dir, 'system.sqlite')):
+    raise ValueError('No DB in %s' % db_dir)
+  with sqlite.ShardedSqliteStorage(db_dir, read_only=True) as db:
+    quarters = [q for q in db.ListQuarters() if quarters is None or q in quarters]
+  groups = sorted(groups) if groups else None
+
+  args = [(db_dir, output_dir, q, groups, fmt, batch_size) for q in quarters]
+  max_workers = min(len(quarters), max_workers or os.cpu_count() or 1)
+  if max_workers > 1:
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+      results = list(executor.map(ExportQuarter, *zip(*args)))
+  else:
+    results = [ExportQuarter(*a) for a in args]
+
+  rows = collections.Counter()
+  for result in results:
+    rows.update(result['rows'])
+  return {
+    'quarters': quarters,
+    'rows': dict(sorted(rows.items())),
+    'files': sum(result['files'] for result in results),
+  }
+
+
+def ParseArgs(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('db_path', help='Storage to export (YF_SNAPSHOT_DB_PATH).')
+  parser.add_argument('output_dir', help='Directory of the partitions.')
+  parser.add_argument('--format', default=JSONL, choices=sorted(_WRITERS))
+  parser.add_argument(
+      '--quarters', default='', help='Comma separated quarters, e.g. 2022q1. Defaults to all.')
+  parser.add_argument(
+      '--groups', default='', help='Comma separated groups, e.g. yf.info. Defaults to all.')
+  parser.add_argument(
+      '--max_workers', type=int, default=0, help='Worker processes. Defaults to the CPU count.')
+  parser.add_argument(
+      '--batch_size', type=int, default=_DEFAULT_BATCH_SIZE, help='Rows per record batch.')
+  return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+  logging.basicConfig(
+      format='%(asctime)s %(levelname)-8s %(message)s',
+      level=logging.INFO,
+      datefmt='%Y-%m-%d %H:%M:%S')
+  args = ParseArgs()
+  result = Export(
+      args.db_path, args.output_dir,
+      quarters=list(filter(None, args.quarters.split(','))) or None,
+      groups=list(filter(None, args.groups.split(','))) or None,
+      fmt=args.format, max_workers=args.max_workers or None, batch_size=args.batch_size)
+  print(json.dumps(result, indent=2, sort_keys=True))
@@ -0,0 +1,143 @@
+import glob
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from protos import yfinance_pb2 as yfpb
+from storage import export
+from storage import sqlite
+
+
+def Info(price_target: float, revenue: float = None) -> bytes:
+  info = yfpb.Info()
+  info.price_target.average = price_target
+  if revenue is not None:
+    info.income.revenue = revenue
+  return info.SerializeToString()
+
+
+class TestExport(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.db_dir = os.path.join(self.tmp_dir, 'db')
+    self.output_dir = os.path.join(self.tmp_dir, 'export')
+    os.makedirs(self.db_dir)
+    with sqlite.ShardedSqliteStorage(self.db_dir) as db:
+      db.WriteMany([
+        ('A', '2022-03-30', Info(10.0), 'yf.info'),
+        ('B', '2022-03-30', Info(20.0), 'yf.info'),
+        ('C', '2022-03-30', Info(30.0, revenue=1e9), 'yf.info'),
+        ('A', '2022-04-01', Info(11.0), 'yf.info'),
+        ('A', '2022-04-01', b'{"price": 1.5}', 'raw.info'),
+      ])
+
+  def tearDown(self) -> None:
+    shutil.rmtree(self.tmp_dir)
+
+  def _Files(self):
+    return sorted(
+        os.path.relpath(path, self.output_dir)
+        for path in glob.glob(os.path.join(self.output_dir, '*', '*', '*')))
+
+  def _ReadJsonl(self, group: str, q: str):
+    path = os.path.join(export.PartitionDir(self.output_dir, group, q), 'part-00000.jsonl')
+    with open(path) as f:
+      return [json.loads(line) for line in f]
+
+  def testJsonl(self):
+    result = export.Export(self.db_dir, self.output_dir, max_workers=2, batch_size=2)
+    self.assertEqual(result, {
+      'quarters': ['2022q1', '2022q2'],
+      'rows': {'raw.info': 1, 'yf.info': 4},
+      'files': 3,
+    })
+    self.assertEqual(self._Files(), [
+      'group=raw.info/quarter=2022q2/part-00000.jsonl',
+      'group=yf.info/quarter=2022q1/part-00000.jsonl',
+      'group=yf.info/quarter=2022q2/part-00000.jsonl',
+    ])
+    self.assertEqual(self._ReadJsonl('yf.info', '2022q1'), [
+      {'ticker': 'A', 'date': '2022-03-30', 'group': 'yf.info',
+       'data': {'price_target': {'average': 10.0}}},
+      {'ticker': 'B', 'date': '2022-03-30', 'group': 'yf.info',
+       'data': {'price_target': {'average': 20.0}}},
+      {'ticker': 'C', 'date': '2022-03-30', 'group': 'yf.info',
+       'data': {'price_target': {'average': 30.0}, 'income': {'revenue': 1e9}}},
+    ])
+    self.assertEqual(self._ReadJsonl('raw.info', '2022q2'), [
+      {'ticker': 'A', 'date': '2022-04-01', 'group': 'raw.info', 'data': {'price': 1.5}},
+    ])
+
+  def testReplacesPartitions(self):
+    export.Export(self.db_dir, self.output_dir)
+    with sqlite.ShardedSqliteStorage(self.db_dir) as db:
+      db.Write('B', '2022-04-01', Info(21.0), 'yf.info')
+    result = export.Export(
+        self.db_dir, self.output_dir, quarters=['2022q2'], groups=['yf.info'], max_workers=1)
+    self.assertEqual(result['rows'], {'yf.info': 2})
+    self.assertEqual(
+        [row['ticker'] for row in self._ReadJsonl('yf.info', '2022q2')], ['A', 'B'])
+    self.assertEqual(len(self._Files()), 3)
+
+  def testSealedShards(self):
+    with sqlite.ShardedSqliteStorage(self.db_dir) as db:
+      db.Seal(['2022q1'])
+    result = export.Export(self.db_dir, self.output_dir, quarters=['2022q1'])
+    self.assertEqual(result['rows'], {'yf.info': 3})
+
+  def testErrors(self):
+    with self.assertRaises(ValueError):
+      export.Export(os.path.join(self.tmp_dir, 'missing'), self.output_dir)
+    with self.assertRaises(ValueError):
+      export.Export(self.db_dir, self.output_dir, fmt='csv')
+
+  @unittest.skipIf(export.pyarrow is None, 'pyarrow is not installed')
+  def testParquet(self):
+    import pyarrow.parquet
+    result = export.Export(
+        self.db_dir, self.output_dir, fmt=export.PARQUET, max_workers=1, batch_size=2)
+    # The batch adding income.revenue starts a new part.
+    self.assertEqual(result['files'], 4)
+    dir_path = export.PartitionDir(self.output_dir, 'yf.info', '2022q1')
+    first = pyarrow.parquet.read_table(os.path.join(dir_path, 'part-00000.parquet'))
+    self.assertEqual(first.to_pydict(), {
+      'ticker': ['A', 'B'],
+      'date': ['2022-03-30', '2022-03-30'],
+      'price_target.average': [10.0, 20.0],
+    })
+    last = pyarrow.parquet.read_table(os.path.join(dir_path, 'part-00001.parquet'))
+    self.assertEqual(last.to_pydict(), {
+      'ticker': ['C'],
+      'date': ['2022-03-30'],
+      'price_target.average': [30.0],
+      'income.revenue': [1e9],
+    })
+    raw = pyarrow.parquet.read_table(os.path.join(
+        export.PartitionDir(self.output_dir, 'raw.info', '2022q2'), 'part-00000.parquet'))
+    self.assertEqual(raw.column('data').to_pylist(), [b'{"price": 1.5}'])
+
+  @unittest.skipIf(export.pyarrow is None, 'pyarrow is not installed')
+  def testParquetDataset(self):
+    import pyarrow.dataset
+    export.Export(self.db_dir, self.output_dir, fmt=export.PARQUET, max_workers=1, batch_size=2)
+    dataset = export.Dataset(self.output_dir)
+    self.assertEqual(dataset.schema.names, [
+      'ticker', 'date', 'data', 'price_target.average', 'income.revenue', 'group', 'quarter'])
+    # income.revenue is only in the second part of 2022q1.
+    table = dataset.to_table(
+        columns=['ticker', 'date', 'income.revenue', 'quarter'],
+        filter=pyarrow.dataset.field('group') == 'yf.info')
+    table = table.sort_by([('date', 'ascending'), ('ticker', 'ascending')])
+    self.assertEqual(table.to_pydict(), {
+      'ticker': ['A', 'B', 'C', 'A'],
+      'date': ['2022-03-30', '2022-03-30', '2022-03-30', '2022-04-01'],
+      'income.revenue': [None, None, 1e9, None],
+      'quarter': ['2022q1', '2022q1', '2022q1', '2022q2'],
+    })
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,259 @@
+"""Partitioning of the ticker universe across snapshot workers.
+
+Worker i of N snapshots the tickers whose CRC32 is i modulo N, into its own storage under
+<db_dir>/workers/<i>, so that workers never write to the same SQLite files. FederatedStorage
+reads a storage and all of its worker storages as one, and MergeWorkers() folds the worker
+storages back into the main one.
+
+The slice of a ticker only depends on N: changing the number of workers moves tickers to other
+worker storages, which the federated reader and the merge handle like any other worker.
+"""
+import heapq
+import itertools
+import logging
+import os
+import shutil
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from storage import sqlite
+
+WORKERS_DIR = 'workers'
+
+# Rows written per transaction by MergeWorkers().
+_MERGE_BATCH_SIZE = 1000
+
+# SQL aggregate functions of ShardedSqliteStorage.AggregateFeature(), over the values of a date.
+_AGGREGATES = {
+  'AVG': lambda values: sum(values) / len(values),
+  'MIN': min,
+  'MAX': max,
+  'SUM': sum,
+  'TOTAL': lambda values: float(sum(values)),
+  'COUNT': len,
+}
+
+
+def Partition(tickers: Sequence[str], num_workers: int, worker_index: int) -> List[str]:
+  """Returns the tickers of the worker, in input order."""
+  if not 0 <= worker_index < num_workers:
+    raise ValueError('Invalid worker %d of %d' % (worker_index, num_workers))
+  return [t for t in tickers if zlib.crc32(t.encode('utf-8')) % num_workers == worker_index]
+
+
+def WorkerDir(db_dir: str, worker_index: int) -> str:
+  """Returns the storage directory of the worker, creating it if needed."""
+  path = os.path.join(db_dir, WORKERS_DIR, str(worker_index))
+  os.makedirs(path, exist_ok=True)
+  return path
+
+
+def ListWorkerDirs(db_dir: str) -> List[str]:
+  """Returns the directories of the existing worker storages, by worker index."""
+  root = os.path.join(db_dir, WORKERS_DIR)
+  if not os.path.isdir(root):
+    return []
+  indices = sorted(int(d) for d in os.listdir(root) if d.isdigit())
+  return [os.path.join(root, str(i)) for i in indices
+          if os.path.exists(os.path.join(root, str(i), 'system.sqlite'))]
+
+
+def _Merge(streams: Sequence[Iterator[tuple]], key_size: int) -> Iterator[Tuple[int, tuple]]:
+  """Merges streams of rows sorted by their first key_size values into (stream index, row).
+
+  Rows with equal keys are yielded in stream order.
+  """
+  def Tag(i, rows):
+    for row in rows:
+      yield row[:key_size], i, row
+  tagged = [Tag(i, rows) for i, rows in enumerate(streams)]
+  for _, i, row in heapq.merge(*tagged, key=lambda item: item[:2]):
+    yield i, row
+
+
+class FederatedStorage(object):
+  """Read-only view of a storage and of its worker storages.
+
+  Values of a (ticker, date, group) found in several storages are read from the main storage
+  first, then from the workers by index. Other arguments are passed to ShardedSqliteStorage.
+  """
+
+  def __init__(self, db_dir: str, **kwargs):
+    self.db_dir = db_dir
+    dirs = [db_dir] if os.path.exists(os.path.join(db_dir, 'system.sqlite')) else []
+    self.storages = [
+        sqlite.ShardedSqliteStorage(d, read_only=True, **kwargs)
+        for d in dirs + ListWorkerDirs(db_dir)]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Close()
+
+  def Close(self):
+    for storage in self.storages:
+      storage.Close()
+
+  def Get(self, key: str) -> bytes:
+    for storage in self.storages:
+      val = storage.Get(key)
+      if val is not None:
+        return val
+    return None
+
+  def List(self, group: str='analysis', date_gte: str='2022-01-01') -> Dict[str, List[str]]:
+    dates: Dict[str, set] = {}
+    for storage in self.storages:
+      for ticker, date_list in storage.List(group, date_gte).items():
+        dates.setdefault(ticker, set()).update(date_list)
+    return {ticker: sorted(date_set) for ticker, date_set in dates.items()}
+
+  def Read(self, ticker: str, date_str: str, group='analysis') -> bytes:
+    for storage in self.storages:
+      val = storage.Read(ticker, date_str, group)
+      if val is not None:
+        return val
+    return None
+
+  def ReadRange(
+      self, ticker: str, date_from: str, date_to: str, group='analysis',
+      decode=None) -> Iterator[Tuple[str, Any]]:
+    """Yields (date, data) of the ticker for date_from <= date <= date_to, in date order."""
+    streams = [storage.ReadRange(ticker, date_from, date_to, group, decode)
+               for storage in self.storages]
+    last = None
+    for _, row in _Merge(streams, 1):
+      if row[0] != last:
+        last = row[0]
+        yield row
+
+  def Scan(
+      self, group: str, date_from: str, date_to: str,
+      tickers=None) -> Iterator[Tuple[str, str, bytes]]:
+    """Yields (date, ticker, data) of all or the given tickers, in (date, ticker) order."""
+    tickers = list(tickers) if tickers is not None else None
+    streams = [storage.Scan(group, date_from, date_to, tickers) for storage in self.storages]
+    last = None
+    for _, row in _Merge(streams, 2):
+      if row[:2] != last:
+        last = row[:2]
+        yield row
+
+  def ReadCrossSection(
+      self, date_str: str, group='analysis', tickers=None, max_staleness_days: int = None,
+      decode=None) -> Iterator[Tuple[str, str, Any]]:
+    """Yields (ticker, date, data) of the latest row of each ticker on or before date_str.
+
+    Rows are yielded in ticker order, once all storages were read.
+    """
+    tickers = list(tickers) if tickers is not None else None
+    latest: Dict[str, Tuple[str, Any]] = {}
+    for storage in self.storages:
+      for ticker, date_str_, data in storage.ReadCrossSection(
+          date_str, group, tickers, max_staleness_days, decode):
+        if ticker not in latest or date_str_ > latest[ticker][0]:
+          latest[ticker] = (date_str_, data)
+    for ticker in sorted(latest):
+      yield (ticker,) + latest[ticker]
+
+  def ReadFeature(
+      self, group: str, path: str, date_from: str, date_to: str,
+      tickers: Iterable[str] = None) -> Iterator[Tuple[str, str, float]]:
+    """Yields (date, ticker, value) of a feature for date_from <= date <= date_to.
+
+    Values are yielded in date and ticker order. A value found in several storages is read from
+    the first one, like rows.
+    """
+    tickers = list(tickers) if tickers is not None else None
+    streams = [storage.ReadFeature(group, path, date_from, date_to, tickers)
+               for storage in self.storages]
+    last = None
+    for _, row in _Merge(streams, 2):
+      if row[:2] != last:
+        last = row[:2]
+        yield row
+
+  def FeatureCrossSection(
+      self, date_str: str, group: str, path: str, tickers: Iterable[str] = None,
+      max_staleness_days: int = None) -> Iterator[Tuple[str, str, float]]:
+    """Yields (ticker, date, value) of the latest value of a feature on or before date_str.
+
+    Values are yielded in ticker order, once all storages were read.
+    """
+    tickers = list(tickers) if tickers is not None else None
+    latest: Dict[str, Tuple[str, float]] = {}
+    for storage in self.storages:
+      for ticker, date_str_, value in storage.FeatureCrossSection(
+          date_str, group, path, tickers, max_staleness_days):
+        if ticker not in latest or date_str_ > latest[ticker][0]:
+          latest[ticker] = (date_str_, value)
+    for ticker in sorted(latest):
+      yield (ticker,) + latest[ticker]
+
+  def AggregateFeature(
+      self, group: str, path: str, date_from: str, date_to: str,
+      func: str = 'AVG') -> Iterator[Tuple[str, int, float]]:
+    """Yields (date, number of values, func(values)) of a feature across tickers, by date.
+
+    Values are aggregated once merged (see ReadFeature()), so that a value found in several
+    storages counts once. func is one of AVG, MIN, MAX, SUM, TOTAL or COUNT.
+    """
+    aggregate = _AGGREGATES.get(func.upper())
+    if aggregate is None:
+      raise ValueError('Unknown aggregate function: %s' % func)
+    values = self.ReadFeature(group, path, date_from, date_to)
+    for date_str, rows in itertools.groupby(values, key=lambda row: row[0]):
+      date_values = [value for _, _, value in rows]
+      yield date_str, len(date_values), aggregate(date_values)
+
+  def ReadChanges(
+      self, group: str, date_from: str, date_to: str, paths: Iterable[str] = None,
+      tickers: Iterable[str] = None) -> Iterator[Tuple[str, str, str, str, float, float]]:
+    """Yields (date, ticker, field path, previous date, old value, new value) changes.
+
+    Changes are yielded in date and ticker order. The changes of a (date, ticker) are read from
+    the first storage with changes of it only.
+    """
+    paths = list(paths) if paths is not None else None
+    tickers = list(tickers) if tickers is not None else None
+    streams = [storage.ReadChanges(group, date_from, date_to, paths, tickers)
+               for storage in self.storages]
+    last = None
+    for i, row in _Merge(streams, 2):
+      if row[:2] != last:
+        last = row[:2]
+        first = i
+      if i == first:
+        yield row
+
+  def ReadLatestDate(self, ticker: str, group='analysis') -> str:
+    dates = [storage.ReadLatestDate(ticker, group) for storage in self.storages]
+    return max(filter(None, dates), default=None)
+
+  def ReadLatest(self, ticker: str, group='analysis') -> bytes:
+    latest_date = self.ReadLatestDate(ticker, group)
+    if not latest_date:
+      return None
+    return self.Read(ticker, latest_date, group)
+
+
+def MergeWorkers(db: sqlite.ShardedSqliteStorage, delete: bool = False) -> int:
+  """Writes the rows of all worker storages of db into db. Returns the number of rows merged.
+
+  Rows of a worker overwrite the rows of the same (ticker, date, group) in db. The features and
+  changes of the merged rows are those of the projections and change log of db: open it like the
+  workers were opened, or their features are lost. With `delete`, the worker storages are deleted
+  once merged; workers must not be running.
+  """
+  merged = 0
+  for worker_dir in ListWorkerDirs(db.db_dir):
+    with sqlite.ShardedSqliteStorage(worker_dir, read_only=True) as worker:
+      with sqlite.BatchWriter(db, _MERGE_BATCH_SIZE) as writer:
+        for row in worker.Rows():
+          writer.Write(*row)
+          merged += 1
+    logging.info('Merged worker storage %s' % worker_dir)
+    if delete:
+      shutil.rmtree(worker_dir)
+  return merged
@@ -0,0 +1,224 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from storage import partition
+from storage import sqlite
+
+
+class TestPartition(unittest.TestCase):
+
+  def testPartition(self):
+    tickers = ['T%d' % i for i in range(1000)]
+    parts = [partition.Partition(tickers, 4, i) for i in range(4)]
+    self.assertEqual(sorted(sum(parts, [])), sorted(tickers))
+    for part in parts:
+      self.assertGreater(len(part), 200)
+      self.assertLess(len(part), 300)
+    # Stable across calls and independent of the other tickers.
+    self.assertEqual(partition.Partition(tickers[::-1], 4, 2), parts[2][::-1])
+    self.assertEqual(partition.Partition(tickers, 1, 0), tickers)
+    with self.assertRaises(ValueError):
+      partition.Partition(tickers, 4, 4)
+
+
+class TestFederatedStorage(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.main = sqlite.ShardedSqliteStorage(self.tmp_dir)
+    self.workers = [
+        sqlite.ShardedSqliteStorage(partition.WorkerDir(self.tmp_dir, i)) for i in range(2)]
+    self.main.Set('key', b'main')
+    self.main.WriteMany([
+      ('A', '2021-01-01', b'main-a1', 'grp'),
+      ('B', '2021-01-01', b'main-b1', 'grp'),
+    ])
+    self.workers[0].WriteMany([
+      ('A', '2021-01-01', b'w0-a1', 'grp'),
+      ('A', '2021-05-02', b'w0-a2', 'grp'),
+    ])
+    self.workers[1].WriteMany([
+      ('B', '2021-01-02', b'w1-b2', 'grp'),
+      ('C', '2021-01-01', b'w1-c1', 'grp'),
+    ])
+
+  def tearDown(self) -> None:
+    for storage in [self.main] + self.workers:
+      storage.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def testListWorkerDirs(self):
+    os.makedirs(os.path.join(self.tmp_dir, partition.WORKERS_DIR, 'other'))
+    self.assertEqual(partition.ListWorkerDirs(self.tmp_dir), [
+      os.path.join(self.tmp_dir, partition.WORKERS_DIR, '0'),
+      os.path.join(self.tmp_dir, partition.WORKERS_DIR, '1'),
+    ])
+
+  def testRead(self):
+    with partition.FederatedStorage(self.tmp_dir) as db:
+      self.assertEqual(db.Get('key'), b'main')
+      self.assertEqual(db.Read('A', '2021-01-01', 'grp'), b'main-a1')
+      self.assertEqual(db.Read('C', '2021-01-01', 'grp'), b'w1-c1')
+      self.assertIsNone(db.Read('C', '2021-01-02', 'grp'))
+      self.assertEqual(db.List('grp', '2021-01-01'), {
+        'A': ['2021-01-01', '2021-05-02'],
+        'B': ['2021-01-01', '2021-01-02'],
+        'C': ['2021-01-01'],
+      })
+      self.assertEqual(
+          list(db.ReadRange('A', '2021-01-01', '2021-12-31', 'grp')),
+          [('2021-01-01', b'main-a1'), ('2021-05-02', b'w0-a2')])
+      self.assertEqual(db.ReadLatestDate('A', 'grp'), '2021-05-02')
+      self.assertEqual(db.ReadLatest('B', 'grp'), b'w1-b2')
+      self.assertIsNone(db.ReadLatest('D', 'grp'))
+
+  def testReadRangeStreams(self):
+    self.workers[0].WriteMany([
+        ('A', '2021-06-%02d' % day, b'w0', 'grp') for day in range(1, 31)])
+    with partition.FederatedStorage(self.tmp_dir) as db:
+      read = []
+      worker_read_range = db.storages[1].ReadRange
+      def ReadRange(*args):
+        for row in worker_read_range(*args):
+          read.append(row[0])
+          yield row
+      db.storages[1].ReadRange = ReadRange
+      rows = db.ReadRange('A', '2021-01-01', '2021-12-31', 'grp')
+      self.assertEqual(next(rows), ('2021-01-01', b'main-a1'))
+      self.assertLess(len(read), 3)
+      self.assertEqual(len(list(rows)), 31)
+
+  def testScan(self):
+    with partition.FederatedStorage(self.tmp_dir) as db:
+      self.assertEqual(list(db.Scan('grp', '2021-01-01', '2021-12-31')), [
+        ('2021-01-01', 'A', b'main-a1'),
+        ('2021-01-01', 'B', b'main-b1'),
+        ('2021-01-01', 'C', b'w1-c1'),
+        ('2021-01-02', 'B', b'w1-b2'),
+        ('2021-05-02', 'A', b'w0-a2'),
+      ])
+      self.assertEqual(
+          list(db.Scan('grp', '2021-01-01', '2021-01-01', tickers=['C'])),
+          [('2021-01-01', 'C', b'w1-c1')])
+
+  def testReadCrossSection(self):
+    with partition.FederatedStorage(self.tmp_dir) as db:
+      self.assertEqual(list(db.ReadCrossSection('2021-03-01', 'grp')), [
+        ('A', '2021-01-01', b'main-a1'),
+        ('B', '2021-01-02', b'w1-b2'),
+        ('C', '2021-01-01', b'w1-c1'),
+      ])
+      self.assertEqual(
+          list(db.ReadCrossSection('2021-12-31', 'grp', tickers=['A'], max_staleness_days=365)),
+          [('A', '2021-05-02', b'w0-a2')])
+
+  def testMergeWorkers(self):
+    for storage in self.workers:
+      storage.Close()
+    self.workers = []
+    self.assertEqual(partition.MergeWorkers(self.main, delete=True), 4)
+    self.assertEqual(partition.ListWorkerDirs(self.tmp_dir), [])
+    self.assertEqual(self.main.Read('A', '2021-01-01', 'grp'), b'w0-a1')
+    self.assertEqual(self.main.ReadLatest('A', 'grp'), b'w0-a2')
+    self.assertEqual(
+        list(self.main.Scan('grp', '2021-01-01', '2021-01-02')),
+        [('2021-01-01', 'A', b'w0-a1'), ('2021-01-01', 'B', b'main-b1'),
+         ('2021-01-01', 'C', b'w1-c1'), ('2021-01-02', 'B', b'w1-b2')])
+
+
+def JsonProjection(data: bytes):
+  return sorted(json.loads(data.decode('utf-8')).items())
+
+
+class TestFederatedFeatures(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.main = self._Storage(self.tmp_dir)
+    self.workers = [self._Storage(partition.WorkerDir(self.tmp_dir, i)) for i in range(2)]
+    self.main.WriteMany([
+      ('A', '2021-01-04', b'{"x": 1.0}', 'grp'),
+      ('B', '2021-01-04', b'{"x": 2.0}', 'grp'),
+    ])
+    self.workers[0].WriteMany([
+      ('A', '2021-01-04', b'{"x": 5.0}', 'grp'),
+      ('A', '2021-01-05', b'{"x": 3.0}', 'grp'),
+    ])
+    self.workers[1].WriteMany([
+      ('B', '2021-01-05', b'{"x": 4.0, "y": 1.0}', 'grp'),
+      ('C', '2021-01-05', b'{"x": 6.0}', 'grp'),
+    ])
+
+  def tearDown(self) -> None:
+    for storage in [self.main] + self.workers:
+      storage.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def _Storage(self, db_dir: str) -> sqlite.ShardedSqliteStorage:
+    return sqlite.ShardedSqliteStorage(
+        db_dir, projections={'grp': JsonProjection}, change_log=True)
+
+  def testReadFeature(self):
+    with partition.FederatedStorage(self.tmp_dir) as db:
+      self.assertEqual(list(db.ReadFeature('grp', 'x', '2021-01-01', '2021-12-31')), [
+        ('2021-01-04', 'A', 1.0),
+        ('2021-01-04', 'B', 2.0),
+        ('2021-01-05', 'A', 3.0),
+        ('2021-01-05', 'B', 4.0),
+        ('2021-01-05', 'C', 6.0),
+      ])
+      self.assertEqual(
+          list(db.ReadFeature('grp', 'y', '2021-01-01', '2021-12-31', ['B'])),
+          [('2021-01-05', 'B', 1.0)])
+      self.assertEqual(list(db.FeatureCrossSection('2021-01-04', 'grp', 'x')), [
+        ('A', '2021-01-04', 1.0),
+        ('B', '2021-01-04', 2.0),
+      ])
+      self.assertEqual(list(db.FeatureCrossSection('2021-06-30', 'grp', 'x', ['A', 'C'])), [
+        ('A', '2021-01-05', 3.0),
+        ('C', '2021-01-05', 6.0),
+      ])
+      self.assertEqual(list(db.AggregateFeature('grp', 'x', '2021-01-01', '2021-12-31')), [
+        ('2021-01-04', 2, 1.5),
+        ('2021-01-05', 3, 13.0 / 3),
+      ])
+      self.assertEqual(
+          list(db.AggregateFeature('grp', 'x', '2021-01-05', '2021-01-05', 'max')),
+          [('2021-01-05', 3, 6.0)])
+      with self.assertRaises(ValueError):
+        list(db.AggregateFeature('grp', 'x', '2021-01-01', '2021-12-31', 'median'))
+
+  def testReadChanges(self):
+    # The changes of A on 2021-01-05 in worker 0 are against its own row of 2021-01-04.
+    with partition.FederatedStorage(self.tmp_dir) as db:
+      self.assertEqual(list(db.ReadChanges('grp', '2021-01-01', '2021-12-31')), [
+        ('2021-01-05', 'A', 'x', '2021-01-04', 5.0, 3.0),
+      ])
+      self.assertEqual(
+          list(db.ReadChanges('grp', '2021-01-01', '2021-12-31', paths=['y'])), [])
+
+  def testMergeWorkers(self):
+    for storage in self.workers:
+      storage.Close()
+    self.workers = []
+    self.assertEqual(partition.MergeWorkers(self.main, delete=True), 4)
+    self.assertEqual(list(self.main.ReadFeature('grp', 'x', '2021-01-01', '2021-12-31')), [
+      ('2021-01-04', 'A', 5.0),
+      ('2021-01-04', 'B', 2.0),
+      ('2021-01-05', 'A', 3.0),
+      ('2021-01-05', 'B', 4.0),
+      ('2021-01-05', 'C', 6.0),
+    ])
+    self.assertEqual(self.main.FeatureFields('grp'), ['x', 'y'])
+    self.assertEqual(list(self.main.ReadChanges('grp', '2021-01-01', '2021-12-31')), [
+      ('2021-01-05', 'A', 'x', '2021-01-04', 5.0, 3.0),
+      ('2021-01-05', 'B', 'x', '2021-01-04', 2.0, 4.0),
+      ('2021-01-05', 'B', 'y', '2021-01-04', None, 1.0),
+    ])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,34 +1,237 @@
+import collections
 from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import datetime
+import glob
+import hashlib
 import logging
 import os
-from typing import Dict, List
+import re
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+import urllib.parse
 
 import sqlite3
 
+from monitoring import metrics
+from storage import codec
+
+# Max number of quarter shards kept open by ShardedSqliteStorage at the same time.
+_DEFAULT_MAX_OPEN_SHARDS = 8
+
+# Number of rows buffered by BatchWriter before they are committed.
+_DEFAULT_BATCH_SIZE = 500
+
+# A row to write: (ticker, date_str, data, group).
+Row = Tuple[str, str, bytes, str]
+
+# Max number of tickers bound into a single SQL IN clause; larger sets are filtered in Python.
+_MAX_SQL_TICKERS = 500
+
+# Max number of keys bound into a single lookup of previous rows, within the 999 variables of
+# older SQLite versions.
+_MAX_SQL_KEYS = 300
+
+# Flattens a stored value into (field path, number) features. See ShardedSqliteStorage.
+Projection = Callable[[bytes], Iterable[Tuple[str, float]]]
+
+# Features of the rows of a shard: {(group, date_str, ticker): [(field id, value)]}.
+Features = Dict[Tuple[str, str, str], List[Tuple[int, float]]]
+
+# Changes of the features of rows against the previous row of their ticker:
+# {(group, date_str, ticker): [(field id, previous date, old value, new value)]}.
+Changes = Dict[Tuple[str, str, str], List[Tuple[int, str, float, float]]]
+
+# SQL aggregate functions of AggregateFeature().
+_AGGREGATES = frozenset(['AVG', 'MIN', 'MAX', 'SUM', 'TOTAL', 'COUNT'])
+
+# Rows projected per transaction by BackfillFeatures().
+_BACKFILL_BATCH_SIZE = 1000
+
+# Index of data on (grp, date, ticker), used by ReadCrossSection().
+_CROSS_SECTION_INDEX = 'data_grp_date_ticker'
+
+_SHARD_FILE_RE = re.compile(r'^shard-(\d{4}q\d)(\.sealed)?\.sqlite$')
+
+# Prefix of the system keys holding the trained zstd dictionary of each group.
+_ZSTD_DICT_KEY = 'codec.zstd_dict.'
+
+# Rows re-encoded per transaction by Recompress().
+_RECOMPRESS_BATCH_SIZE = 1000
+
+Codecs = Dict[str, codec.Codec]
+
+_COMMIT_SECONDS = metrics.Histogram(
+    'yf_storage_commit_seconds', 'Latency of WriteMany transaction commits, by DB file.')
+_SHARD_WRITE_SECONDS = metrics.Histogram(
+    'yf_storage_shard_write_seconds', 'Latency of writing rows to a shard, by storage and quarter.')
+_ROWS_WRITTEN = metrics.Counter(
+    'yf_storage_rows_written_total', 'Rows written, by storage and group.')
+_BYTES_WRITTEN = metrics.Counter(
+    'yf_storage_bytes_written_total', 'Uncompressed bytes written, by storage and group.')
+
+# Selects the value of a data row, stored inline or in the content table.
+_DATA = 'COALESCE(data, (SELECT content.data FROM content WHERE content.hash = data.ref))'
+
+# PRAGMA settings of each connection, by profile name. WAL lets readers run concurrently with the
+# writer, but requires all processes to run on the same host (not on a network filesystem).
+PRAGMA_PROFILES = {
+  'default': {},
+  'wal': {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 1 << 28,
+    'cache_size': -16384,  # KiB
+  },
+}
+
+# PRAGMAs changing the DB file, not applied to read-only connections.
+_WRITE_PRAGMAS = frozenset(['journal_mode', 'synchronous'])
+
+_PRAGMA_RE = re.compile(r'^[\w-]+$')
+
+
+def ParsePragmas(spec: str) -> Dict[str, str]:
+  """Parses profile names and PRAGMA overrides, e.g. 'wal' or 'wal,cache_size=-65536'."""
+  pragmas = {}
+  for part in spec.split(','):
+    part = part.strip()
+    if not part:
+      continue
+    name, sep, value = part.partition('=')
+    if not sep:
+      if part not in PRAGMA_PROFILES:
+        raise ValueError('Unknown PRAGMA profile: %s' % part)
+      pragmas.update(PRAGMA_PROFILES[part])
+    else:
+      pragmas[name.strip()] = value.strip()
+  return pragmas
+
+class ShardSealedError(Exception):
+  pass
+
+
+def CreateCodecs(compression: Dict[str, str], dictionaries: Dict[str, bytes] = None) -> Codecs:
+  """Returns the codecs for codec specs by group (see codec.DEFAULT_COMPRESSION)."""
+  dictionaries = dictionaries or {}
+  return {
+      group: codec.Create(spec, dictionaries.get(group) if spec.startswith('zstd') else None)
+      for group, spec in compression.items()}
+
+_DEFAULT_CODECS = CreateCodecs(codec.DEFAULT_COMPRESSION)
+
 class SqliteStorage(object):
-  def __init__(self, db_dir: str, db_name='data'):
+  """A single SQLite DB file.
+
+  Bytes values are compressed with the codec configured for their group in `codecs` ('*' for any
+  other group). Values are decoded based on their header, so any codec can be read back.
+
+  With `dedup`, each distinct value is stored once in the content table, keyed by its hash, and
+  data rows reference it. Rewriting the same value for a (date, ticker, group) is a no-op.
+
+  `pragmas` are set on the connection (see PRAGMA_PROFILES). A `read_only` storage opens an
+  existing file without creating or migrating tables, so it can read files of any schema version
+  while another process writes them. An `immutable` file is read without any locking, which is
+  only safe for files nobody writes, like sealed shards.
+  """
+
+  def __init__(
+      self, db_dir: str, db_name='data', codecs: Codecs = None, dedup: bool = False,
+      pragmas: Dict[str, Any] = None, read_only: bool = False, immutable: bool = False):
     super().__init__()
+    self.codecs = codecs if codecs is not None else _DEFAULT_CODECS
+    self.dedup = dedup
+    self.read_only = read_only
     self.db_path = os.path.join(db_dir, '%s.sqlite' % db_name)
-    logging.info('Connecting to DB: %s' % self.db_path)
-    self.con = sqlite3.connect(self.db_path)
-    self._InitTables()
+    logging.info('Connecting to DB: %s%s' % (self.db_path, ' (read-only)' if read_only else ''))
+    # Shards are pooled by ShardedSqliteStorage and may be used from its worker threads.
+    if read_only:
+      uri = 'file:%s?mode=ro%s' % (
+          urllib.parse.quote(os.path.abspath(self.db_path)),
+          '&immutable=1' if immutable else '')
+      self.con = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    else:
+      self.con = sqlite3.connect(self.db_path, check_same_thread=False)
+    self._SetPragmas(pragmas or {})
+    if read_only:
+      # Files written before dedup have neither the ref column nor the content table.
+      self.data_expr = _DATA if self._HasTable('content') else 'data'
+      self.has_features = self._HasTable('features')
+      self.has_changes = self._HasTable('changes')
+    else:
+      self._InitTables()
+      self.data_expr = _DATA
+      self.has_features = True
+      self.has_changes = True
+    # Without table statistics, SQLite prefers the (grp, ticker, date) index.
+    self.cross_section_index = (
+        'INDEXED BY %s' % _CROSS_SECTION_INDEX if self._HasIndex(_CROSS_SECTION_INDEX) else '')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Close()
+
+  def Close(self):
+    self.con.close()
+
+  def _SetPragmas(self, pragmas: Dict[str, Any]):
+    for name, value in pragmas.items():
+      if self.read_only and name in _WRITE_PRAGMAS:
+        continue
+      if not _PRAGMA_RE.match(name) or not _PRAGMA_RE.match(str(value)):
+        raise ValueError('Invalid PRAGMA: %s=%s' % (name, value))
+      self.con.execute('PRAGMA %s = %s;' % (name, value))
+
+  def _HasTable(self, name: str) -> bool:
+    cur = self.con.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?;", (name,))
+    return cur.fetchone() is not None
+
+  def _HasIndex(self, name: str) -> bool:
+    cur = self.con.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = ?;", (name,))
+    return cur.fetchone() is not None
 
   def _InitTables(self):
     cur = self.con.cursor()
     cur.execute('''
     CREATE TABLE IF NOT EXISTS data
-    (date text, ticker text, grp text, data BLOB,
+    (date text, ticker text, grp text, data BLOB, ref BLOB,
      UNIQUE(date,ticker,grp))
     ''')
+    # Tables created before dedup have no ref column.
+    columns = [row[1] for row in cur.execute('PRAGMA table_info(data)')]
+    if 'ref' not in columns:
+      cur.execute('ALTER TABLE data ADD COLUMN ref BLOB')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS content
+    (hash BLOB PRIMARY KEY, grp text, data BLOB)
+    ''')
+    cur.execute(
+        'CREATE INDEX IF NOT EXISTS data_grp_ticker_date ON data (grp, ticker, date)')
+    # Covers the latest date lookups of cross sections.
+    cur.execute(
+        'CREATE INDEX IF NOT EXISTS %s ON data (grp, date, ticker)' % _CROSS_SECTION_INDEX)
+    _CreateFeaturesTable(cur)
+    _CreateChangesTable(cur)
     self.con.commit()
 
   def Reset(self):
     cur = self.con.cursor()
     cur.execute('DROP TABLE data')
+    cur.execute('DROP TABLE content')
+    cur.execute('DROP TABLE features')
+    cur.execute('DROP TABLE changes')
     self.con.commit()
     self._InitTables()
 
+  def _Encode(self, group: str, data: bytes) -> bytes:
+    if not isinstance(data, bytes):
+      return data
+    return self.codecs.get(group, self.codecs.get('*', _DEFAULT_CODECS['system'])).Encode(data)
+
   def Get(self, key: str) -> bytes:
     """Returns non-dated config/cache value for the given key."""
     return self.Read(key, '1970-01-01', 'system')
@@ -37,6 +240,45 @@ class SqliteStorage(object):
     """Sets non-dated config/cache value for the given key."""
     return self.Write(key, '1970-01-01', val, 'system')
 
+  def ReadPreviousFeatures(
+      self, keys: Iterable[Tuple[str, str, str]]) -> Dict[Tuple[str, str, str], Tuple[str, Any]]:
+    """Returns the (date, features) of the previous row of each (group, date, ticker) key.
+
+    The previous row is the latest one of the ticker before the date. Keys without one are
+    missing. Features are (field id, value) lists, or None for rows without stored features.
+    """
+    keys = list(keys)
+    previous: Dict[Tuple[str, str, str], Tuple[str, Any]] = {}
+    cur = self.con.cursor()
+    for i in range(0, len(keys), _MAX_SQL_KEYS):
+      chunk = keys[i:i + _MAX_SQL_KEYS]
+      # The MAX() subquery of each key is a range lookup of the (grp, ticker, date) index.
+      query = '''WITH keys(grp, date, ticker) AS (VALUES %s),
+          prev AS (
+            SELECT grp, date, ticker, (
+              SELECT MAX(data.date) FROM data
+              WHERE data.grp = keys.grp AND data.ticker = keys.ticker AND data.date < keys.date
+            ) AS prev_date FROM keys)''' % ','.join(['(?, ?, ?)'] * len(chunk))
+      if self.has_features:
+        query += '''
+          SELECT prev.grp, prev.date, prev.ticker, prev.prev_date, field_id, value FROM prev
+          LEFT JOIN features ON features.grp = prev.grp AND features.date = prev.prev_date
+            AND features.ticker = prev.ticker
+          WHERE prev_date IS NOT NULL;'''
+      else:
+        query += '''
+          SELECT grp, date, ticker, prev_date, NULL, NULL FROM prev
+          WHERE prev_date IS NOT NULL;'''
+      for group, date_str, ticker, prev_date, field_id, value in cur.execute(
+          query, [param for key in chunk for param in key]):
+        features = previous.setdefault((group, date_str, ticker), (prev_date, None))[1]
+        if field_id is not None:
+          if features is None:
+            features = []
+            previous[(group, date_str, ticker)] = (prev_date, features)
+          features.append((field_id, value))
+    return previous
+
   def List(self, group: str='analysis', date_gte: str='2022-01-01') -> Dict[str, List[str]]:
     """Returns list of available dates for each ticker."""
     data_dict = {}
@@ -47,31 +289,367 @@ class SqliteStorage(object):
       data_dict.setdefault(row[0], []).append(row[1])
     return data_dict
 
+  def Rows(self, after: Tuple[str, str, str] = None) -> Iterator[Row]:
+    """Yields all (ticker, date_str, data, group) rows, ordered by group, ticker and date.
+
+    With `after`, a (group, ticker, date), only the rows following it are yielded.
+    """
+    cur = self.con.cursor()
+    for ticker, date_str, data, group in cur.execute(
+        'SELECT ticker, date, %s, grp FROM data %s ORDER BY grp, ticker, date;' % (
+            self.data_expr, 'WHERE (grp, ticker, date) > (?, ?, ?)' if after else ''),
+        tuple(after or ())):
+      yield ticker, date_str, codec.Decode(data), group
+
   def Read(self, ticker: str, date_str: str, group='analysis') -> bytes:
     """Returns the json data for the given ticker and date."""
     cur = self.con.cursor()
     result = None
     for row in cur.execute(
-        'SELECT data FROM data WHERE ticker = ? AND date = ? AND grp = ?;',
+        'SELECT %s FROM data WHERE ticker = ? AND date = ? AND grp = ?;' % self.data_expr,
         (ticker, date_str, group)):
       result = row[0]
-    return result
+    return codec.Decode(result)
+
+  def ReadRange(
+      self, ticker: str, date_from: str, date_to: str,
+      group='analysis') -> Iterator[Tuple[str, bytes]]:
+    """Yields (date, data) of the ticker for date_from <= date <= date_to, in date order."""
+    cur = self.con.cursor()
+    for date_str, data in cur.execute(
+        '''SELECT date, %s FROM data
+        WHERE grp = ? AND ticker = ? AND date >= ? AND date <= ? ORDER BY date ASC;'''
+        % self.data_expr,
+        (group, ticker, date_from, date_to)):
+      yield date_str, codec.Decode(data)
+
+  def Scan(
+      self, group: str, date_from: str, date_to: str,
+      tickers: Iterable[str] = None) -> Iterator[Tuple[str, str, bytes]]:
+    """Yields (date, ticker, data) for date_from <= date <= date_to, optionally for tickers only."""
+    clause, ticker_params, ticker_set = _TickerClause(tickers)
+    query = 'SELECT date, ticker, %s FROM data WHERE grp = ? AND date >= ? AND date <= ?%s' % (
+        self.data_expr, clause)
+    params = [group, date_from, date_to] + ticker_params
+    cur = self.con.cursor()
+    for date_str, ticker, data in cur.execute(query + ' ORDER BY date ASC, ticker ASC;', params):
+      if ticker_set is None or ticker in ticker_set:
+        yield date_str, ticker, codec.Decode(data)
+
+  def ReadCrossSection(
+      self, group: str, date_from: str, date_to: str,
+      tickers: Iterable[str] = None) -> Iterator[Tuple[str, str, bytes]]:
+    """Yields (ticker, date, data) of the latest row of each ticker within [date_from, date_to].
+
+    Rows are yielded in ticker order, optionally for the given tickers only.
+    """
+    clause, ticker_params, ticker_set = _TickerClause(tickers)
+    query = '''SELECT ticker, MAX(date) AS latest_date FROM data %s
+        WHERE grp = ? AND date >= ? AND date <= ?%s''' % (self.cross_section_index, clause)
+    params = [group, date_from, date_to] + ticker_params
+    # CROSS JOIN keeps the latest dates as the outer loop, each row being then read by key.
+    cur = self.con.cursor()
+    for ticker, date_str, data in cur.execute(
+        '''SELECT data.ticker, data.date, %s
+        FROM (%s GROUP BY ticker) AS latest
+        CROSS JOIN data ON data.grp = ? AND data.ticker = latest.ticker
+          AND data.date = latest.latest_date
+        ORDER BY data.ticker ASC;''' % (self.data_expr, query),
+        params + [group]):
+      if ticker_set is None or ticker in ticker_set:
+        yield ticker, date_str, codec.Decode(data)
+
+  def ReadFeature(
+      self, field_id: int, date_from: str, date_to: str,
+      tickers: Iterable[str] = None) -> Iterator[Tuple[str, str, float]]:
+    """Yields (date, ticker, value) of a feature for date_from <= date <= date_to."""
+    if not self.has_features:
+      return
+    clause, params, ticker_set = _TickerClause(tickers)
+    cur = self.con.cursor()
+    for date_str, ticker, value in cur.execute(
+        '''SELECT date, ticker, value FROM features
+        WHERE field_id = ? AND date >= ? AND date <= ?%s ORDER BY date ASC, ticker ASC;'''
+        % clause,
+        [field_id, date_from, date_to] + params):
+      if ticker_set is None or ticker in ticker_set:
+        yield date_str, ticker, value
+
+  def FeatureCrossSection(
+      self, field_id: int, date_from: str, date_to: str,
+      tickers: Iterable[str] = None) -> Iterator[Tuple[str, str, float]]:
+    """Yields (ticker, date, value) of the latest value of a feature within [date_from, date_to].
+
+    Values are yielded in ticker order.
+    """
+    if not self.has_features:
+      return
+    clause, params, ticker_set = _TickerClause(tickers)
+    cur = self.con.cursor()
+    # With MAX(), SQLite reads the bare value column from the row with the max date.
+    for ticker, date_str, value in cur.execute(
+        '''SELECT ticker, MAX(date), value FROM features
+        WHERE field_id = ? AND date >= ? AND date <= ?%s
+        GROUP BY ticker ORDER BY ticker ASC;''' % clause,
+        [field_id, date_from, date_to] + params):
+      if ticker_set is None or ticker in ticker_set:
+        yield ticker, date_str, value
+
+  def AggregateFeature(
+      self, field_id: int, date_from: str, date_to: str,
+      func: str = 'AVG') -> Iterator[Tuple[str, int, float]]:
+    """Yields (date, number of values, func(values)) of a feature for each date, in date order."""
+    func = func.upper()
+    if func not in _AGGREGATES:
+      raise ValueError('Unknown aggregate function: %s' % func)
+    if not self.has_features:
+      return
+    cur = self.con.cursor()
+    yield from cur.execute(
+        '''SELECT date, COUNT(*), %s(value) FROM features
+        WHERE field_id = ? AND date >= ? AND date <= ? GROUP BY date ORDER BY date ASC;''' % func,
+        (field_id, date_from, date_to))
+
+  def _WriteFeatures(self, cur: sqlite3.Cursor, features: Features):
+    """Replaces the features of the given rows, without committing."""
+    cur.executemany(
+        'DELETE FROM features WHERE grp = ? AND date = ? AND ticker = ?', list(features))
+    cur.executemany(
+        'INSERT INTO features VALUES (?, ?, ?, ?, ?)',
+        ((group, date_str, ticker, field_id, value)
+         for (group, date_str, ticker), values in features.items()
+         for field_id, value in values))
+
+  def WriteFeatures(self, features: Features, changes: Changes = None):
+    """Replaces the features and changes of the given rows in a single transaction."""
+    cur = self.con.cursor()
+    self._WriteFeatures(cur, features)
+    if changes is not None:
+      self._WriteChanges(cur, changes)
+    self.con.commit()
+
+  def _WriteChanges(self, cur: sqlite3.Cursor, changes: Changes):
+    """Replaces the changes of the given rows, without committing."""
+    cur.executemany(
+        'DELETE FROM changes WHERE grp = ? AND date = ? AND ticker = ?', list(changes))
+    cur.executemany(
+        'INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?, ?)',
+        ((group, date_str, ticker, field_id, prev_date, old, new)
+         for (group, date_str, ticker), values in changes.items()
+         for field_id, prev_date, old, new in values))
+
+  def ReadChanges(
+      self, group: str, date_from: str, date_to: str, field_ids: Iterable[int] = None,
+      tickers: Iterable[str] = None) -> Iterator[Tuple[str, str, int, str, float, float]]:
+    """Yields (date, ticker, field id, previous date, old value, new value) changes.
+
+    Changes with date_from <= date <= date_to are yielded in (date, ticker, field id) order,
+    optionally for the given fields and tickers only.
+    """
+    if not self.has_changes:
+      return
+    clause, params, ticker_set = _TickerClause(tickers)
+    if field_ids is not None:
+      field_ids = sorted(field_ids)
+      clause += ' AND field_id IN (%s)' % ','.join('?' * len(field_ids))
+      params += field_ids
+    cur = self.con.cursor()
+    for row in cur.execute(
+        '''SELECT date, ticker, field_id, prev_date, old_value, new_value FROM changes
+        WHERE grp = ? AND date >= ? AND date <= ?%s
+        ORDER BY date ASC, ticker ASC, field_id ASC;''' % clause,
+        [group, date_from, date_to] + params):
+      if ticker_set is None or row[1] in ticker_set:
+        yield row
 
   def ReadLatest(self, ticker: str, group='analysis') -> bytes:
     cur = self.con.cursor()
     result = None
     for row in cur.execute(
-        'SELECT data FROM data WHERE ticker = ? AND grp = ? ORDER BY date DESC LIMIT 1;',
+        'SELECT %s FROM data WHERE ticker = ? AND grp = ? ORDER BY date DESC LIMIT 1;'
+        % self.data_expr,
         (ticker, group)):
       result = row[0]
-    return result
+    return codec.Decode(result)
 
   def Write(self, ticker: str, date_str: str, data: bytes, group='analysis'):
+    self.WriteMany([(ticker, date_str, data, group)])
+
+  def WriteMany(self, rows: Iterable[Row], features: Features = None, changes: Changes = None):
+    """Writes (ticker, date_str, data, group) rows in a single transaction.
+
+    The `features` and `changes` of the rows are replaced in the same transaction.
+    """
+    cur = self.con.cursor()
+    if self.dedup and not self.con.in_transaction:
+      # Takes the write lock before checking which content exists, so that CollectGarbage() in
+      # another process cannot delete it before the rows referencing it are written.
+      cur.execute('BEGIN IMMEDIATE')
+    try:
+      self._WriteMany(cur, rows, features, changes)
+    except:
+      self.con.rollback()
+      raise
+    with _COMMIT_SECONDS.Time(db=self.db_path):
+      self.con.commit()
+
+  def _WriteMany(self, cur, rows: Iterable[Row], features: Features, changes: Changes):
+    if features:
+      self._WriteFeatures(cur, features)
+    if changes:
+      self._WriteChanges(cur, changes)
+    if not self.dedup:
+      cur.executemany(
+          '''INSERT OR REPLACE INTO data (date, ticker, grp, data)
+          VALUES (?, ?, ?, ?)''',
+          ((date_str, ticker, group, self._Encode(group, data))
+           for ticker, date_str, data, group in rows))
+      return
+
+    refs = []
+    new_content = {}
+    for ticker, date_str, data, group in rows:
+      if not isinstance(data, bytes):
+        raise TypeError('Deduplicated values must be bytes: %s %s' % (ticker, date_str))
+      ref = ContentHash(data)
+      refs.append((date_str, ticker, group, ref))
+      if ref not in new_content:
+        cur.execute('SELECT 1 FROM content WHERE hash = ?;', (ref,))
+        new_content[ref] = None if cur.fetchone() else (group, data)
+    cur.executemany(
+        'INSERT OR IGNORE INTO content VALUES (?, ?, ?)',
+        ((ref, content[0], self._Encode(*content))
+         for ref, content in new_content.items() if content))
+    cur.executemany(
+        '''INSERT INTO data (date, ticker, grp, ref) VALUES (?, ?, ?, ?)
+        ON CONFLICT(date, ticker, grp) DO UPDATE SET data = NULL, ref = excluded.ref
+        WHERE ref IS NOT excluded.ref''',
+        refs)
+
+  def CollectGarbage(self) -> int:
+    """Deletes content no longer referenced by any row. Returns the number of deleted values."""
     cur = self.con.cursor()
     cur.execute(
-        'INSERT OR REPLACE INTO data VALUES (?, ?, ?, ?)',
-        (date_str, ticker, group, data))
+        'DELETE FROM content WHERE hash NOT IN (SELECT ref FROM data WHERE ref IS NOT NULL)')
     self.con.commit()
+    return cur.rowcount
+
+  def Recompress(self):
+    """Re-encodes all values with the configured codecs, then vacuums the file."""
+    for table, key in [('data', 'rowid'), ('content', 'hash')]:
+      cur = self.con.cursor()
+      last_key = b'' if key == 'hash' else 0
+      while True:
+        rows = cur.execute(
+            '''SELECT %s, grp, data FROM %s
+            WHERE %s > ? AND data IS NOT NULL ORDER BY %s LIMIT ?;''' % (key, table, key, key),
+            (last_key, _RECOMPRESS_BATCH_SIZE)).fetchall()
+        if not rows:
+          break
+        cur.executemany(
+            'UPDATE %s SET data = ? WHERE %s = ?' % (table, key),
+            ((self._Encode(group, codec.Decode(data)), k) for k, group, data in rows))
+        self.con.commit()
+        last_key = rows[-1][0]
+    self.con.execute('VACUUM')
+
+  def Seal(self, path: str):
+    """Writes a read-optimized copy of this DB to path, re-encoding values with the codecs.
+
+    Rows are clustered by (grp, ticker, date) in a WITHOUT ROWID table holding content hashes,
+    and each distinct value is stored once, in the order of its first row. Ranges of a ticker are
+    thus read sequentially. The file is written to a temporary path first and made read-only.
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    sealed = sqlite3.connect(tmp_path)
+    try:
+      sealed.execute('PRAGMA journal_mode = OFF;')
+      sealed.execute('PRAGMA synchronous = OFF;')
+      sealed.execute('''
+      CREATE TABLE data
+      (grp text, ticker text, date text, data BLOB, ref BLOB,
+       PRIMARY KEY(grp, ticker, date)) WITHOUT ROWID
+      ''')
+      sealed.execute('CREATE TABLE content (hash BLOB PRIMARY KEY, grp text, data BLOB)')
+      sealed.execute('CREATE INDEX %s ON data (grp, date, ticker)' % _CROSS_SECTION_INDEX)
+      hashes = set()
+      cur = self.con.cursor()
+      cur.execute(
+          'SELECT grp, ticker, date, %s FROM data ORDER BY grp, ticker, date;' % self.data_expr)
+      for group, ticker, date_str, value in cur:
+        value = codec.Decode(value)
+        ref = None
+        if isinstance(value, bytes):
+          ref = ContentHash(value)
+          if ref not in hashes:
+            hashes.add(ref)
+            sealed.execute(
+                'INSERT INTO content VALUES (?, ?, ?)', (ref, group, self._Encode(group, value)))
+          value = None
+        sealed.execute(
+            'INSERT INTO data VALUES (?, ?, ?, ?, ?)', (group, ticker, date_str, value, ref))
+      if self.has_features:
+        _CreateFeaturesTable(sealed.cursor())
+        sealed.executemany(
+            'INSERT INTO features VALUES (?, ?, ?, ?, ?)',
+            cur.execute('SELECT * FROM features ORDER BY grp, date, ticker, field_id;'))
+      if self.has_changes:
+        _CreateChangesTable(sealed.cursor())
+        sealed.executemany(
+            'INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?, ?)',
+            cur.execute('SELECT * FROM changes ORDER BY grp, date, ticker, field_id;'))
+      sealed.commit()
+      sealed.execute('VACUUM')
+    finally:
+      sealed.close()
+    fd = os.open(tmp_path, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+    os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, path)
+
+
+def ContentHash(data: bytes) -> bytes:
+  return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _CreateFeaturesTable(cur: sqlite3.Cursor):
+  """Creates the table of the numeric fields of data rows, keyed by storage field ids."""
+  cur.execute('''
+  CREATE TABLE IF NOT EXISTS features
+  (grp text, date text, ticker text, field_id INTEGER, value REAL,
+   PRIMARY KEY(grp, date, ticker, field_id)) WITHOUT ROWID
+  ''')
+  cur.execute(
+      'CREATE INDEX IF NOT EXISTS features_field_date ON features (field_id, date, value)')
+
+
+def _CreateChangesTable(cur: sqlite3.Cursor):
+  """Creates the table of the feature changes of data rows against the previous row."""
+  cur.execute('''
+  CREATE TABLE IF NOT EXISTS changes
+  (grp text, date text, ticker text, field_id INTEGER, prev_date text, old_value REAL,
+   new_value REAL,
+   PRIMARY KEY(grp, date, ticker, field_id)) WITHOUT ROWID
+  ''')
+  cur.execute('CREATE INDEX IF NOT EXISTS changes_field_date ON changes (field_id, date)')
+
+
+def _TickerClause(tickers: Iterable[str]) -> Tuple[str, List[str], set]:
+  """Returns the SQL clause and params filtering tickers, and the tickers to filter in Python.
+
+  Sets larger than _MAX_SQL_TICKERS are not bound into the query but returned for filtering.
+  """
+  if tickers is None:
+    return '', [], None
+  ticker_set = set(tickers)
+  if len(ticker_set) > _MAX_SQL_TICKERS:
+    return '', [], ticker_set
+  return ' AND ticker IN (%s)' % ','.join('?' * len(ticker_set)), sorted(ticker_set), None
 
 
 def GetQuarters(date_begin: datetime.datetime, date_end: datetime.datetime) -> str:
@@ -84,6 +662,15 @@ def GetQuarters(date_begin: datetime.datetime, date_end: datetime.datetime) -> s
     return result
 
 
+def GetQuarter(date_str: str) -> str:
+  d = GetDate(date_str)
+  return GetQuarters(d, d)[0]
+
+
+def CurrentQuarter() -> str:
+  return GetQuarter(datetime.datetime.now().strftime('%Y-%m-%d'))
+
+
 def GetDate(date_str: str) -> datetime.datetime:
   return datetime.datetime.strptime(date_str, '%Y-%m-%d')
 
@@ -97,22 +684,334 @@ def GetDaysAgoStr(days_ago: int) -> str:
 
 
 class ShardedSqliteStorage(object):
-  def __init__(self, db_dir: str):
+  """Storage sharded by quarter, with a pool of long-lived shard connections.
+
+  At most `max_open_shards` idle shards are kept open; the least recently used ones are closed
+  when the limit is exceeded. Shards in use by another thread are never closed.
+
+  `compression` maps groups to codec specs (see codec.DEFAULT_COMPRESSION). zstd codecs use the
+  group's dictionary trained by TrainDictionary(), which is kept in the system DB. Groups with a
+  dictionary default to zstd.
+
+  Shards deduplicate values by content unless `dedup` is False (see SqliteStorage).
+
+  Closed quarters can be sealed with Seal(): the shard file is replaced by a read-optimized,
+  immutable shard-YYYYqN.sealed.sqlite, which reads are routed to. Writes to sealed quarters raise
+  ShardSealedError.
+
+  `pragmas` and `read_only` apply to all connections (see SqliteStorage). A read-only storage
+  never creates shards: quarters without a shard file read as empty.
+
+  `projections` map groups to functions flattening their values into (field path, number) pairs,
+  written to the feature table of the shard in the same transaction as the rows. Field paths are
+  mapped to ids kept in the system DB. Features are queried with SQL, without decoding values:
+  see ReadFeature(), FeatureCrossSection() and AggregateFeature().
+
+  With `change_log`, the features of each written row are also compared to those of the previous
+  row of its ticker, and the differing fields are appended to the change table of the shard (see
+  ReadChanges()). The first row of a ticker has no changes.
+  """
+
+  def __init__(
+      self, db_dir: str, max_open_shards: int = _DEFAULT_MAX_OPEN_SHARDS,
+      compression: Dict[str, str] = None, dedup: bool = True, pragmas: Dict[str, Any] = None,
+      read_only: bool = False, projections: Dict[str, Projection] = None,
+      change_log: bool = False):
     self.db_dir = db_dir
-    self.system = SqliteStorage(self.db_dir, 'system')
-    self.shards: Dict[str, SqliteStorage] = {}
+    self.max_open_shards = max_open_shards
+    self.dedup = dedup
+    self.pragmas = pragmas
+    self.read_only = read_only
+    self.projections = projections or {}
+    self.change_log = change_log
+    self._field_ids: Dict[str, Dict[str, int]] = {}
+    self.compression = dict(compression or codec.DEFAULT_COMPRESSION)
+    self.system = SqliteStorage(self.db_dir, 'system', pragmas=pragmas, read_only=read_only)
+    dictionaries = self._LoadDictionaries()
+    # Groups with a trained dictionary use zstd unless configured otherwise.
+    if codec.zstandard is not None:
+      for group in dictionaries:
+        self.compression.setdefault(group, 'zstd')
+    self.codecs = CreateCodecs(self.compression, dictionaries)
+    self.shards: Dict[str, SqliteStorage] = collections.OrderedDict()
+    self._shard_refs: Dict[str, int] = {}
+    # Whether the quarter of each open shard is sealed.
+    self._sealed: Dict[str, bool] = {}
+    self._lock = threading.Lock()
+    self._system_lock = threading.Lock()
+    self._InitLatestIndex()
+    self._InitFeatureFields()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Close()
+
+  def Close(self):
+    """Closes all pooled shard connections and the system DB."""
+    with self._lock:
+      for shard in self.shards.values():
+        shard.Close()
+      self.shards.clear()
+      self._shard_refs.clear()
+      self._sealed.clear()
+    self.system.Close()
+
+  def _ShardPath(self, q: str, sealed: bool = False) -> str:
+    return os.path.join(self.db_dir, 'shard-%s%s.sqlite' % (q, '.sealed' if sealed else ''))
+
+  def _IsSealed(self, q: str) -> bool:
+    """Returns whether the quarter is sealed, cached while its shard is open."""
+    sealed = self._sealed.get(q)
+    if sealed is None:
+      sealed = os.path.exists(self._ShardPath(q, sealed=True))
+    return sealed
+
+  def FileGeneration(self, q: str = None) -> Tuple:
+    """Returns the (mtime, size) of the files of the quarter shard, or of the system DB if None.
+
+    The generation changes when any process commits to the shard (or WAL) file or seals the
+    quarter, without querying SQLite. Missing files are None.
+    """
+    path = self._ShardPath(q) if q else self.system.db_path
+    paths = [path, path + '-wal'] + ([self._ShardPath(q, sealed=True)] if q else [])
+    generation = []
+    for p in paths:
+      try:
+        st = os.stat(p)
+        generation.append((st.st_mtime_ns, st.st_size))
+      except FileNotFoundError:
+        generation.append(None)
+    return tuple(generation)
+
+  @contextlib.contextmanager
+  def _Shard(self, q: str, write: bool = False) -> Iterator[SqliteStorage]:
+    """Returns the pooled shard for the quarter, opening it if needed."""
+    if write and self._IsSealed(q):
+      raise ShardSealedError('Shard %s of %s is sealed' % (q, self.db_dir))
+    with self._lock:
+      shard = self.shards.get(q)
+      if shard is None:
+        self._sealed[q] = os.path.exists(self._ShardPath(q, sealed=True))
+        if self._sealed[q]:
+          shard = SqliteStorage(
+              self.db_dir, 'shard-%s.sealed' % q, self.codecs, pragmas=self.pragmas,
+              read_only=True, immutable=True)
+        else:
+          shard = SqliteStorage(
+              self.db_dir, 'shard-' + q, self.codecs, self.dedup, self.pragmas, self.read_only)
+        self.shards[q] = shard
+      self.shards.move_to_end(q)
+      self._shard_refs[q] = self._shard_refs.get(q, 0) + 1
+    try:
+      yield shard
+    finally:
+      with self._lock:
+        self._shard_refs[q] -= 1
+        self._EvictShards()
+
+  def _EvictShards(self):
+    """Closes least recently used idle shards beyond max_open_shards. Requires self._lock."""
+    excess = len(self.shards) - self.max_open_shards
+    for q in list(self.shards.keys()):
+      if excess <= 0:
+        break
+      if self._shard_refs.get(q, 0) > 0:
+        continue
+      self.shards.pop(q).Close()
+      self._shard_refs.pop(q, None)
+      self._sealed.pop(q, None)
+      excess -= 1
+
+  def _InitLatestIndex(self):
+    """Creates the latest-date index in the system DB, building it from shards if new."""
+    cur = self.system.con.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'latest';")
+    exists = cur.fetchone() is not None
+    self._has_latest_index = exists or not self.read_only
+    if self.read_only:
+      return
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS latest
+    (ticker text, grp text, date text,
+     PRIMARY KEY(ticker,grp))
+    ''')
+    self.system.con.commit()
+    if not exists:
+      self.RebuildLatestIndex()
+
+  def _InitFeatureFields(self):
+    """Creates the table of the feature field ids in the system DB."""
+    self._has_feature_fields = self.system._HasTable('feature_fields')
+    if self.read_only:
+      return
+    self.system.con.execute('''
+    CREATE TABLE IF NOT EXISTS feature_fields
+    (id INTEGER PRIMARY KEY, grp text, path text,
+     UNIQUE(grp, path))
+    ''')
+    self.system.con.commit()
+    self._has_feature_fields = True
+
+  def _UpdateLatestIndex(self, rows: Iterable[Row]):
+    """Advances the latest date of each (ticker, group) in rows."""
+    latest: Dict[Tuple[str, str], str] = {}
+    for ticker, date_str, _, group in rows:
+      key = (ticker, group)
+      if date_str > latest.get(key, ''):
+        latest[key] = date_str
+    with self._system_lock:
+      cur = self.system.con.cursor()
+      cur.executemany(
+          '''INSERT INTO latest VALUES (?, ?, ?)
+          ON CONFLICT(ticker, grp) DO UPDATE SET date = excluded.date
+          WHERE excluded.date > latest.date''',
+          ((ticker, group, date_str) for (ticker, group), date_str in latest.items()))
+      self.system.con.commit()
+
+  def RebuildLatestIndex(self):
+    """Reconstructs the latest-date index from all existing shards."""
+    rows = []
+    for q in self.ListQuarters():
+      with self._Shard(q) as shard:
+        cur = shard.con.cursor()
+        for ticker, group, date_str in cur.execute(
+            'SELECT ticker, grp, MAX(date) FROM data GROUP BY ticker, grp;'):
+          rows.append((ticker, date_str, None, group))
+    with self._system_lock:
+      self.system.con.execute('DELETE FROM latest')
+      self.system.con.commit()
+    self._UpdateLatestIndex(rows)
+    logging.info('Rebuilt latest index of %s from %d rows' % (self.db_dir, len(rows)))
+
+  def _LoadDictionaries(self) -> Dict[str, bytes]:
+    """Returns the trained zstd dictionaries by group, registering them for decoding."""
+    dictionaries = {}
+    cur = self.system.con.cursor()
+    for key, data in cur.execute(
+        "SELECT ticker, data FROM data WHERE grp = 'system' AND ticker LIKE ?;",
+        (_ZSTD_DICT_KEY + '%',)):
+      dictionaries[key[len(_ZSTD_DICT_KEY):]] = data
+      if codec.zstandard is not None:
+        codec.RegisterZstdDictionary(data)
+    return dictionaries
+
+  def TrainDictionary(
+      self, group: str, max_samples: int = 5000, level: int = None) -> codec.Codec:
+    """Trains a zstd dictionary on the latest values of the group and compresses it with zstd.
+
+    Existing rows keep their codec until Recompress() is called.
+    """
+    samples = []
+    for q in reversed(self.ListQuarters()):
+      with self._Shard(q) as shard:
+        cur = shard.con.cursor()
+        for (data,) in cur.execute(
+            'SELECT %s FROM data WHERE grp = ? ORDER BY date DESC LIMIT ?;' % shard.data_expr,
+            (group, max_samples - len(samples))):
+          samples.append(codec.Decode(data))
+      if len(samples) >= max_samples:
+        break
+    dictionary = codec.TrainZstdDictionary(samples)
+    self.Set(_ZSTD_DICT_KEY + group, dictionary)
+    spec = 'zstd:%d' % level if level else 'zstd'
+    self.compression[group] = spec
+    self.codecs[group] = codec.Create(spec, dictionary)
+    logging.info('Trained zstd dictionary of %s on %d samples' % (group, len(samples)))
+    return self.codecs[group]
+
+  def Recompress(self, quarters: Iterable[str] = None):
+    """Re-encodes the shards (all unsealed ones by default) with the configured codecs."""
+    for q in quarters if quarters is not None else self.ListQuarters(sealed=False):
+      with self._Shard(q, write=True) as shard:
+        shard.Recompress()
+      logging.info('Recompressed shard %s' % q)
+
+  def CollectGarbage(self, quarters: Iterable[str] = None):
+    """Deletes unreferenced content from the shards (all unsealed ones by default)."""
+    for q in quarters if quarters is not None else self.ListQuarters(sealed=False):
+      with self._Shard(q, write=True) as shard:
+        deleted = shard.CollectGarbage()
+      logging.info('Deleted %d unreferenced values from shard %s' % (deleted, q))
+
+  def Seal(self, quarters: Iterable[str] = None) -> List[str]:
+    """Seals the given closed quarters, or all unsealed closed quarters. Returns the sealed ones.
+
+    Only seal quarters no other process writes to: a writer keeping the shard open would write to
+    the deleted file. Readers in other processes keep reading the old file until they reopen it.
+    """
+    current = CurrentQuarter()
+    if quarters is None:
+      quarters = [q for q in self.ListQuarters(sealed=False) if q < current]
+    sealed = []
+    for q in quarters:
+      if q >= current:
+        raise ValueError('Quarter %s is not closed yet' % q)
+      with self._Shard(q, write=True) as shard:
+        shard.Seal(self._ShardPath(q, sealed=True))
+      with self._lock:
+        shard = self.shards.pop(q, None)
+        if shard:
+          shard.Close()
+        self._shard_refs.pop(q, None)
+        self._sealed.pop(q, None)
+      path = self._ShardPath(q)
+      for suffix in ['', '-wal', '-shm']:
+        if os.path.exists(path + suffix):
+          os.remove(path + suffix)
+      logging.info('Sealed shard %s' % q)
+      sealed.append(q)
+    return sealed
+
+  def ListQuarters(self, sealed: bool = None) -> List[str]:
+    """Returns the quarters of all existing shards, in ascending order.
+
+    With `sealed` True or False, only the sealed or unsealed quarters are returned.
+    """
+    quarters = set()
+    for path in glob.glob(os.path.join(self.db_dir, 'shard-*.sqlite')):
+      match = _SHARD_FILE_RE.match(os.path.basename(path))
+      if match and (sealed is None or bool(match.group(2)) == sealed):
+        quarters.add(match.group(1))
+    if sealed is False:
+      quarters = set(q for q in quarters if not self._IsSealed(q))
+    return sorted(quarters)
+
+  def FeatureFields(self, group: str) -> List[str]:
+    """Returns the paths of the feature fields written for the group, sorted."""
+    if not self._has_feature_fields:
+      return []
+    with self._system_lock:
+      cur = self.system.con.cursor()
+      return [row[0] for row in cur.execute(
+          'SELECT path FROM feature_fields WHERE grp = ? ORDER BY path;', (group,))]
+
+  @contextlib.contextmanager
+  def System(self) -> Iterator[sqlite3.Connection]:
+    """Yields the connection of the system DB, for tables other than data, e.g. checkpoints."""
+    with self._system_lock:
+      yield self.system.con
 
   def Get(self, key: str) -> bytes:
-    return self.system.Get(key)
+    with self._system_lock:
+      return self.system.Get(key)
 
   def Set(self, key: str, val: str) -> bytes:
-    return self.system.Set(key, val)
+    with self._system_lock:
+      return self.system.Set(key, val)
+
+  def _HasShard(self, q: str) -> bool:
+    return q in self.shards or os.path.exists(self._ShardPath(q)) or self._IsSealed(q)
 
   def List(self, group: str='analysis', date_gte: str='2022-01-01') -> Dict[str, List[str]]:
-    quarters = GetQuarters(GetDate(date_gte), datetime.datetime.now())
+    existing = set(self.ListQuarters())
+    quarters = [
+        q for q in GetQuarters(GetDate(date_gte), datetime.datetime.now()) if q in existing]
     def DoList(q):
-      return SqliteStorage(self.db_dir, 'shard-' + q).List(group, date_gte)
-    with ThreadPoolExecutor(max_workers = len(quarters)) as executor:
+      with self._Shard(q) as shard:
+        return shard.List(group, date_gte)
+    with ThreadPoolExecutor(max_workers = max(1, len(quarters))) as executor:
       data = executor.map(DoList, quarters)
       result: Dict[str, List[str]] = {}
       for elem in data:
@@ -122,19 +1021,429 @@ class ShardedSqliteStorage(object):
             res.append(d)
       return result
 
+  def Rows(
+      self, quarters: Iterable[str] = None, after: Tuple[str, str, str] = None) -> Iterator[Row]:
+    """Yields all (ticker, date_str, data, group) rows of the shards (all by default).
+
+    Rows are ordered by group, ticker and date within each shard. With `after`, a (group, ticker,
+    date), only the rows following it in each shard are yielded.
+    """
+    for q in quarters if quarters is not None else self.ListQuarters():
+      with self._Shard(q) as shard:
+        yield from shard.Rows(after)
+
   def Read(self, ticker: str, date_str: str, group='analysis') -> bytes:
-    d = GetDate(date_str)
-    q = GetQuarters(d, d)[0]
-    return SqliteStorage(self.db_dir, 'shard-' + q).Read(ticker, date_str, group)
+    q = GetQuarter(date_str)
+    if self.read_only and not self._HasShard(q):
+      return None
+    with self._Shard(q) as shard:
+      return shard.Read(ticker, date_str, group)
+
+  def ReadRange(
+      self, ticker: str, date_from: str, date_to: str, group='analysis',
+      decode=None) -> Iterator[Tuple[str, Any]]:
+    """Yields (date, data) of the ticker for date_from <= date <= date_to, in date order.
+
+    Only the existing shards overlapping the range are visited, with one query each. If `decode`
+    is a proto message class (e.g. yfpb.Info), data is yielded as parsed messages.
+    """
+    existing = set(self.ListQuarters())
+    for q in GetQuarters(GetDate(date_from), GetDate(date_to)):
+      if q not in existing:
+        continue
+      with self._Shard(q) as shard:
+        for date_str, data in shard.ReadRange(ticker, date_from, date_to, group):
+          yield date_str, decode.FromString(data) if decode else data
+
+  def Scan(
+      self, group: str, date_from: str, date_to: str, tickers: Iterable[str] = None,
+      quarters: Iterable[str] = None) -> Iterator[Tuple[str, str, bytes]]:
+    """Yields (date, ticker, data) of all or the given tickers, shard by shard in date order.
+
+    `quarters` restricts the scan to a subset of the shards overlapping the range.
+    """
+    tickers = list(tickers) if tickers is not None else None
+    existing = set(self.ListQuarters())
+    for q in GetQuarters(GetDate(date_from), GetDate(date_to)):
+      if q not in existing or (quarters is not None and q not in quarters):
+        continue
+      with self._Shard(q) as shard:
+        yield from shard.Scan(group, date_from, date_to, tickers)
+
+  def ReadCrossSection(
+      self, date_str: str, group='analysis', tickers: Iterable[str] = None,
+      max_staleness_days: int = None, decode=None) -> Iterator[Tuple[str, str, Any]]:
+    """Yields (ticker, date, data) of the latest row of each ticker on or before date_str.
+
+    Rows more than `max_staleness_days` older than date_str are ignored (by default, any row
+    qualifies). Shards are visited newest first, with one indexed query each, and each ticker is
+    yielded once: in ticker order within a shard, but not across shards. If `decode` is a proto
+    message class, data is yielded as parsed messages.
+    """
+    date_from = ''
+    if max_staleness_days is not None:
+      date_from = (
+          GetDate(date_str) - datetime.timedelta(days=max_staleness_days)).strftime('%Y-%m-%d')
+    q_from = GetQuarter(date_from) if date_from else ''
+    q_to = GetQuarter(date_str)
+    tickers = list(tickers) if tickers is not None else None
+    seen = set()
+    for q in reversed(self.ListQuarters()):
+      if q > q_to or q < q_from:
+        continue
+      remaining = [t for t in tickers if t not in seen] if tickers is not None else None
+      if remaining is not None and not remaining:
+        break
+      with self._Shard(q) as shard:
+        for ticker, latest_date, data in shard.ReadCrossSection(
+            group, date_from, date_str, remaining):
+          if ticker not in seen:
+            seen.add(ticker)
+            yield ticker, latest_date, decode.FromString(data) if decode else data
+
+  def ReadLatestDate(self, ticker: str, group='analysis') -> str:
+    """Returns the latest date written for the ticker, or None."""
+    if not self._has_latest_index:
+      # Read-only storage written before the index existed: search the shards, newest first.
+      for q in reversed(self.ListQuarters()):
+        with self._Shard(q) as shard:
+          cur = shard.con.cursor()
+          cur.execute(
+              'SELECT MAX(date) FROM data WHERE ticker = ? AND grp = ?;', (ticker, group))
+          row = cur.fetchone()
+        if row[0]:
+          return row[0]
+      return None
+    with self._system_lock:
+      cur = self.system.con.cursor()
+      cur.execute('SELECT date FROM latest WHERE ticker = ? AND grp = ?;', (ticker, group))
+      row = cur.fetchone()
+    return row[0] if row else None
 
   def ReadLatest(self, ticker: str, group='analysis') -> bytes:
-    tickers = self.List(group, GetDaysAgoStr(30))
-    if ticker not in tickers:
+    latest_date = self.ReadLatestDate(ticker, group)
+    if not latest_date:
       return None
-    latest_date = tickers[ticker][-1]
     return self.Read(ticker, latest_date, group)
 
   def Write(self, ticker: str, date_str: str, data: bytes, group='analysis'):
-    d = GetDate(date_str)
-    q = GetQuarters(d, d)[0]
-    return SqliteStorage(self.db_dir, 'shard-' + q).Write(ticker, date_str, data, group)
+    rows = [(ticker, date_str, data, group)]
+    features = self._Project(rows)
+    changes = self._Changes(features)
+    with self._Shard(GetQuarter(date_str), write=True) as shard:
+      shard.WriteMany(rows, features, changes)
+    self._UpdateLatestIndex(rows)
+
+  def _FieldIds(self, group: str, paths: Iterable[str]) -> Dict[str, int]:
+    """Returns the feature field ids of the paths of the group, allocating missing ones."""
+    ids = self._field_ids.setdefault(group, {})
+    missing = [p for p in paths if p not in ids]
+    if missing:
+      with self._system_lock:
+        cur = self.system.con.cursor()
+        cur.executemany(
+            'INSERT OR IGNORE INTO feature_fields (grp, path) VALUES (?, ?)',
+            ((group, p) for p in missing))
+        self.system.con.commit()
+        for field_id, path in cur.execute(
+            'SELECT id, path FROM feature_fields WHERE grp = ?;', (group,)):
+          ids[path] = field_id
+    return ids
+
+  def _Project(self, rows: Iterable[Row]) -> Features:
+    """Returns the features of the rows of projected groups."""
+    features = {}
+    for ticker, date_str, data, group in rows:
+      projection = self.projections.get(group)
+      if projection is None or not isinstance(data, bytes):
+        continue
+      values = list(projection(data))
+      ids = self._FieldIds(group, [path for path, _ in values])
+      features[(group, date_str, ticker)] = [(ids[path], value) for path, value in values]
+    return features
+
+  def _ReadLatestDates(self, keys: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], str]:
+    """Returns the latest date written for each (group, ticker) key, missing if None."""
+    keys = list(keys)
+    latest = {}
+    with self._system_lock:
+      cur = self.system.con.cursor()
+      for i in range(0, len(keys), _MAX_SQL_KEYS):
+        chunk = keys[i:i + _MAX_SQL_KEYS]
+        for group, ticker, date_str in cur.execute(
+            'SELECT grp, ticker, date FROM latest WHERE (grp, ticker) IN (VALUES %s);'
+            % ','.join(['(?, ?)'] * len(chunk)),
+            [param for key in chunk for param in key]):
+          latest[(group, ticker)] = date_str
+    return latest
+
+  def _PreviousFeatures(
+      self, keys: Iterable[Tuple[str, str, str]]) -> Dict[Tuple[str, str, str], Tuple[str, Any]]:
+    """Returns the (date, features) of the previous stored row of each (group, date, ticker).
+
+    Shards are searched newest first, with one query per shard for all keys whose previous row
+    may be in it: the shard of the latest date of the ticker if it is earlier (appends), else the
+    shards up to the quarter of the key (rewrites and out of order writes). Features are None for
+    rows without stored features, see SqliteStorage.ReadPreviousFeatures().
+    """
+    keys = list(keys)
+    latest = self._ReadLatestDates(set((group, ticker) for group, _, ticker in keys))
+    pending = {}
+    for key in keys:
+      group, date_str, ticker = key
+      latest_date = latest.get((group, ticker))
+      if latest_date is not None and latest_date < date_str:
+        pending[key] = GetQuarter(latest_date)
+      elif latest_date is not None or not self._has_latest_index:
+        pending[key] = GetQuarter(date_str)
+    previous = {}
+    for q in reversed(self.ListQuarters()):
+      if not pending:
+        break
+      shard_keys = [key for key, last_q in pending.items() if q <= last_q]
+      if not shard_keys:
+        continue
+      with self._Shard(q) as shard:
+        found = shard.ReadPreviousFeatures(shard_keys)
+      for key, value in found.items():
+        previous[key] = value
+        del pending[key]
+    return previous
+
+  def _StoredFeatures(self, group: str, ticker: str, date_str: str) -> Dict[int, float]:
+    """Returns the features of a stored row without stored features, by projecting its value."""
+    data = self.Read(ticker, date_str, group)
+    if data is None:
+      return {}
+    return dict(self._Project([(ticker, date_str, data, group)]).get(
+        (group, date_str, ticker), []))
+
+  def _Changes(self, features: Features) -> Changes:
+    """Returns the changes of the features of each row against the previous row of its ticker.
+
+    The previous row is the latest earlier one, among the given rows (which replace the stored
+    ones of the same date) or stored. Stored values are only decoded for rows without stored
+    features. Returns None without change_log.
+    """
+    if not self.change_log:
+      return None
+    dates: Dict[Tuple[str, str], List[str]] = {}
+    for group, date_str, ticker in features:
+      dates.setdefault((group, ticker), []).append(date_str)
+    previous = self._PreviousFeatures(features)
+    changes = {}
+    for (group, date_str, ticker), values in features.items():
+      prev_date, prev = previous.get((group, date_str, ticker), (None, None))
+      earlier = [d for d in dates[(group, ticker)] if d < date_str]
+      if earlier and (prev_date is None or max(earlier) >= prev_date):
+        prev_date = max(earlier)
+        prev = dict(features[(group, prev_date, ticker)])
+      elif prev_date is not None:
+        prev = dict(prev) if prev is not None else self._StoredFeatures(group, ticker, prev_date)
+      else:
+        changes[(group, date_str, ticker)] = []
+        continue
+      new = dict(values)
+      changes[(group, date_str, ticker)] = [
+          (field_id, prev_date, prev.get(field_id), new.get(field_id))
+          for field_id in sorted(set(prev) | set(new))
+          if prev.get(field_id) != new.get(field_id)]
+    return changes
+
+  def _FieldPaths(self, group: str) -> Dict[int, str]:
+    if not self._has_feature_fields:
+      return {}
+    with self._system_lock:
+      cur = self.system.con.cursor()
+      return dict(cur.execute('SELECT id, path FROM feature_fields WHERE grp = ?;', (group,)))
+
+  def FieldId(self, group: str, path: str) -> int:
+    """Returns the id of a feature field, or None if it was never written."""
+    if path not in self._field_ids.get(group, {}):
+      with self._system_lock:
+        cur = self.system.con.cursor()
+        if self._has_feature_fields:
+          cur.execute(
+              'SELECT id FROM feature_fields WHERE grp = ? AND path = ?;', (group, path))
+          row = cur.fetchone()
+        else:
+          row = None
+      if row is None:
+        return None
+      self._field_ids.setdefault(group, {})[path] = row[0]
+    return self._field_ids[group][path]
+
+  def BackfillFeatures(self, quarters: Iterable[str] = None) -> int:
+    """Projects the existing rows of the shards (all unsealed ones by default) into features.
+
+    With change_log, the changes of the rows are written too. Sealed shards are immutable:
+    backfill quarters before sealing them. Returns the number of projected rows.
+    """
+    total = 0
+    for q in quarters if quarters is not None else self.ListQuarters(sealed=False):
+      with self._Shard(q, write=True) as shard:
+        cur = shard.con.cursor()
+        for group in sorted(self.projections):
+          last_rowid = 0
+          while True:
+            rows = cur.execute(
+                '''SELECT rowid, ticker, date, %s FROM data
+                WHERE grp = ? AND rowid > ? ORDER BY rowid LIMIT ?;''' % shard.data_expr,
+                (group, last_rowid, _BACKFILL_BATCH_SIZE)).fetchall()
+            if not rows:
+              break
+            features = self._Project(
+                (ticker, date_str, codec.Decode(data), group)
+                for _, ticker, date_str, data in rows)
+            shard.WriteFeatures(features, self._Changes(features))
+            last_rowid = rows[-1][0]
+            total += len(rows)
+      logging.info('Backfilled the features of shard %s' % q)
+    return total
+
+  def ReadFeature(
+      self, group: str, path: str, date_from: str, date_to: str,
+      tickers: Iterable[str] = None) -> Iterator[Tuple[str, str, float]]:
+    """Yields (date, ticker, value) of a feature for date_from <= date <= date_to.
+
+    Values are read from the feature table only, in date and ticker order.
+    """
+    field_id = self.FieldId(group, path)
+    if field_id is None:
+      return
+    tickers = list(tickers) if tickers is not None else None
+    existing = set(self.ListQuarters())
+    for q in GetQuarters(GetDate(date_from), GetDate(date_to)):
+      if q in existing:
+        with self._Shard(q) as shard:
+          yield from shard.ReadFeature(field_id, date_from, date_to, tickers)
+
+  def FeatureCrossSection(
+      self, date_str: str, group: str, path: str, tickers: Iterable[str] = None,
+      max_staleness_days: int = None) -> Iterator[Tuple[str, str, float]]:
+    """Yields (ticker, date, value) of the latest value of a feature on or before date_str.
+
+    Like ReadCrossSection(), but from the feature table.
+    """
+    field_id = self.FieldId(group, path)
+    if field_id is None:
+      return
+    date_from = ''
+    if max_staleness_days is not None:
+      date_from = (
+          GetDate(date_str) - datetime.timedelta(days=max_staleness_days)).strftime('%Y-%m-%d')
+    tickers = list(tickers) if tickers is not None else None
+    seen = set()
+    for q in reversed(self.ListQuarters()):
+      if q > GetQuarter(date_str) or (date_from and q < GetQuarter(date_from)):
+        continue
+      with self._Shard(q) as shard:
+        for ticker, latest_date, value in shard.FeatureCrossSection(
+            field_id, date_from, date_str, tickers):
+          if ticker not in seen:
+            seen.add(ticker)
+            yield ticker, latest_date, value
+
+  def AggregateFeature(
+      self, group: str, path: str, date_from: str, date_to: str,
+      func: str = 'AVG') -> Iterator[Tuple[str, int, float]]:
+    """Yields (date, number of values, func(values)) of a feature across tickers, by date.
+
+    func is a SQL aggregate function: AVG, MIN, MAX, SUM, TOTAL or COUNT.
+    """
+    field_id = self.FieldId(group, path)
+    if field_id is None:
+      return
+    existing = set(self.ListQuarters())
+    for q in GetQuarters(GetDate(date_from), GetDate(date_to)):
+      if q in existing:
+        with self._Shard(q) as shard:
+          yield from shard.AggregateFeature(field_id, date_from, date_to, func)
+
+  def ReadChanges(
+      self, group: str, date_from: str, date_to: str, paths: Iterable[str] = None,
+      tickers: Iterable[str] = None) -> Iterator[Tuple[str, str, str, str, float, float]]:
+    """Yields (date, ticker, field path, previous date, old value, new value) changes.
+
+    Changes of rows with date_from <= date <= date_to are yielded in date and ticker order,
+    optionally for the given field paths and tickers only. Fields missing from the previous or
+    the new row have a None old or new value.
+    """
+    field_paths = self._FieldPaths(group)
+    field_ids = None
+    if paths is not None:
+      field_ids = [self.FieldId(group, path) for path in paths]
+      field_ids = [field_id for field_id in field_ids if field_id is not None]
+      if not field_ids:
+        return
+    tickers = list(tickers) if tickers is not None else None
+    existing = set(self.ListQuarters())
+    for q in GetQuarters(GetDate(date_from), GetDate(date_to)):
+      if q not in existing:
+        continue
+      with self._Shard(q) as shard:
+        for date_str, ticker, field_id, prev_date, old, new in shard.ReadChanges(
+            group, date_from, date_to, field_ids, tickers):
+          yield date_str, ticker, field_paths[field_id], prev_date, old, new
+
+  def WriteMany(self, rows: Iterable[Row]):
+    """Writes (ticker, date_str, data, group) rows with one transaction per quarter shard."""
+    rows_by_quarter: Dict[str, List[Row]] = {}
+    for row in rows:
+      rows_by_quarter.setdefault(GetQuarter(row[1]), []).append(row)
+    # Fail before writing any shard.
+    for q in rows_by_quarter:
+      if self._IsSealed(q):
+        raise ShardSealedError('Shard %s of %s is sealed' % (q, self.db_dir))
+    for q, shard_rows in sorted(rows_by_quarter.items()):
+      features = self._Project(shard_rows)
+      changes = self._Changes(features)
+      with self._Shard(q, write=True) as shard, _SHARD_WRITE_SECONDS.Time(
+          db=self.db_dir, quarter=q):
+        shard.WriteMany(shard_rows, features, changes)
+      self._UpdateLatestIndex(shard_rows)
+    if metrics.REGISTRY.enabled:
+      for shard_rows in rows_by_quarter.values():
+        for _, _, data, group in shard_rows:
+          _ROWS_WRITTEN.Inc(db=self.db_dir, group=group)
+          _BYTES_WRITTEN.Inc(len(data), db=self.db_dir, group=group)
+
+
+class BatchWriter(object):
+  """Buffers writes to a storage and commits them with WriteMany.
+
+  Rows are flushed once `batch_size` rows are pending, and on Flush() / exiting the context.
+  Rows stay buffered if a flush fails, so the next flush retries them. `before_flush` is called
+  before each flush, e.g. to flush rows another writer must commit first, and `on_flush` with the
+  rows of each successful flush.
+  """
+
+  def __init__(
+      self, db, batch_size: int = _DEFAULT_BATCH_SIZE,
+      on_flush: Callable[[List[Row]], None] = None, before_flush: Callable[[], None] = None):
+    self.db = db
+    self.batch_size = batch_size
+    self.on_flush = on_flush
+    self.before_flush = before_flush
+    self.rows: List[Row] = []
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.Flush()
+
+  def Write(self, ticker: str, date_str: str, data: bytes, group='analysis'):
+    self.rows.append((ticker, date_str, data, group))
+    if len(self.rows) >= self.batch_size:
+      self.Flush()
+
+  def Flush(self):
+    if not self.rows:
+      return
+    if self.before_flush:
+      self.before_flush()
+    self.db.WriteMany(self.rows)
+    rows, self.rows = self.rows, []
+    if self.on_flush:
+      self.on_flush(rows)
@@ -1,8 +1,13 @@
+import json
 import os
 import shutil
+import sqlite3
 import tempfile
 import unittest
+from unittest import mock
 
+from monitoring import metrics
+from storage import codec
 from storage import sqlite
 
 _DATE1 = '2022-01-01'
@@ -34,6 +39,42 @@ class TestSqliteStorage(unittest.TestCase):
       self.storage.Read('T', _DATE1, 'grp'), 'd1'.encode('utf-8'))
 
 
+  def testReadRange(self):
+    self.storage.Write('T', _DATE1, 'd1'.encode('utf-8'), 'grp')
+    self.storage.Write('T', _DATE3, 'd3'.encode('utf-8'), 'grp')
+    self.storage.Write('T', _DATE2, 'd2'.encode('utf-8'), 'grp')
+    self.storage.Write('T2', _DATE2, 'x'.encode('utf-8'), 'grp')
+    self.assertEqual(
+      list(self.storage.ReadRange('T', _DATE2, _DATE3, 'grp')),
+      [(_DATE2, 'd2'.encode('utf-8')), (_DATE3, 'd3'.encode('utf-8'))])
+
+  def testScan(self):
+    self.storage.Write('T1', _DATE1, 'd1'.encode('utf-8'), 'grp')
+    self.storage.Write('T2', _DATE2, 'd2'.encode('utf-8'), 'grp')
+    self.storage.Write('T3', _DATE2, 'd3'.encode('utf-8'), 'grp')
+    self.storage.Write('T1', _DATE3, 'd4'.encode('utf-8'), 'grp')
+    self.assertEqual(
+      list(self.storage.Scan('grp', _DATE1, _DATE2)),
+      [(_DATE1, 'T1', b'd1'), (_DATE2, 'T2', b'd2'), (_DATE2, 'T3', b'd3')])
+    self.assertEqual(
+      list(self.storage.Scan('grp', _DATE1, _DATE3, ['T1', 'T3'])),
+      [(_DATE1, 'T1', b'd1'), (_DATE2, 'T3', b'd3'), (_DATE3, 'T1', b'd4')])
+    self.assertEqual(
+      list(self.storage.Scan('grp', _DATE1, _DATE3, ['T%d' % i for i in range(1000)])),
+      list(self.storage.Scan('grp', _DATE1, _DATE3)))
+
+  def testRowsAfter(self):
+    self.storage.WriteMany([
+      ('T1', _DATE1, b'd1', 'grp'),
+      ('T1', _DATE2, b'd2', 'grp'),
+      ('T2', _DATE1, b'd3', 'grp'),
+      ('T1', _DATE1, b'd4', 'other'),
+    ])
+    self.assertEqual([row[2] for row in self.storage.Rows()], [b'd1', b'd2', b'd3', b'd4'])
+    self.assertEqual(
+        [row[2] for row in self.storage.Rows(('grp', 'T1', _DATE2))], [b'd3', b'd4'])
+    self.assertEqual(list(self.storage.Rows(('other', 'T1', _DATE1))), [])
+
   def testReadLatest(self):
     self.storage.Write('T', _DATE2, 'd2'.encode('utf-8'), 'grp')
     self.storage.Write('T', _DATE3, 'd3'.encode('utf-8'), 'grp')
@@ -41,6 +82,181 @@ class TestSqliteStorage(unittest.TestCase):
     self.assertEqual(
       self.storage.ReadLatest('T', 'grp'), 'd3'.encode('utf-8'))
 
+  def testReadCrossSection(self):
+    self.storage.Write('T1', _DATE1, b'd1', 'grp')
+    self.storage.Write('T1', _DATE2, b'd2', 'grp')
+    self.storage.Write('T2', _DATE1, b'd3', 'grp')
+    self.storage.Write('T2', _DATE3, b'd4', 'grp')
+    self.storage.Write('T3', _DATE2, b'd5', 'other')
+    self.assertEqual(
+      list(self.storage.ReadCrossSection('grp', _DATE1, _DATE2)),
+      [('T1', _DATE2, b'd2'), ('T2', _DATE1, b'd3')])
+    self.assertEqual(
+      list(self.storage.ReadCrossSection('grp', _DATE2, _DATE3, ['T2'])),
+      [('T2', _DATE3, b'd4')])
+    many = ['T%d' % i for i in range(1000)]
+    self.assertEqual(
+      list(self.storage.ReadCrossSection('grp', _DATE1, _DATE3, many)),
+      list(self.storage.ReadCrossSection('grp', _DATE1, _DATE3)))
+    self.assertTrue(self.storage.cross_section_index)
+
+  def testWriteMany(self):
+    self.storage.WriteMany([
+      ('T1', _DATE1, 'd1'.encode('utf-8'), 'grp'),
+      ('T1', _DATE2, 'd2'.encode('utf-8'), 'grp'),
+      ('T2', _DATE1, 'd3'.encode('utf-8'), 'grp'),
+    ])
+    self.assertEqual(self.storage.List('grp'),  {
+      'T1': [_DATE1, _DATE2],
+      'T2': [_DATE1],
+    })
+    self.assertEqual(self.storage.Read('T1', _DATE2, 'grp'), 'd2'.encode('utf-8'))
+
+  def testCompression(self):
+    data = b'{"key": "value"}' * 10
+    self.storage.Write('T', _DATE1, data, 'grp')
+    stored = self.storage.con.execute('SELECT data FROM data').fetchone()[0]
+    self.assertEqual(stored[0], codec.HEADER_ZLIB)
+    self.assertLess(len(stored), len(data))
+    self.assertEqual(self.storage.Read('T', _DATE1, 'grp'), data)
+
+  def testReadUncompressedRows(self):
+    self.storage.con.execute(
+        'INSERT INTO data (date, ticker, grp, data) VALUES (?, ?, ?, ?)',
+        (_DATE1, 'T', 'grp', b'legacy'))
+    self.assertEqual(self.storage.Read('T', _DATE1, 'grp'), b'legacy')
+    self.assertEqual(
+      list(self.storage.ReadRange('T', _DATE1, _DATE1, 'grp')), [(_DATE1, b'legacy')])
+
+  def testRecompress(self):
+    self.storage.con.execute(
+        'INSERT INTO data (date, ticker, grp, data) VALUES (?, ?, ?, ?)',
+        (_DATE1, 'T', 'grp', b'legacy' * 10))
+    self.storage.Recompress()
+    stored = self.storage.con.execute('SELECT data FROM data').fetchone()[0]
+    self.assertEqual(stored[0], codec.HEADER_ZLIB)
+    self.assertEqual(self.storage.Read('T', _DATE1, 'grp'), b'legacy' * 10)
+
+  def testLegacySchema(self):
+    self.storage.con.execute('DROP TABLE data')
+    self.storage.con.execute('DROP TABLE content')
+    self.storage.con.execute(
+        'CREATE TABLE data (date text, ticker text, grp text, data BLOB, UNIQUE(date,ticker,grp))')
+    self.storage.con.execute(
+        'INSERT INTO data VALUES (?, ?, ?, ?)', (_DATE1, 'T', 'grp', b'legacy'))
+    self.storage.con.commit()
+    self.storage.Close()
+    self.storage = sqlite.SqliteStorage(self.tmp_dir, dedup=True)
+    self.assertEqual(self.storage.Read('T', _DATE1, 'grp'), b'legacy')
+    self.storage.Write('T', _DATE2, b'new', 'grp')
+    self.assertEqual(self.storage.Read('T', _DATE2, 'grp'), b'new')
+
+  def testReadOnlyLegacySchema(self):
+    self.storage.con.execute('DROP TABLE data')
+    self.storage.con.execute('DROP TABLE content')
+    self.storage.con.execute(
+        'CREATE TABLE data (date text, ticker text, grp text, data BLOB, UNIQUE(date,ticker,grp))')
+    self.storage.con.execute(
+        'INSERT INTO data VALUES (?, ?, ?, ?)', (_DATE1, 'T', 'grp', b'legacy'))
+    self.storage.con.commit()
+    reader = sqlite.SqliteStorage(self.tmp_dir, read_only=True)
+    self.assertEqual(reader.Read('T', _DATE1, 'grp'), b'legacy')
+    self.assertEqual(list(reader.ReadRange('T', _DATE1, _DATE2, 'grp')), [(_DATE1, b'legacy')])
+    # The schema is left untouched.
+    columns = [row[1] for row in self.storage.con.execute('PRAGMA table_info(data)')]
+    self.assertNotIn('ref', columns)
+    reader.Close()
+
+  def testReadOnly(self):
+    self.storage.Write('T', _DATE1, b'd1', 'grp')
+    reader = sqlite.SqliteStorage(self.tmp_dir, read_only=True, pragmas={'journal_mode': 'WAL'})
+    self.assertEqual(reader.Read('T', _DATE1, 'grp'), b'd1')
+    with self.assertRaises(sqlite3.OperationalError):
+      reader.Write('T', _DATE2, b'd2', 'grp')
+    reader.Close()
+    with self.assertRaises(sqlite3.OperationalError):
+      sqlite.SqliteStorage(self.tmp_dir, 'missing', read_only=True)
+
+  def testWalConcurrentReader(self):
+    self.storage.Close()
+    self.storage = sqlite.SqliteStorage(
+        self.tmp_dir, pragmas=sqlite.PRAGMA_PROFILES['wal'], dedup=True)
+    self.assertEqual(self.storage.con.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+    self.assertEqual(self.storage.con.execute('PRAGMA synchronous').fetchone()[0], 1)
+    self.storage.Write('T', _DATE1, b'd1', 'grp')
+    reader = sqlite.SqliteStorage(
+        self.tmp_dir, read_only=True, pragmas=sqlite.PRAGMA_PROFILES['wal'])
+    # Readers see the last commit while a write transaction is pending.
+    self.storage.con.execute('BEGIN EXCLUSIVE')
+    self.storage.con.execute("DELETE FROM data WHERE ticker = 'T'")
+    self.assertEqual(reader.Read('T', _DATE1, 'grp'), b'd1')
+    self.storage.con.commit()
+    self.assertIsNone(reader.Read('T', _DATE1, 'grp'))
+    reader.Close()
+
+  def testParsePragmas(self):
+    self.assertEqual(sqlite.ParsePragmas(''), {})
+    self.assertEqual(sqlite.ParsePragmas('wal'), sqlite.PRAGMA_PROFILES['wal'])
+    pragmas = sqlite.ParsePragmas('wal, cache_size=-65536')
+    self.assertEqual(pragmas['journal_mode'], 'WAL')
+    self.assertEqual(pragmas['cache_size'], '-65536')
+    self.assertEqual(sqlite.ParsePragmas('mmap_size=0'), {'mmap_size': '0'})
+    with self.assertRaises(ValueError):
+      sqlite.ParsePragmas('fast')
+    with self.assertRaises(ValueError):
+      sqlite.SqliteStorage(self.tmp_dir, pragmas={'cache_size': '1; DROP TABLE data'})
+
+  def testDedup(self):
+    self.storage.Close()
+    self.storage = sqlite.SqliteStorage(self.tmp_dir, dedup=True)
+    self.storage.WriteMany([
+      ('T1', _DATE1, b'same', 'grp'),
+      ('T1', _DATE2, b'same', 'grp'),
+      ('T2', _DATE2, b'other', 'grp'),
+    ])
+    self.storage.Write('T1', _DATE3, b'same', 'grp')
+    self.assertEqual(self.storage.con.execute('SELECT COUNT(*) FROM content').fetchone()[0], 2)
+    self.assertEqual(self.storage.Read('T1', _DATE2, 'grp'), b'same')
+    self.assertEqual(self.storage.ReadLatest('T1', 'grp'), b'same')
+    self.assertEqual(
+      [row[2] for row in self.storage.Scan('grp', _DATE1, _DATE3)],
+      [b'same', b'same', b'other', b'same'])
+    self.assertEqual(self.storage.List('grp'), {'T1': [_DATE1, _DATE2, _DATE3], 'T2': [_DATE2]})
+
+  def testDedupRewrite(self):
+    self.storage.Close()
+    self.storage = sqlite.SqliteStorage(self.tmp_dir, dedup=True)
+    self.storage.Write('T', _DATE1, b'v1', 'grp')
+    changes = self.storage.con.total_changes
+    self.storage.Write('T', _DATE1, b'v1', 'grp')
+    self.assertEqual(self.storage.con.total_changes, changes)
+
+    self.storage.Write('T', _DATE1, b'v2', 'grp')
+    self.assertEqual(self.storage.Read('T', _DATE1, 'grp'), b'v2')
+    self.assertEqual(self.storage.CollectGarbage(), 1)
+    self.assertEqual(self.storage.Read('T', _DATE1, 'grp'), b'v2')
+
+  def testDedupConcurrentGarbageCollection(self):
+    self.storage.Close()
+    self.storage = sqlite.SqliteStorage(self.tmp_dir, dedup=True)
+    self.storage.Write('T', _DATE1, b'v1', 'grp')
+    self.storage.Write('T', _DATE1, b'v2', 'grp')
+    # v1 is unreferenced, until a GC in another process races with a write referencing it again.
+    other = sqlite.SqliteStorage(self.tmp_dir, dedup=True)
+    other.con.execute('PRAGMA busy_timeout = 0')
+    content_hash = sqlite.ContentHash
+    def ContentHash(data):
+      with self.assertRaises(sqlite3.OperationalError):
+        other.CollectGarbage()
+      return content_hash(data)
+    sqlite.ContentHash = ContentHash
+    try:
+      self.storage.Write('T', _DATE2, b'v1', 'grp')
+    finally:
+      sqlite.ContentHash = content_hash
+    self.assertEqual(self.storage.Read('T', _DATE2, 'grp'), b'v1')
+    other.Close()
+
   def testGetSet(self):
     self.storage.Set('key1', 'val1')
     self.assertEqual(self.storage.Get('key1'), 'val1')
@@ -60,6 +276,7 @@ class TestShardedSqliteStorage(unittest.TestCase):
     self._Write('2021-12-01')
 
   def tearDown(self) -> None:
+    self.storage.Close()
     shutil.rmtree(self.tmp_dir)
 
   def _Write(self, date_str: str):
@@ -80,10 +297,484 @@ class TestShardedSqliteStorage(unittest.TestCase):
     self._Write(date)
     self.assertEqual(self.storage.ReadLatest('T'), date.encode('utf-8'))
 
+  def testReadRange(self):
+    self._Write('2021-01-15')
+    self.assertEqual(
+      list(self.storage.ReadRange('T', '2020-01-01', '2021-01-15')),
+      [(d, d.encode('utf-8')) for d in ['2020-02-01', '2021-01-01', '2021-01-15']])
+    self.assertEqual(list(self.storage.ReadRange('T', '2019-01-01', '2019-12-31')), [])
+    self.assertEqual(self.storage.ListQuarters(), ['2020q1', '2021q1', '2021q4'])
+
+  def testReadRangeDecode(self):
+    class Decoder(object):
+      @staticmethod
+      def FromString(data):
+        return data.decode('utf-8')
+    self.assertEqual(
+      list(self.storage.ReadRange('T', '2021-12-01', '2021-12-31', decode=Decoder)),
+      [('2021-12-01', '2021-12-01')])
+
+  def testScan(self):
+    self.storage.Write('T2', '2021-01-01', b'x')
+    self.assertEqual(
+      list(self.storage.Scan('analysis', '2021-01-01', '2021-12-31', ['T2'])),
+      [('2021-01-01', 'T2', b'x')])
+    self.assertEqual(
+      [row[0] for row in self.storage.Scan('analysis', '2020-01-01', '2021-12-31')],
+      ['2020-02-01', '2021-01-01', '2021-01-01', '2021-02-01', '2021-12-01'])
+    self.assertEqual(
+      [row[0] for row in self.storage.Scan(
+          'analysis', '2020-01-01', '2021-12-31', quarters=['2021q4'])],
+      ['2021-12-01'])
+
+  def testReadLatestWithoutTimeWindow(self):
+    self.assertEqual(self.storage.ReadLatest('T'), '2021-12-01'.encode('utf-8'))
+    self.assertEqual(self.storage.ReadLatestDate('T'), '2021-12-01')
+    self.assertIsNone(self.storage.ReadLatest('T', 'other'))
+    self.assertIsNone(self.storage.ReadLatest('nonexist'))
+
+  def testReadLatestAfterWriteMany(self):
+    self.storage.WriteMany([
+      ('T', '2022-03-01', b'a', 'analysis'),
+      ('T', '2021-06-01', b'b', 'analysis'),
+    ])
+    self.assertEqual(self.storage.ReadLatest('T'), b'a')
+
+  def testRebuildLatestIndex(self):
+    self.storage.system.con.execute('DELETE FROM latest')
+    self.assertIsNone(self.storage.ReadLatest('T'))
+    self.storage.RebuildLatestIndex()
+    self.assertEqual(self.storage.ReadLatest('T'), '2021-12-01'.encode('utf-8'))
+
+  def testLatestIndexBuiltForExistingShards(self):
+    self.storage.system.con.execute('DROP TABLE latest')
+    self.storage.system.con.commit()
+    self.storage.Close()
+    self.storage = sqlite.ShardedSqliteStorage(self.tmp_dir)
+    self.assertEqual(self.storage.ReadLatest('T'), '2021-12-01'.encode('utf-8'))
+
+  def testListQuarters(self):
+    self.assertEqual(self.storage.ListQuarters(), ['2020q1', '2021q1', '2021q4'])
+
+  def testShardPoolReusesConnections(self):
+    shard = self.storage.shards['2021q1']
+    self._Write('2021-01-02')
+    self.assertIs(self.storage.shards['2021q1'], shard)
+    self.assertEqual(self.storage.Read('T', '2021-01-02'), '2021-01-02'.encode('utf-8'))
+
+  def testShardPoolEvictsLeastRecentlyUsed(self):
+    self.storage.max_open_shards = 2
+    self.storage.Read('T', '2020-02-01')
+    self.storage.Read('T', '2021-12-01')
+    self.assertEqual(list(self.storage.shards.keys()), ['2020q1', '2021q4'])
+    self.assertEqual(self.storage.Read('T', '2021-01-01'), '2021-01-01'.encode('utf-8'))
+    self.assertEqual(list(self.storage.shards.keys()), ['2021q4', '2021q1'])
+
+  def testWriteMany(self):
+    self.storage.WriteMany([
+      ('T2', '2020-03-01', b'a', 'analysis'),
+      ('T2', '2021-12-02', b'b', 'analysis'),
+    ])
+    self.assertEqual(self.storage.Read('T2', '2020-03-01'), b'a')
+    self.assertEqual(self.storage.Read('T2', '2021-12-02'), b'b')
+
+  def testWriteManyMetrics(self):
+    metrics.REGISTRY.Reset()
+    metrics.Enable()
+    try:
+      self.storage.WriteMany([
+        ('T2', '2020-03-01', b'a', 'analysis'),
+        ('T2', '2020-03-02', b'bc', 'analysis'),
+        ('T2', '2021-12-02', b'd', 'info'),
+      ])
+    finally:
+      metrics.Enable(False)
+    db = self.storage.db_dir
+    self.assertEqual(sqlite._ROWS_WRITTEN.Get(db=db, group='analysis'), 2)
+    self.assertEqual(sqlite._BYTES_WRITTEN.Get(db=db, group='analysis'), 3)
+    self.assertEqual(sqlite._SHARD_WRITE_SECONDS.Get(db=db, quarter='2020q1')[0], 1)
+    self.assertEqual(sqlite._SHARD_WRITE_SECONDS.Get(db=db, quarter='2021q4')[0], 1)
+    shard_path = os.path.join(db, 'shard-2020q1.sqlite')
+    self.assertEqual(sqlite._COMMIT_SECONDS.Get(db=shard_path)[0], 1)
+    metrics.REGISTRY.Reset()
+
+  def testBatchWriter(self):
+    writer = sqlite.BatchWriter(self.storage, batch_size=2)
+    writer.Write('T2', '2021-01-01', b'a')
+    self.assertIsNone(self.storage.Read('T2', '2021-01-01'))
+    writer.Write('T2', '2021-01-02', b'b')
+    self.assertEqual(self.storage.Read('T2', '2021-01-01'), b'a')
+    writer.Write('T2', '2021-01-03', b'c')
+    self.assertEqual(writer.rows, [('T2', '2021-01-03', b'c', 'analysis')])
+    writer.Flush()
+    self.assertEqual(self.storage.Read('T2', '2021-01-03'), b'c')
+
+  def testBatchWriterOnFlush(self):
+    flushed = []
+    writer = sqlite.BatchWriter(self.storage, batch_size=2, on_flush=flushed.append)
+    writer.Write('T2', '2021-01-01', b'a')
+    self.assertEqual(flushed, [])
+    writer.Write('T2', '2021-01-02', b'b')
+    writer.Write('T2', '2021-01-03', b'c')
+    writer.Flush()
+    writer.Flush()
+    self.assertEqual(flushed, [
+      [('T2', '2021-01-01', b'a', 'analysis'), ('T2', '2021-01-02', b'b', 'analysis')],
+      [('T2', '2021-01-03', b'c', 'analysis')],
+    ])
+
+  def testBatchWriterBeforeFlush(self):
+    calls = []
+    writer = sqlite.BatchWriter(
+        self.storage, batch_size=2, on_flush=lambda rows: calls.append(len(rows)),
+        before_flush=lambda: calls.append('before'))
+    writer.Write('T2', '2021-01-01', b'a')
+    writer.Write('T2', '2021-01-02', b'b')
+    writer.Flush()
+    self.assertEqual(calls, ['before', 2])
+
+  @unittest.skipIf(codec.zstandard is None, 'zstandard is not installed')
+  def testTrainDictionaryAndRecompress(self):
+    self.storage.WriteMany([
+        ('T%d' % i, '2021-03-01', b'{"ticker": "T%d", "value": %d}' % (i, i), 'raw')
+        for i in range(1000)])
+    self.storage.TrainDictionary('raw')
+    self.storage.Recompress()
+    with self.storage._Shard('2021q1') as shard:
+      stored = shard.con.execute(
+          "SELECT content.data FROM data JOIN content ON content.hash = data.ref "
+          "WHERE ticker = 'T1'").fetchone()[0]
+    self.assertEqual(stored[0], codec.HEADER_ZSTD)
+    self.storage.Close()
+
+    self.storage = sqlite.ShardedSqliteStorage(self.tmp_dir)
+    self.assertEqual(self.storage.Read('T1', '2021-03-01', 'raw'), b'{"ticker": "T1", "value": 1}')
+    self.assertEqual(self.storage.compression['raw'], 'zstd')
+
   def testGetSet(self):
     self.storage.Set('key1', 'val1'.encode('utf-8'))
     self.assertEqual(self.storage.Get('key1'), 'val1'.encode('utf-8'))
 
+  def testReadOnly(self):
+    self.storage.Close()
+    self.storage = sqlite.ShardedSqliteStorage(self.tmp_dir, pragmas=sqlite.ParsePragmas('wal'))
+    reader = sqlite.ShardedSqliteStorage(
+        self.tmp_dir, pragmas=sqlite.ParsePragmas('wal'), read_only=True)
+    quarters = self.storage.ListQuarters()
+    self.assertEqual(reader.Read('T', '2021-12-01'), b'2021-12-01')
+    self.assertIsNone(reader.Read('T', '2022-06-01'))
+    self.assertEqual(reader.List(date_gte='2020-01-01'), {
+      'T': ['2020-02-01', '2021-01-01', '2021-02-01', '2021-12-01'],
+    })
+    self.assertEqual(reader.ReadLatest('T'), b'2021-12-01')
+    self.assertEqual(reader.ListQuarters(), quarters)
+    self.storage.Write('T', '2022-01-05', b'new')
+    self.assertEqual(reader.ReadLatest('T'), b'new')
+    reader.Close()
+
+  def testSeal(self):
+    self.storage.Write('U', '2021-01-01', b'2021-01-01')
+    self.assertEqual(self.storage.Seal(['2021q1']), ['2021q1'])
+    self.assertEqual(
+        sorted(os.listdir(self.tmp_dir)),
+        ['shard-2020q1.sqlite', 'shard-2021q1.sealed.sqlite', 'shard-2021q4.sqlite',
+         'system.sqlite'])
+    self.assertEqual(self.storage.ListQuarters(), ['2020q1', '2021q1', '2021q4'])
+    self.assertEqual(self.storage.ListQuarters(sealed=True), ['2021q1'])
+    self.assertEqual(self.storage.ListQuarters(sealed=False), ['2020q1', '2021q4'])
+
+    for storage in [self.storage, sqlite.ShardedSqliteStorage(self.tmp_dir, read_only=True)]:
+      self.assertEqual(storage.Read('T', '2021-02-01'), b'2021-02-01')
+      self.assertEqual(
+          list(storage.ReadRange('T', '2020-01-01', '2021-12-31')),
+          [(d, d.encode('utf-8'))
+           for d in ['2020-02-01', '2021-01-01', '2021-02-01', '2021-12-01']])
+      self.assertEqual(
+          list(storage.Scan('analysis', '2021-01-01', '2021-01-01')),
+          [('2021-01-01', 'T', b'2021-01-01'), ('2021-01-01', 'U', b'2021-01-01')])
+      self.assertEqual(storage.List(date_gte='2021-01-01')['U'], ['2021-01-01'])
+    with self.storage._Shard('2021q1') as shard:
+      self.assertTrue(shard.read_only)
+      # Both rows reference the same value.
+      self.assertEqual(shard.con.execute('SELECT COUNT(*) FROM content').fetchone()[0], 2)
+
+    with self.assertRaises(sqlite.ShardSealedError):
+      self.storage.Write('T', '2021-01-02', b'x')
+    with self.assertRaises(sqlite.ShardSealedError):
+      self.storage.WriteMany([('T', '2021-12-02', b'y'), ('T', '2021-01-02', b'x')])
+    self.assertIsNone(self.storage.Read('T', '2021-12-02'))
+    with self.assertRaises(sqlite.ShardSealedError):
+      self.storage.Seal(['2021q1'])
+    self.storage.Recompress()
+    self.storage.CollectGarbage()
+
+  def testSealedStateCached(self):
+    self.storage.Write('T', '2021-12-02', b'x')
+    exists = os.path.exists
+    checked = []
+    def Exists(path):
+      checked.append(path)
+      return exists(path)
+    with mock.patch.object(sqlite.os.path, 'exists', Exists):
+      for i in range(3):
+        self.storage.WriteMany([('T', '2021-12-%02d' % (i + 3), b'y', 'analysis')])
+    self.assertEqual([path for path in checked if '.sealed' in path], [])
+    self.storage.Seal(['2021q4'])
+    with self.assertRaises(sqlite.ShardSealedError):
+      self.storage.Write('T', '2021-12-10', b'z')
+
+  def testReadCrossSection(self):
+    self.storage.WriteMany([
+      ('U', '2021-01-01', b'u1', 'analysis'),
+      ('V', '2021-12-02', b'v1', 'analysis'),
+      ('V', '2021-12-03', b'v2', 'other'),
+    ])
+    self.assertEqual(list(self.storage.ReadCrossSection('2021-12-31')), [
+      ('T', '2021-12-01', b'2021-12-01'),
+      ('V', '2021-12-02', b'v1'),
+      ('U', '2021-01-01', b'u1'),
+    ])
+    self.assertEqual(
+        list(self.storage.ReadCrossSection('2021-02-15', max_staleness_days=30)),
+        [('T', '2021-02-01', b'2021-02-01')])
+    self.assertEqual(
+        list(self.storage.ReadCrossSection('2021-12-31', tickers=['U', 'X'])),
+        [('U', '2021-01-01', b'u1')])
+    self.assertEqual(list(self.storage.ReadCrossSection('2019-12-31')), [])
+
+    self.storage.Seal(['2021q1'])
+    with sqlite.ShardedSqliteStorage(self.tmp_dir, read_only=True) as storage:
+      self.assertEqual(
+          list(storage.ReadCrossSection('2021-06-30', tickers=['T', 'U'])),
+          [('T', '2021-02-01', b'2021-02-01'), ('U', '2021-01-01', b'u1')])
+      with storage._Shard('2021q1') as shard:
+        self.assertTrue(shard.cross_section_index)
+
+  def testSealClosedQuartersOnly(self):
+    self.storage.Write('T', sqlite.GetDaysAgoStr(0), b'today')
+    self.assertEqual(self.storage.Seal(), ['2020q1', '2021q1', '2021q4'])
+    self.assertEqual(self.storage.ListQuarters(sealed=False), [sqlite.CurrentQuarter()])
+    with self.assertRaises(ValueError):
+      self.storage.Seal([sqlite.CurrentQuarter()])
+    self.assertEqual(self.storage.ReadLatest('T'), b'today')
+    self.assertEqual(self.storage.Read('T', '2021-12-01'), b'2021-12-01')
+
+  def testSealRecompresses(self):
+    data = b'{"key": "value"}' * 100
+    self.storage.Close()
+    self.storage = sqlite.ShardedSqliteStorage(self.tmp_dir, compression={'*': 'none'})
+    self.storage.Write('T', '2021-03-01', data)
+    self.storage.Close()
+    self.storage = sqlite.ShardedSqliteStorage(self.tmp_dir)
+    self.storage.Seal(['2021q1'])
+    with self.storage._Shard('2021q1') as shard:
+      stored = shard.con.execute(
+          "SELECT content.data FROM data JOIN content ON content.hash = data.ref "
+          "WHERE date = '2021-03-01'").fetchone()[0]
+    self.assertEqual(stored[0], codec.HEADER_ZLIB)
+    self.assertEqual(self.storage.Read('T', '2021-03-01'), data)
+
+  def testReadOnlyWithoutLatestIndex(self):
+    self.storage.system.con.execute('DROP TABLE latest')
+    self.storage.system.con.commit()
+    reader = sqlite.ShardedSqliteStorage(self.tmp_dir, read_only=True)
+    self.assertEqual(reader.ReadLatestDate('T'), '2021-12-01')
+    self.assertIsNone(reader.ReadLatestDate('T', 'other'))
+    reader.Close()
+
+
+def JsonProjection(data: bytes):
+  return sorted(json.loads(data.decode('utf-8')).items())
+
+
+class TestFeatures(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.storage = self._Storage()
+    self.storage.WriteMany([
+      ('A', '2021-01-04', b'{"x": 1.0, "y": 10}', 'grp'),
+      ('B', '2021-01-04', b'{"x": 2.0}', 'grp'),
+      ('A', '2021-01-05', b'{"x": 3.0}', 'grp'),
+      ('A', '2021-01-05', b'not projected', 'other'),
+    ])
+    self.storage.Write('B', '2021-04-01', b'{"x": 4.0}', 'grp')
+
+  def tearDown(self) -> None:
+    self.storage.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def _Storage(self, **kwargs) -> sqlite.ShardedSqliteStorage:
+    return sqlite.ShardedSqliteStorage(
+        self.tmp_dir, projections={'grp': JsonProjection}, **kwargs)
+
+  def testReadFeature(self):
+    self.assertEqual(self.storage.FeatureFields('grp'), ['x', 'y'])
+    self.assertEqual(list(self.storage.ReadFeature('grp', 'x', '2021-01-01', '2021-12-31')), [
+      ('2021-01-04', 'A', 1.0),
+      ('2021-01-04', 'B', 2.0),
+      ('2021-01-05', 'A', 3.0),
+      ('2021-04-01', 'B', 4.0),
+    ])
+    self.assertEqual(
+        list(self.storage.ReadFeature('grp', 'y', '2021-01-01', '2021-12-31', ['A'])),
+        [('2021-01-04', 'A', 10.0)])
+    self.assertEqual(list(self.storage.ReadFeature('grp', 'z', '2021-01-01', '2021-12-31')), [])
+
+  def testRewriteReplacesFeatures(self):
+    self.storage.Write('A', '2021-01-04', b'{"x": 5.0}', 'grp')
+    self.assertEqual(
+        list(self.storage.ReadFeature('grp', 'y', '2021-01-01', '2021-12-31')), [])
+    self.assertEqual(
+        list(self.storage.ReadFeature('grp', 'x', '2021-01-04', '2021-01-04', ['A'])),
+        [('2021-01-04', 'A', 5.0)])
+
+  def testFeatureCrossSection(self):
+    self.assertEqual(list(self.storage.FeatureCrossSection('2021-06-30', 'grp', 'x')), [
+      ('B', '2021-04-01', 4.0),
+      ('A', '2021-01-05', 3.0),
+    ])
+    self.assertEqual(
+        list(self.storage.FeatureCrossSection('2021-01-04', 'grp', 'x', max_staleness_days=0)),
+        [('A', '2021-01-04', 1.0), ('B', '2021-01-04', 2.0)])
+
+  def testAggregateFeature(self):
+    self.assertEqual(
+        list(self.storage.AggregateFeature('grp', 'x', '2021-01-01', '2021-12-31')),
+        [('2021-01-04', 2, 1.5), ('2021-01-05', 1, 3.0), ('2021-04-01', 1, 4.0)])
+    self.assertEqual(
+        list(self.storage.AggregateFeature('grp', 'x', '2021-01-01', '2021-01-04', 'max')),
+        [('2021-01-04', 2, 2.0)])
+    with self.assertRaises(ValueError):
+      list(self.storage.AggregateFeature('grp', 'x', '2021-01-01', '2021-01-04', 'x); --'))
+
+  def testBackfillFeatures(self):
+    db_dir = os.path.join(self.tmp_dir, 'backfill')
+    os.makedirs(db_dir)
+    with sqlite.ShardedSqliteStorage(db_dir) as storage:
+      storage.WriteMany([
+        ('A', '2021-01-04', b'{"x": 1.0}', 'grp'),
+        ('A', '2021-04-01', b'{"x": 2.0}', 'grp'),
+      ])
+    self.storage.Close()
+    self.storage = sqlite.ShardedSqliteStorage(db_dir, projections={'grp': JsonProjection})
+    self.assertEqual(list(self.storage.ReadFeature('grp', 'x', '2021-01-01', '2021-12-31')), [])
+    self.assertEqual(self.storage.BackfillFeatures(), 2)
+    self.assertEqual(
+        list(self.storage.ReadFeature('grp', 'x', '2021-01-01', '2021-12-31')),
+        [('2021-01-04', 'A', 1.0), ('2021-04-01', 'A', 2.0)])
+
+  def testSealedAndReadOnly(self):
+    self.storage.Seal(['2021q1'])
+    with self._Storage(read_only=True) as storage:
+      self.assertEqual(
+          list(storage.ReadFeature('grp', 'x', '2021-01-01', '2021-12-31', ['A'])),
+          [('2021-01-04', 'A', 1.0), ('2021-01-05', 'A', 3.0)])
+      self.assertEqual(
+          list(storage.AggregateFeature('grp', 'x', '2021-01-04', '2021-01-04', 'sum')),
+          [('2021-01-04', 2, 3.0)])
+
+
+class TestChangeLog(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    self.storage = self._Storage()
+    self.storage.WriteMany([
+      ('A', '2021-03-30', b'{"x": 1.0, "y": 10}', 'grp'),
+      ('B', '2021-03-30', b'{"x": 2.0}', 'grp'),
+      ('A', '2021-03-31', b'{"x": 1.0, "y": 11}', 'grp'),
+      ('A', '2021-04-01', b'{"x": 3.0}', 'grp'),
+      ('A', '2021-04-01', b'not projected', 'other'),
+    ])
+    self.storage.Write('B', '2021-04-02', b'{"x": 2.0}', 'grp')
+
+  def tearDown(self) -> None:
+    self.storage.Close()
+    shutil.rmtree(self.tmp_dir)
+
+  def _Storage(self, **kwargs) -> sqlite.ShardedSqliteStorage:
+    return sqlite.ShardedSqliteStorage(
+        self.tmp_dir, projections={'grp': JsonProjection}, change_log=True, **kwargs)
+
+  def testReadChanges(self):
+    self.assertEqual(list(self.storage.ReadChanges('grp', '2021-01-01', '2021-12-31')), [
+      ('2021-03-31', 'A', 'y', '2021-03-30', 10.0, 11.0),
+      ('2021-04-01', 'A', 'x', '2021-03-31', 1.0, 3.0),
+      ('2021-04-01', 'A', 'y', '2021-03-31', 11.0, None),
+    ])
+    self.assertEqual(
+        list(self.storage.ReadChanges('grp', '2021-04-01', '2021-04-30', paths=['x'])),
+        [('2021-04-01', 'A', 'x', '2021-03-31', 1.0, 3.0)])
+    self.assertEqual(
+        list(self.storage.ReadChanges('grp', '2021-01-01', '2021-12-31', tickers=['B'])), [])
+    self.assertEqual(
+        list(self.storage.ReadChanges('grp', '2021-01-01', '2021-12-31', paths=['z'])), [])
+
+  def testRewrite(self):
+    self.storage.Write('A', '2021-04-01', b'{"x": 1.0, "y": 11}', 'grp')
+    self.storage.Write('B', '2021-04-03', b'{"x": 5.0}', 'grp')
+    self.assertEqual(list(self.storage.ReadChanges('grp', '2021-04-01', '2021-12-31')), [
+      ('2021-04-03', 'B', 'x', '2021-04-02', 2.0, 5.0),
+    ])
+
+  def testBatchedLookups(self):
+    tickers = ['T%02d' % i for i in range(20)]
+    with sqlite.ShardedSqliteStorage(self.tmp_dir) as storage:
+      # Stored without features.
+      storage.Write('T00', '2021-04-05', b'{"x": 0.0}', 'grp')
+    self.storage.WriteMany([
+        (t, '2021-04-05', b'{"x": 1.0}', 'grp') for t in tickers[1:]])
+    projected = []
+    def Projection(data: bytes):
+      projected.append(data)
+      return JsonProjection(data)
+    self.storage.projections['grp'] = Projection
+    statements = []
+    with self.storage._Shard('2021q2') as shard:
+      shard.con.set_trace_callback(statements.append)
+    self.storage.WriteMany([(t, '2021-04-06', b'{"x": 2.0}', 'grp') for t in tickers])
+    with self.storage._Shard('2021q2') as shard:
+      shard.con.set_trace_callback(None)
+    # One lookup of the previous rows, and only the row without features is decoded.
+    self.assertEqual(len([s for s in statements if 'prev_date' in s]), 1)
+    self.assertEqual(len(projected), len(tickers) + 1)
+    changes = list(self.storage.ReadChanges('grp', '2021-04-06', '2021-04-06'))
+    self.assertEqual(changes[:2], [
+      ('2021-04-06', 'T00', 'x', '2021-04-05', 0.0, 2.0),
+      ('2021-04-06', 'T01', 'x', '2021-04-05', 1.0, 2.0),
+    ])
+    self.assertEqual(len(changes), len(tickers))
+
+  def testRewriteInBatch(self):
+    # The rewritten row of 2021-04-01 is the previous row of 2021-04-02.
+    self.storage.WriteMany([
+      ('A', '2021-04-01', b'{"x": 2.0, "y": 11}', 'grp'),
+      ('A', '2021-04-02', b'{"x": 3.0}', 'grp'),
+    ])
+    self.assertEqual(
+        list(self.storage.ReadChanges('grp', '2021-04-02', '2021-04-02', tickers=['A'])), [
+      ('2021-04-02', 'A', 'x', '2021-04-01', 2.0, 3.0),
+      ('2021-04-02', 'A', 'y', '2021-04-01', 11.0, None),
+    ])
+
+  def testBackfillAndSeal(self):
+    db_dir = os.path.join(self.tmp_dir, 'backfill')
+    os.makedirs(db_dir)
+    with sqlite.ShardedSqliteStorage(db_dir) as storage:
+      storage.WriteMany([
+        ('A', '2021-03-31', b'{"x": 1.0}', 'grp'),
+        ('A', '2021-04-01', b'{"x": 2.0}', 'grp'),
+      ])
+    with sqlite.ShardedSqliteStorage(
+        db_dir, projections={'grp': JsonProjection}, change_log=True) as storage:
+      self.assertEqual(storage.BackfillFeatures(), 2)
+      storage.Seal(['2021q1', '2021q2'])
+    with sqlite.ShardedSqliteStorage(db_dir, read_only=True) as storage:
+      self.assertEqual(
+          list(storage.ReadChanges('grp', '2021-01-01', '2021-12-31')),
+          [('2021-04-01', 'A', 'x', '2021-03-31', 1.0, 2.0)])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,193 @@
+"""Fast-start read commands over a snapshot DB, for scripts.
+
+Usage:
+  bazel run storage:yfsnap -- get /path/to/db AAPL,MSFT 2022-03-31 --group=yf.info
+  bazel run storage:yfsnap -- latest /path/to/db AAPL --format=csv
+  bazel run storage:yfsnap -- range /path/to/db AAPL --from=2022-01-01 --to=2022-03-31
+  bazel run storage:yfsnap -- list /path/to/db --group=yf.info --since=2022-03-01
+
+The DB is opened read-only. Snapshots are printed as JSON lines, {"ticker", "date", "group",
+"data"}, with proto groups (see proto_fields.GROUP_MESSAGES) decoded to JSON objects, or as
+(ticker, date, field, value) CSV rows of their numeric fields. Values of other groups are printed
+as JSON if they parse, else as text.
+
+Only the storage and the protos are imported, never pandas or yfinance, to keep the start-up of
+short-lived commands cheap: see `cli_cold_start` in bench/storage_bench.py.
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+from typing import Any, Dict, List, TextIO
+
+from google.protobuf import json_format
+from google.protobuf import message
+
+from analysis import proto_fields
+from storage import sqlite
+
+
+def Decode(group: str, data: bytes) -> Any:
+  """Returns the proto message of a value of a proto group, or its JSON or text."""
+  message_class = proto_fields.GROUP_MESSAGES.get(group)
+  if message_class is not None:
+    return message_class.FromString(data)
+  text = data.decode('utf-8', errors='replace')
+  try:
+    return json.loads(text)
+  except ValueError:
+    return text
+
+
+def Record(ticker: str, date_str: str, group: str, data: bytes) -> Dict[str, Any]:
+  """Returns the JSON object of a snapshot, with its value decoded."""
+  value = Decode(group, data)
+  if isinstance(value, message.Message):
+    value = json_format.MessageToDict(value, preserving_proto_field_name=True)
+  return {'ticker': ticker, 'date': date_str, 'group': group, 'data': value}
+
+
+class JsonWriter(object):
+  """Writes snapshots and dates as JSON lines."""
+
+  def __init__(self, out: TextIO):
+    self.out = out
+
+  def Snapshot(self, ticker: str, date_str: str, group: str, data: bytes):
+    self._Write(Record(ticker, date_str, group, data))
+
+  def Dates(self, ticker: str, dates: List[str]):
+    self._Write({'ticker': ticker, 'dates': dates})
+
+  def _Write(self, record):
+    self.out.write(json.dumps(record, sort_keys=True))
+    self.out.write('\n')
+
+
+class CsvWriter(object):
+  """Writes snapshots as (ticker, date, field, value) rows and dates as (ticker, date) rows."""
+
+  def __init__(self, out: TextIO):
+    self.writer = csv.writer(out, lineterminator='\n')
+    self.header = None
+
+  def Snapshot(self, ticker: str, date_str: str, group: str, data: bytes):
+    self._Header(['ticker', 'date', 'field', 'value'])
+    value = Decode(group, data)
+    if isinstance(value, message.Message):
+      for path, number in proto_fields.Flatten(value):
+        self.writer.writerow([ticker, date_str, path, number])
+    elif isinstance(value, str):
+      self.writer.writerow([ticker, date_str, '', value])
+    else:
+      self.writer.writerow([ticker, date_str, '', json.dumps(value, sort_keys=True)])
+
+  def Dates(self, ticker: str, dates: List[str]):
+    self._Header(['ticker', 'date'])
+    for date_str in dates:
+      self.writer.writerow([ticker, date_str])
+
+  def _Header(self, header: List[str]):
+    if self.header is None:
+      self.header = header
+      self.writer.writerow(header)
+
+
+_WRITERS = {
+  'json': JsonWriter,
+  'csv': CsvWriter,
+}
+
+
+def _Tickers(arg: str) -> List[str]:
+  return [ticker for ticker in arg.split(',') if ticker]
+
+
+def Get(db: sqlite.ShardedSqliteStorage, args, writer) -> int:
+  missing = 0
+  for ticker in _Tickers(args.tickers):
+    data = db.Read(ticker, args.date, args.group)
+    if data is None:
+      logging.warning('No %s snapshot of %s on %s' % (args.group, ticker, args.date))
+      missing += 1
+      continue
+    writer.Snapshot(ticker, args.date, args.group, data)
+  return missing
+
+
+def Latest(db: sqlite.ShardedSqliteStorage, args, writer) -> int:
+  missing = 0
+  for ticker in _Tickers(args.tickers):
+    date_str = db.ReadLatestDate(ticker, args.group)
+    data = db.Read(ticker, date_str, args.group) if date_str else None
+    if data is None:
+      logging.warning('No %s snapshot of %s' % (args.group, ticker))
+      missing += 1
+      continue
+    writer.Snapshot(ticker, date_str, args.group, data)
+  return missing
+
+
+def Range(db: sqlite.ShardedSqliteStorage, args, writer) -> int:
+  for ticker in _Tickers(args.tickers):
+    for date_str, data in db.ReadRange(ticker, args.date_from, args.date_to, args.group):
+      writer.Snapshot(ticker, date_str, args.group, data)
+  return 0
+
+
+def ListDates(db: sqlite.ShardedSqliteStorage, args, writer) -> int:
+  for ticker, dates in sorted(db.List(args.group, args.since).items()):
+    writer.Dates(ticker, dates)
+  return 0
+
+
+def ParseArgs(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  commands = parser.add_subparsers(dest='command')
+  commands.required = True
+
+  def AddCommand(name: str, func, help: str):
+    cmd = commands.add_parser(name, help=help)
+    cmd.add_argument('db_path')
+    cmd.add_argument('--group', default='yf.info', help='Storage group, e.g. yf.analysis.')
+    cmd.add_argument('--format', default='json', choices=sorted(_WRITERS))
+    cmd.set_defaults(func=func)
+    return cmd
+
+  cmd = AddCommand('get', Get, 'Print the snapshots of tickers on a date.')
+  cmd.add_argument('tickers', help='Comma separated tickers.')
+  cmd.add_argument('date', help='YYYY-MM-DD')
+
+  cmd = AddCommand('latest', Latest, 'Print the latest snapshots of tickers.')
+  cmd.add_argument('tickers', help='Comma separated tickers.')
+
+  cmd = AddCommand('range', Range, 'Print the snapshots of tickers between two dates.')
+  cmd.add_argument('tickers', help='Comma separated tickers.')
+  cmd.add_argument('--from', dest='date_from', required=True, help='First date, YYYY-MM-DD.')
+  cmd.add_argument('--to', dest='date_to', required=True, help='Last date, YYYY-MM-DD.')
+
+  cmd = AddCommand('list', ListDates, 'Print the snapshot dates of each ticker.')
+  cmd.add_argument('--since', default='2022-01-01', help='First date, YYYY-MM-DD.')
+  return parser.parse_args(argv)
+
+
+def Main(argv=None, out: TextIO = None) -> int:
+  """Runs a command, writing to out (stdout by default), and returns the exit status.
+
+  The status is 1 if a requested snapshot is missing and 2 if there is no DB at the path.
+  """
+  args = ParseArgs(argv)
+  if not os.path.exists(os.path.join(args.db_path, 'system.sqlite')):
+    logging.error('No DB in %s' % args.db_path)
+    return 2
+  writer = _WRITERS[args.format](out or sys.stdout)
+  with sqlite.ShardedSqliteStorage(args.db_path, read_only=True) as db:
+    missing = args.func(db, args, writer)
+  return 1 if missing else 0
+
+
+if __name__ == '__main__':
+  logging.basicConfig(format='%(levelname)s %(message)s', level=logging.WARNING)
+  sys.exit(Main())
@@ -0,0 +1,104 @@
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from protos import yfinance_pb2 as yfpb
+from storage import sqlite
+from storage import yfsnap
+
+# Modules too slow to import for short-lived read commands.
+_HEAVY_MODULES = ['numpy', 'pandas', 'requests', 'yfinance']
+
+
+def Info(price_target: float) -> bytes:
+  info = yfpb.Info()
+  info.price_target.average = price_target
+  return info.SerializeToString()
+
+
+class TestYfsnap(unittest.TestCase):
+
+  def setUp(self) -> None:
+    self.tmp_dir = tempfile.mkdtemp()
+    with sqlite.ShardedSqliteStorage(self.tmp_dir) as db:
+      db.WriteMany([
+        ('A', '2022-03-30', Info(10.0), 'yf.info'),
+        ('A', '2022-04-01', Info(11.0), 'yf.info'),
+        ('B', '2022-03-30', Info(20.0), 'yf.info'),
+        ('A', '2022-04-01', b'{"price": 1.5}', 'raw.info'),
+      ])
+
+  def tearDown(self) -> None:
+    shutil.rmtree(self.tmp_dir)
+
+  def _Run(self, *argv):
+    out = io.StringIO()
+    status = yfsnap.Main([argv[0], self.tmp_dir] + list(argv[1:]), out)
+    return status, out.getvalue()
+
+  def testGet(self):
+    status, out = self._Run('get', 'A,B', '2022-03-30')
+    self.assertEqual(status, 0)
+    self.assertEqual([json.loads(line) for line in out.splitlines()], [
+      {'ticker': 'A', 'date': '2022-03-30', 'group': 'yf.info',
+       'data': {'price_target': {'average': 10.0}}},
+      {'ticker': 'B', 'date': '2022-03-30', 'group': 'yf.info',
+       'data': {'price_target': {'average': 20.0}}},
+    ])
+    status, out = self._Run('get', 'A,C', '2022-03-30')
+    self.assertEqual(status, 1)
+    self.assertEqual(len(out.splitlines()), 1)
+
+  def testLatest(self):
+    status, out = self._Run('latest', 'A,B', '--format=csv')
+    self.assertEqual(status, 0)
+    self.assertEqual(out, '\n'.join([
+      'ticker,date,field,value',
+      'A,2022-04-01,price_target.average,11.0',
+      'B,2022-03-30,price_target.average,20.0',
+    ]) + '\n')
+    _, out = self._Run('latest', 'A', '--group=raw.info')
+    self.assertEqual(json.loads(out)['data'], {'price': 1.5})
+
+  def testRange(self):
+    _, out = self._Run('range', 'A', '--from=2022-01-01', '--to=2022-12-31', '--format=csv')
+    self.assertEqual(out.splitlines()[1:], [
+      'A,2022-03-30,price_target.average,10.0',
+      'A,2022-04-01,price_target.average,11.0',
+    ])
+
+  def testList(self):
+    _, out = self._Run('list', '--since=2022-01-01')
+    self.assertEqual([json.loads(line) for line in out.splitlines()], [
+      {'ticker': 'A', 'dates': ['2022-03-30', '2022-04-01']},
+      {'ticker': 'B', 'dates': ['2022-03-30']},
+    ])
+    _, out = self._Run('list', '--since=2022-04-01', '--format=csv')
+    self.assertEqual(out, 'ticker,date\nA,2022-04-01\n')
+
+  def testNoDb(self):
+    self.assertEqual(yfsnap.Main(['list', os.path.join(self.tmp_dir, 'missing')]), 2)
+
+  def testReadOnly(self):
+    self._Run('latest', 'A')
+    self._Run('list', '--since=2023-01-01')
+    self.assertEqual(
+        sorted(os.listdir(self.tmp_dir)),
+        ['shard-2022q1.sqlite', 'shard-2022q2.sqlite', 'system.sqlite'])
+
+  def testImportsNoHeavyModules(self):
+    code = 'import sys\nimport %s\nprint(",".join(m for m in %r if m in sys.modules))'
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    for module in ['storage.yfsnap', 'analysis.yfinance_client']:
+      out = subprocess.check_output(
+          [sys.executable, '-c', code % (module, _HEAVY_MODULES)], env=env)
+      self.assertEqual(out.decode('utf-8').strip(), '', module)
+
+
+if __name__ == '__main__':
+  unittest.main()